@@ -22,6 +22,8 @@ from datetime import timedelta
 from src.multiplayer import multiplayer
 from src.singleplayer import singleplayer
 from src.admin import admin
+from src.customvision.classifier import get_classifier
+from src import storage
 
 
 def create_app():
@@ -75,6 +77,10 @@ def create_app():
     except Exception as e:
         app.logger.error("Error when creating DB in Azure. " + str(e))
 
+    # Let the classifier use the database from background threads
+    get_classifier().init_app(app)
+    storage.init_app(app)
+
     try:
         Migrate(app, db)
     except Exception as e:
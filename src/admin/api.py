@@ -1,22 +1,24 @@
 from flask import Blueprint, current_app, request, session, jsonify
+import hmac
 import json
 import os
 from datetime import datetime, timezone, timedelta
 from PIL import Image, ImageChops
-from threading import Thread
 from io import BytesIO
 from src import storage
 import pytz
 import src.models as shared_models
 from src.utilities import setup
 from src.utilities.keys import Keys
-from src.customvision.classifier import Classifier
+from src.customvision.classifier import get_classifier
+from src.customvision.training import TrainingManager
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug import exceptions as excp
 import requests
 
 admin = Blueprint("admin", __name__)
-classifier = Classifier()
+classifier = get_classifier()
+training = TrainingManager(classifier)
 norwegian_tz = pytz.timezone("Europe/Oslo")
 log_pattern = r"(?P<date>\d{4}-\d{2}-\d{2}) (?P<time>\d{2}:\d{2}:\d{2},\d{3}) (?P<level>[A-Z]+) (?P<message>.*)"
 
@@ -117,28 +119,38 @@ def admin_page(action):
 
     elif action == "trainML":
         # Run training asynchronously
-        Thread(target=classifier.retrain).start()
+        training.start("retrain")
         return json.dumps({"success": "Training started"}), 200
 
     elif action == "hardReset":
-        # Delete all images in CV, upload all orignal images and retrain
-        classifier.delete_all_images()
-        try:
-            storage.clear_dataset()
-        except Exception as e:
-            current_app.logger.error(e)
-        Thread(target=classifier.hard_reset_retrain).start()
-        response = {"success": "All images deleted, model now training"}
+        # Delete all images in CV, upload all orignal images and retrain.
+        # Raises Conflict before deleting anything if a job is running
+        training.start("hardReset")
+        response = {"success": "Deleting all images, model will retrain"}
         return json.dumps(response), 200
 
+    elif action == "trainingStatus":
+        return json.dumps(training.status()), 200
+
+    elif action == "cancelTraining":
+        if not training.cancel():
+            raise excp.BadRequest("No training job is running")
+        return json.dumps({"success": "Training cancelled"}), 200
+
     elif action == "status":
         try:
-            new_blob_image_count = storage.image_count()
+            label_counts = storage.image_counts()
             iteration = classifier.get_iteration()
             data = {
                 "CV_iteration_name": iteration.name,
                 "CV_time_created": str(iteration.created),
-                "BLOB_image_count": new_blob_image_count,
+                "BLOB_image_count": sum(label_counts.values()),
+                "BLOB_label_counts": label_counts,
+                "BLOB_upload_queue": storage.get_upload_queue().stats(),
+                "BLOB_clients": storage.blob_client_stats(),
+                "BLOB_example_cache": (
+                    storage.get_example_image_cache().stats()
+                ),
             }
         except Exception as e:
             current_app.logger.error(
@@ -147,6 +159,20 @@ def admin_page(action):
             return json.dumps(e), 500
         return json.dumps(data), 200
 
+    elif action == "predictionStatus":
+        data = {
+            "backend": classifier.backend.name,
+            "fallback": classifier.fallback and classifier.fallback.name,
+            "breaker": classifier.breaker.stats(),
+            "cache": classifier.cache.stats(),
+            "rate_limit": classifier.limiter.stats(),
+            "shadow": classifier.shadow and classifier.shadow.stats(),
+        }
+        return json.dumps(data), 200
+
+    elif action == "metrics":
+        return json.dumps(classifier.metrics.snapshot()), 200
+
     elif action == "logging":
         url = Keys.get("INSIGHTS_URL")
 
@@ -176,6 +202,58 @@ def admin_page(action):
         return json.dumps({"error": "Admin action unspecified"}), 400
 
 
+@admin.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Prediction metrics in the Prometheus text format. Requires the
+    METRICS_TOKEN key as bearer token if it is set, else an admin session.
+    """
+    if Keys.exists("METRICS_TOKEN"):
+        expected = "Bearer " + Keys.get("METRICS_TOKEN")
+        received = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(received, expected):
+            raise excp.Unauthorized()
+    else:
+        is_authenticated()
+
+    uploads = storage.get_upload_queue().stats()
+    lines = [
+        "# HELP upload_queue_depth Images waiting to be uploaded.",
+        "# TYPE upload_queue_depth gauge",
+        f"upload_queue_depth {uploads['depth']}",
+        "# HELP upload_queue_lag_seconds Age of the oldest waiting image.",
+        "# TYPE upload_queue_lag_seconds gauge",
+        f"upload_queue_lag_seconds {uploads['lag']}",
+        "# HELP upload_queue_spooled_total Images spooled to disk.",
+        "# TYPE upload_queue_spooled_total counter",
+        f"upload_queue_spooled_total {uploads['spooled']}",
+    ]
+    blob_clients = storage.blob_client_stats()
+    connections = blob_clients["connections"]
+    lines += [
+        "# HELP blob_connections_opened_total Connections to Blob Storage.",
+        "# TYPE blob_connections_opened_total counter",
+        f"blob_connections_opened_total {connections['opened']}",
+        "# HELP blob_connections_idle Idle connections to Blob Storage.",
+        "# TYPE blob_connections_idle gauge",
+        f"blob_connections_idle {connections['idle']}",
+        "# HELP blob_request_latency_seconds Latency of Blob requests.",
+        "# TYPE blob_request_latency_seconds summary",
+    ]
+    name = "blob_request_latency_seconds"
+    for method, latency in blob_clients["requests"].items():
+        for q, seconds in latency["quantiles"].items():
+            labels = f'method="{method}",quantile="{q}"'
+            lines.append(f"{name}{{{labels}}} {seconds}")
+        labels = f'method="{method}"'
+        total = latency["mean"] * latency["count"]
+        lines.append(f"{name}_sum{{{labels}}} {total}")
+        lines.append(f"{name}_count{{{labels}}} {latency['count']}")
+    headers = {"Content-Type": "text/plain; version=0.0.4"}
+    body = classifier.metrics.prometheus() + "\n".join(lines) + "\n"
+    return body, 200, headers
+
+
 def is_authenticated():
     """
     Check if user has an unexpired cookie. Renew time if not expired.
@@ -0,0 +1,133 @@
+"""
+    Micro-batching of predictions for the local backend. A model running on
+    the CPU predicts a batch of images in about the same time as a single
+    image, so concurrent requests are gathered before they are predicted.
+"""
+
+import time
+from queue import Empty
+from queue import Queue
+from threading import Event
+from threading import Lock
+from threading import Thread
+
+
+class _Request:
+    """
+    An image waiting in the scheduler queue.
+    """
+
+    def __init__(self, image, iteration_name) -> None:
+        self.image = image
+        self.iteration_name = iteration_name
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class BatchScheduler:
+    """
+    Collects images submitted from any thread or greenlet and predicts them
+    with predict_batch(images, iteration_name). A batch is predicted when it
+    holds max_batch_size images, or max_wait seconds after its first image
+    arrived, whichever comes first. Each caller gets its own result back.
+    If prepare is given, prepare(image) decodes the image in the caller's
+    thread before it is queued, so an invalid image fails only its own
+    request. If a batch fails anyway, its images are predicted one by one.
+    """
+
+    def __init__(
+        self, predict_batch, max_batch_size, max_wait, prepare=None
+    ) -> None:
+        self.predict_batch = predict_batch
+        self.prepare = prepare
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.images = 0
+        self._queue = Queue()
+        self._worker = None
+        self._lock = Lock()
+
+    def submit(self, image, iteration_name):
+        """
+        Queues an image and blocks until its prediction is ready.
+        """
+        if self.prepare is not None:
+            image = self.prepare(image)
+        self._start()
+        request = _Request(image, iteration_name)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _start(self) -> None:
+        """
+        Starts the worker on first use, so it runs in the process serving
+        the requests and not in a parent process that forked it.
+        """
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = Thread(target=self._run, daemon=True)
+                self._worker.start()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except Empty:
+                    break
+
+            self._predict(batch)
+
+    def _predict(self, batch) -> None:
+        """
+        Predicts a batch, one call per iteration name in the batch.
+        """
+        iterations = {}
+        for request in batch:
+            iterations.setdefault(request.iteration_name, []).append(request)
+
+        for iteration_name, requests in iterations.items():
+            try:
+                results = self.predict_batch(
+                    [request.image for request in requests], iteration_name
+                )
+                for request, result in zip(requests, results):
+                    request.result = result
+            except Exception as e:
+                if len(requests) == 1:
+                    requests[0].error = e
+                else:
+                    # find the image that failed, the others still get
+                    # their result
+                    self._predict_each(requests, iteration_name)
+            self.batches += 1
+            self.images += len(requests)
+
+        for request in batch:
+            request.done.set()
+
+    def _predict_each(self, requests, iteration_name) -> None:
+        for request in requests:
+            try:
+                request.result = self.predict_batch(
+                    [request.image], iteration_name
+                )[0]
+            except Exception as e:
+                request.error = e
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "images": self.images,
+            "queued": self._queue.qsize(),
+        }
@@ -0,0 +1,108 @@
+"""
+    Circuit breaker for prediction backends. When a backend keeps failing or
+    answering slower than its latency budget, calls are rejected right away
+    for a while instead of piling up behind it.
+"""
+
+import time
+from threading import Lock
+from src.utilities.exceptions import PredictionUnavailable
+
+
+class CircuitBreaker:
+    """
+    The breaker is closed while the backend is healthy. It opens after
+    failure_threshold failures in a row, where a call slower than
+    latency_budget seconds counts as a failure. While open, calls raise
+    PredictionUnavailable. After reset_timeout seconds one trial call is let
+    through (half-open), which closes the breaker again if it succeeds.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(
+        self, name, failure_threshold, reset_timeout, latency_budget
+    ) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.latency_budget = latency_budget
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.rejected = 0
+        self._opened_at = 0
+        self._lock = Lock()
+
+    def call(self, function, *args, before=None):
+        """
+        Calls function(*args) if the breaker allows it. If given, before()
+        is called first, e.g. to wait for a rate limiter token. Its time and
+        errors are not held against the backend.
+        """
+        self._before_call()
+        if before is not None:
+            try:
+                before()
+            except Exception:
+                self._release_trial()
+                raise
+        start = time.monotonic()
+        try:
+            result = function(*args)
+        except Exception:
+            self._record(success=False)
+            raise
+        elapsed = time.monotonic() - start
+        self._record(success=elapsed <= self.latency_budget)
+        return result
+
+    def _before_call(self) -> None:
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at >= self.reset_timeout:
+                    # let one trial call through
+                    self.state = self.HALF_OPEN
+                    return
+            if self.state != self.CLOSED:
+                self.rejected += 1
+                raise PredictionUnavailable(
+                    "Prediction backend " + self.name + " is unavailable"
+                )
+
+    def _release_trial(self) -> None:
+        """
+        Lets the next call be the trial call, if this one never reached the
+        backend.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def _record(self, success: bool) -> None:
+        with self._lock:
+            if success:
+                self.failures = 0
+                self.state = self.CLOSED
+                return
+
+            self.failures += 1
+            is_trial = self.state == self.HALF_OPEN
+            if is_trial or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "backend": self.name,
+                "state": self.state,
+                "failures": self.failures,
+                "trips": self.trips,
+                "rejected": self.rejected,
+                "latency_budget": self.latency_budget,
+            }
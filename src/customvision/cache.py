@@ -0,0 +1,90 @@
+"""
+    In-memory cache for predictions. Clients resend the canvas several
+    times during a round, and identical images do not need to be predicted
+    more than once by the same iteration.
+"""
+
+import hashlib
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class PredictionCache:
+    """
+    Least recently used cache where entries also expire after ttl seconds.
+    Entries are keyed on a digest of the image bytes and the iteration name,
+    so a new iteration never receives results from the previous one.
+    """
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        """
+        Parameters:
+        max_size: maximum number of cached predictions, 0 disables the cache
+        ttl: number of seconds a prediction is kept
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def key(image: bytes, iteration_name: str) -> str:
+        """
+        Returns the cache key of an image predicted by the given iteration.
+        """
+        digest = hashlib.blake2b(image, digest_size=16).hexdigest()
+        return f"{iteration_name}:{digest}"
+
+    def get(self, key):
+        """
+        Returns the cached (prediction, best_guess) tuple, or None if the key
+        is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+        pred_kv, best_guess = entry[1]
+        return dict(pred_kv), best_guess
+
+    def put(self, key, value) -> None:
+        """
+        Stores a (prediction, best_guess) tuple, evicting the least recently
+        used entry if the cache is full.
+        """
+        if self.max_size <= 0:
+            return
+
+        pred_kv, best_guess = value
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = (expires, (dict(pred_kv), best_guess))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns the size of the cache and the hit and miss counters.
+        """
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,56 @@
+"""
+    Normalization of canvases before they are sent to the prediction
+    backend. Clients upload the full canvas as an RGBA .png, while the model
+    only needs the drawing itself in grayscale at model resolution.
+"""
+
+from io import BytesIO
+from PIL import Image, ImageChops
+from src.utilities import setup
+
+
+def normalize_canvas(image: bytes):
+    """
+    Crops the canvas to the bounding box of the ink, converts it to
+    grayscale and re-encodes it as a square .png of MODEL_RESOLUTION pixels.
+    A blank canvas is only scaled down.
+
+    Returns:
+    (image (bytes): the normalized .png,
+    bytes_saved (int): reduction in size compared to the uploaded image)
+    """
+    img = Image.open(BytesIO(image))
+    if img.mode in ("RGBA", "LA", "P"):
+        # transparent pixels are part of the white background
+        img = img.convert("RGBA")
+        background = Image.new("RGBA", img.size, (255, 255, 255, 255))
+        img = Image.alpha_composite(background, img)
+    img = img.convert("L")
+
+    bbox = ImageChops.invert(img).getbbox()
+    if bbox is not None:
+        img = img.crop(bbox)
+
+    # pad the drawing to a square, with a margin around the ink
+    side = int(max(img.size) * (1 + 2 * setup.CANVAS_MARGIN))
+    square = Image.new("L", (side, side), 255)
+    square.paste(img, ((side - img.width) // 2, (side - img.height) // 2))
+    resolution = setup.MODEL_RESOLUTION
+    square = square.resize((resolution, resolution), Image.BILINEAR)
+
+    output = BytesIO()
+    square.save(output, format="PNG", compress_level=setup.PNG_COMPRESSION)
+    normalized = output.getvalue()
+    if len(normalized) >= len(image):
+        return image, 0
+    return normalized, len(image) - len(normalized)
+
+
+def blank_canvas() -> bytes:
+    """
+    Returns a white .png at model resolution, used to warm up iterations.
+    """
+    resolution = setup.MODEL_RESOLUTION
+    output = BytesIO()
+    Image.new("L", (resolution, resolution), 255).save(output, format="PNG")
+    return output.getvalue()
@@ -3,15 +3,22 @@
     Tools for interacting with Azure Custom Vision and Azure Blob Storage
 """
 import logging
+import os
+import random
 import uuid
 import time
+from threading import Lock
+from threading import Thread
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
 from typing import Dict
 from typing import List
 from src import models
+from src import storage
 from flask import current_app as app
 from werkzeug import exceptions as excp
 from msrest.authentication import ApiKeyCredentials
-from azure.storage.blob import BlobServiceClient
 from azure.cognitiveservices.vision.customvision.prediction import (
     CustomVisionPredictionClient,
 )
@@ -26,6 +33,19 @@ from azure.cognitiveservices.vision.customvision.training.models import (
 
 from src.utilities.keys import Keys
 from src.utilities import setup
+from src.utilities.sessions import pooled_session
+from src.utilities.sessions import share_session
+from src.customvision.predictors import LocalPredictor
+from src.customvision.predictors import create_predictor
+from src.customvision.cache import PredictionCache
+from src.customvision.canvas import blank_canvas
+from src.customvision.breaker import CircuitBreaker
+from src.customvision.metrics import PredictionMetrics
+from src.customvision.shadow import ShadowPredictor
+from src.customvision.ratelimit import RateLimiter
+from src.utilities.exceptions import PredictionUnavailable
+from src.customvision.manifest import UploadManifest
+from src.customvision.manifest import remove_manifests
 
 
 class Classifier:
@@ -34,6 +54,9 @@ class Classifier:
         - predict_imgage() / predicts a an image
         - upload_images() / reads image URLs from Blob Storage and uploads to Custom Vision
         - train() / trains a model
+    Predictions made with predict_image() and predict_image_by_post() are
+    delegated to a prediction backend, see predictors.py. Every request to
+    Custom Vision is granted by a RateLimiter, see ratelimit.py.
     """
 
     def __init__(self) -> None:
@@ -67,41 +90,285 @@ class Classifier:
         self.trainer = CustomVisionTrainingClient(
             self.ENDPOINT, self.training_credentials
         )
-        connect_str = Keys.get("BLOB_CONNECTION_STRING")
-        self.blob_service_client = BlobServiceClient.from_connection_string(
-            connect_str
+        # keep connections to Custom Vision alive between calls
+        share_session(self.predictor, pooled_session())
+        share_session(self.trainer, pooled_session())
+        self.predictor.config.retry_policy.retries = setup.PREDICTION_RETRIES
+        # the pooled client shared with storage.py
+        self.blob_service_client = storage.get_blob_service_client()
+        # every request to Custom Vision shares the quota of the resource
+        rate = setup.CV_RATE_LIMIT
+        if Keys.exists("CV_RATE_LIMIT"):
+            rate = float(Keys.get("CV_RATE_LIMIT"))
+        self.limiter = RateLimiter(rate, setup.CV_RATE_BURST)
+        if Keys.exists("PREDICTION_BACKEND"):
+            backend_name = Keys.get("PREDICTION_BACKEND")
+        else:
+            backend_name = setup.PREDICTION_BACKEND
+        if Keys.exists("LOCAL_MODEL_PATH"):
+            self.local_model_path = Keys.get("LOCAL_MODEL_PATH")
+        else:
+            self.local_model_path = setup.LOCAL_MODEL_PATH
+        self.backend = create_predictor(backend_name, self)
+        self.breaker = CircuitBreaker(
+            self.backend.name,
+            setup.BREAKER_FAILURE_THRESHOLD,
+            setup.BREAKER_RESET_TIMEOUT,
+            setup.PREDICTION_LATENCY_BUDGET,
         )
+        # backend used while the breaker is open, e.g. a local model
+        if Keys.exists("FALLBACK_BACKEND"):
+            fallback_name = Keys.get("FALLBACK_BACKEND")
+        else:
+            fallback_name = setup.FALLBACK_BACKEND
+        self.fallback = None
+        if fallback_name and fallback_name != self.backend.name:
+            self.fallback = create_predictor(fallback_name, self)
+        self.cache = PredictionCache(
+            setup.PREDICTION_CACHE_SIZE, setup.PREDICTION_CACHE_TTL
+        )
+        self.metrics = PredictionMetrics()
+        self.shadow = self._create_shadow()
+        # Flask app used for database access, see init_app()
+        self.app = None
+        # The iteration name is resolved on first use and refreshed in the
+        # background, see the iteration_name property
+        self._iteration_name = None
+        self._iteration_expires = 0
+        self._iteration_lock = Lock()
+        self._refreshing = False
+        if isinstance(self.backend, LocalPredictor):
+            # a local model does not need Custom Vision to be reachable
+            self._iteration_name = self.backend.model_name
+            self._iteration_expires = float("inf")
+
+    def _create_shadow(self):
+        """
+        Creates the candidate backend or iteration that SHADOW_FRACTION of
+        the predictions are also sent to, or None if shadowing is off. The
+        candidate is set with the SHADOW_BACKEND and SHADOW_ITERATION keys.
+        """
+        shadow_name = setup.SHADOW_BACKEND
+        if Keys.exists("SHADOW_BACKEND"):
+            shadow_name = Keys.get("SHADOW_BACKEND")
+        shadow_iteration = None
+        if Keys.exists("SHADOW_ITERATION"):
+            shadow_iteration = Keys.get("SHADOW_ITERATION")
+        if not shadow_name and not shadow_iteration:
+            return None
+
+        if not shadow_name:
+            shadow_name = self.backend.name
+        if isinstance(self.backend, LocalPredictor) and (
+            shadow_name == self.backend.name
+        ):
+            predictor = self.backend
+        else:
+            # shadow predictions only use tokens left over by players
+            predictor = create_predictor(
+                shadow_name, self, priority=RateLimiter.BATCH
+            )
+        if shadow_iteration is None:
+            # a local model predicts with its own name, Custom Vision with
+            # the live iteration, read again for every shadow prediction
+            shadow_iteration = getattr(predictor, "model_name", None) or (
+                partial(getattr, self, "iteration_name")
+            )
+        return ShadowPredictor(
+            predictor,
+            shadow_iteration,
+            setup.SHADOW_FRACTION,
+            setup.SHADOW_LOG_PATH,
+            setup.SHADOW_WORKERS,
+            setup.SHADOW_MAX_PENDING,
+        )
+
+    def init_app(self, app) -> None:
+        """
+        Registers the Flask app, used to read and store the iteration name
+        from background threads.
+        """
+        self.app = app
+
+    def app_context(self):
+        """
+        Returns an app context for the registered app, or for the current
+        app if none is registered.
+        """
+        if self.app is not None:
+            return self.app.app_context()
+        return app.app_context()
+
+    @property
+    def iteration_name(self) -> str:
+        """
+        Name of the published iteration used for predictions. On first use
+        it is read from the database, or from Custom Vision if no name is
+        stored. It is then refreshed in the background every
+        ITERATION_REFRESH_INTERVAL seconds.
+        """
+        if self._iteration_name is None:
+            self.refresh_iteration_name(from_database=True)
+        elif time.monotonic() > self._iteration_expires:
+            self._refresh_in_background()
+        return self._iteration_name
+
+    @iteration_name.setter
+    def iteration_name(self, name: str) -> None:
+        self._iteration_name = name
+        self._iteration_expires = (
+            time.monotonic() + setup.ITERATION_REFRESH_INTERVAL
+        )
+
+    def refresh_iteration_name(self, from_database: bool = False) -> None:
+        """
+        Resolves the iteration name. If from_database is set, the name
+        stored by any worker is used when there is one. Otherwise the latest
+        published iteration is fetched from Custom Vision, and stored if it
+        has changed. If Custom Vision can't be reached, the current name is
+        kept, or DEFAULT_ITERATION_NAME is used if there is none.
+        """
+        if from_database:
+            stored_name = self._stored_iteration_name()
+            if stored_name is not None:
+                self.iteration_name = stored_name
+                return
+
         try:
-            # get all project iterations
-            iterations = self.trainer.get_iterations(self.project_id)
-            # find published iterations
-            puplished_iterations = [
-                iteration
-                for iteration in iterations
-                if iteration.publish_name is not None
-            ]
-            # get the latest published iteration
-            puplished_iterations.sort(key=lambda i: i.created)
-            self.iteration_name = puplished_iterations[-1].publish_name
+            name = self.get_published_iteration_name()
         except Exception as e:
-            logging.info(
-                "An error occurred while trying to get latest published iteration from Custom Vision",
-                e,
+            logging.warning(
+                "Could not get latest published iteration from Custom "
+                "Vision: " + str(e)
             )
-            self.iteration_name = "Iteration4"
+            if self._iteration_name is None:
+                self._iteration_name = setup.DEFAULT_ITERATION_NAME
+                logging.warning(
+                    "Using default iteration name " + self._iteration_name
+                )
+            # try again sooner than a normal refresh
+            self._iteration_expires = (
+                time.monotonic() + setup.ITERATION_RETRY_INTERVAL
+            )
+            return
+
+        if self._iteration_name is None:
+            # first use, there is no traffic to protect yet
+            self._store_iteration_name(name)
+            self.iteration_name = name
+        elif not self.swap_iteration(name):
+            self._iteration_expires = (
+                time.monotonic() + setup.ITERATION_RETRY_INTERVAL
+            )
+        else:
+            self.iteration_name = name
 
-    def predict_image_url(self, img_url: str) -> Dict[str, float]:
+    def swap_iteration(
+        self, name: str, warm_up: bool = setup.WARM_UP_ITERATION
+    ) -> bool:
+        """
+        Switches predictions over to the published iteration with the given
+        name, without interrupting requests in progress. If warm_up is set,
+        the iteration first predicts a blank canvas, so the first player
+        using it does not pay for a cold start. The name is stored in the
+        database, and the other workers switch at their next refresh.
+
+        Returns:
+        True if the iteration is now in use, False if the warm-up failed.
+        """
+        if name == self._iteration_name:
+            return True
+
+        if warm_up:
+            try:
+                self.backend.predict(blank_canvas(), name)
+            except Exception as e:
+                logging.warning(
+                    "Warm-up of iteration " + name + " failed: " + str(e)
+                )
+                return False
+
+        # a single assignment, predictions read the name once
+        self.iteration_name = name
+        self._store_iteration_name(name)
+        logging.info("Switched to iteration " + name)
+        return True
+
+    def get_published_iteration_name(self) -> str:
+        """
+        Returns the publish name of the latest published iteration in
+        Custom Vision.
+        """
+        # get all project iterations
+        iterations = self.limiter.call(
+            RateLimiter.ADMIN, self.trainer.get_iterations, self.project_id
+        )
+        # find published iterations
+        puplished_iterations = [
+            iteration
+            for iteration in iterations
+            if iteration.publish_name is not None
+        ]
+        # get the latest published iteration
+        puplished_iterations.sort(key=lambda i: i.created)
+        return puplished_iterations[-1].publish_name
+
+    def _refresh_in_background(self) -> None:
+        """
+        Starts a refresh of the iteration name, unless one is running. The
+        current name is used until the refresh is done.
+        """
+        with self._iteration_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def refresh():
+            try:
+                self.refresh_iteration_name()
+            finally:
+                self._refreshing = False
+
+        Thread(target=refresh, daemon=True).start()
+
+    def _stored_iteration_name(self):
+        """
+        Returns the iteration name stored in the database, or None.
+        """
+        try:
+            with self.app_context():
+                return models.get_iteration_name()
+        except Exception as e:
+            logging.info("Could not read iteration name: " + str(e))
+            return None
+
+    def _store_iteration_name(self, name: str) -> None:
+        """
+        Stores the iteration name in the database, shared by all workers.
+        """
+        try:
+            with self.app_context():
+                models.update_iteration_name(name)
+        except Exception as e:
+            logging.warning("Could not store iteration name: " + str(e))
+
+    def predict_image_url(
+        self, img_url: str, priority=RateLimiter.ADMIN
+    ) -> Dict[str, float]:
         """
         Predicts label(s) of Image read from URL.
 
         Parameters:
         img_url: Image URL
+        priority: priority of the request in the rate limiter
 
         Returns:
         (prediction (dict[str,float]): labels and assosiated probabilities,
         best_guess: (str): name of the label with highest probability)
         """
-        res = self.predictor.classify_image_url(
+        res = self.limiter.call(
+            priority,
+            self.predictor.classify_image_url,
             project_id=self.project_id,
             published_name=self.iteration_name,
             url=img_url,
@@ -127,17 +394,38 @@ class Classifier:
         (prediction (dict[str,float]): labels and assosiated probabilities,
         best_guess: (str): name of the label with highest probability)
         """
-        res = self.predictor.classify_image_with_no_store(
-            self.project_id, self.iteration_name, img
-        )
+        image = img.read()
+        img.seek(0)
+        # read the name once, it may be swapped while predicting
+        iteration_name = self.iteration_name
+        key = self.cache.key(image, iteration_name)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        if isinstance(self.backend, LocalPredictor):
+            pred_kv = self.backend.predict(image, iteration_name)
+        else:
+            res = self.limiter.call(
+                RateLimiter.LIVE,
+                self.predictor.classify_image_with_no_store,
+                self.project_id,
+                iteration_name,
+                img,
+            )
+            pred_kv = dict(
+                [(i.tag_name, i.probability) for i in res.predictions]
+            )
         # reset the file head such that it does not affect the state of the
         # file handle
         img.seek(0)
-        pred_kv = dict([(i.tag_name, i.probability) for i in res.predictions])
         best_guess = max(pred_kv, key=pred_kv.get)
+        self.cache.put(key, (pred_kv, best_guess))
         return pred_kv, best_guess
 
-    def predict_image_by_post(self, img) -> Dict[str, float]:
+    def predict_image_by_post(
+        self, img, endpoint="unknown"
+    ) -> Dict[str, float]:
         """
         Predicts label(s) of Image read from URL.
         ASSUMES:
@@ -147,27 +435,65 @@ class Classifier:
 
         Parameters:
         img_url: .png file
+        endpoint: name of the endpoint in the prediction metrics
 
         Returns:
         (prediction (dict[str,float]): labels and assosiated probabilities,
         best_guess: (str): name of the label with highest probability)
         """
-
-        headers = {
-            "content-type": "application/octet-stream",
-            "prediction-key": self.prediction_key,
-        }
-        res = self.predictor.classify_image(
-            self.project_id,
-            self.iteration_name,
-            img.read(),
-            custom_headers=headers,
+        image = img.read()
+        img.seek(0)
+        # read the name once, it may be swapped while predicting
+        iteration_name = self.iteration_name
+        with self.metrics.measure(
+            endpoint, self.backend.name, iteration_name
+        ) as measurement:
+            # identical canvases are answered from the cache
+            key = self.cache.key(image, iteration_name)
+            cached = self.cache.get(key)
+            if cached is not None:
+                measurement.done("cache", cached)
+                return cached
+
+            start = time.monotonic()
+            try:
+                # waiting for a rate limit token is not a backend failure
+                pred_kv = self.breaker.call(
+                    self.backend.send,
+                    image,
+                    iteration_name,
+                    before=self.backend.acquire,
+                )
+            except Exception as e:
+                result = self._fallback_predict(image, e)
+                measurement.done(self.fallback.name, result)
+                return result
+
+            best_guess = max(pred_kv, key=pred_kv.get)
+            self.cache.put(key, (pred_kv, best_guess))
+            measurement.done(self.backend.name, (pred_kv, best_guess))
+            if self.shadow is not None:
+                primary = {
+                    "backend": self.backend.name,
+                    "iteration": iteration_name,
+                    "guess": best_guess,
+                }
+                self.shadow.submit(image, primary, time.monotonic() - start)
+            return pred_kv, best_guess
+
+    def _fallback_predict(self, image: bytes, error: Exception):
+        """
+        Predicts with the fallback backend when the primary backend failed
+        or its breaker is open. Raises PredictionUnavailable if there is no
+        fallback. Fallback results are not cached.
+        """
+        logging.warning(
+            "Prediction with " + self.backend.name + " failed: " + str(error)
         )
-        # res = requests.post(Keys.get("CV_PREDICTION_ENDPOINT"), img.read(), headers=headers).json()
+        if self.fallback is None:
+            raise PredictionUnavailable(str(error))
 
-        img.seek(0)
-        # pred_kv = dict([(i["tagName"], i["probability"]) for i in res["predictions"]])
-        pred_kv = dict([(i.tag_name, i.probability) for i in res.predictions])
+        pred_kv = self.fallback.predict(image, self.fallback.name)
         best_guess = max(pred_kv, key=pred_kv.get)
         return pred_kv, best_guess
 
@@ -178,20 +504,30 @@ class Classifier:
         for i in range(0, len(lst), n):
             yield lst[i : i + n]
 
-    def upload_images(self, labels: List, container_name) -> None:
+    def upload_images(
+        self, labels: List, container_name, incremental=False
+    ) -> None:
         """
         Takes as input a list of labels, uploads all assosiated images to Azure Custom Vision project.
         If label in input already exists in Custom Vision project, all images are uploaded directly.
         If label in input does not exist in Custom Vision project, new label (Tag object in Custom Vision) is created before uploading images
+        Blobs are listed and batches are submitted by UPLOAD_WORKERS threads.
+        Progress is checkpointed to a manifest in UPLOAD_MANIFEST_DIR, so an
+        interrupted upload resumes where it stopped. Uploaded blobs are
+        recorded in the UploadedImage table.
 
         Parameters:
         labels (str[]): List of labels
+        incremental (bool): only upload blobs missing from UploadedImage
 
         Returns:
         None
         """
-        url_list = []
-        existing_tags = list(self.trainer.get_tags(self.project_id))
+        existing_tags = list(
+            self.limiter.call(
+                RateLimiter.BATCH, self.trainer.get_tags, self.project_id
+            )
+        )
 
         try:
             container = self.blob_service_client.get_container_client(
@@ -203,6 +539,7 @@ class Classifier:
                 str(e),
             )
 
+        tags = {}
         for label in labels:
             # check if input has correct type
             if not isinstance(label, str):
@@ -212,46 +549,117 @@ class Classifier:
             # check if tag already exists
             if len(tag) == 0:
                 try:
-                    tag = self.trainer.create_tag(self.project_id, label)
+                    tag = self.limiter.call(
+                        RateLimiter.BATCH,
+                        self.trainer.create_tag,
+                        self.project_id,
+                        label,
+                    )
                     print("Created new label in project: " + label)
                 except Exception as e:
                     print(e)
                     continue
             else:
                 tag = tag[0]
-
+            tags[label] = tag
+
+        # if base url ends on /, remove it.
+        base_img_url = self.base_img_url
+        if base_img_url[-1] == "/":
+            base_img_url = base_img_url[:-1]
+
+        uploaded = set()
+        if incremental:
+            with self.app_context():
+                uploaded = models.get_uploaded_images(container_name)
+
+        def list_label(label):
+            """
+            Builds the image URLs of all blobs with the given label.
+            """
             blob_prefix = f"{label}/"
             blob_list = container.list_blobs(name_starts_with=blob_prefix)
+            return [
+                (
+                    blob.name,
+                    ImageUrlCreateEntry(
+                        url=f"{base_img_url}/{container_name}/{blob.name}",
+                        tag_ids=[tags[label].id],
+                    ),
+                )
+                for blob in blob_list
+            ]
 
-            if not blob_list:
-                raise AttributeError("no images for this label")
-
-            # build correct URLs and append to URL list
-
-            # if base url ends on /, remove it.
-            base_img_url = self.base_img_url
-            if base_img_url[-1] == "/":
-                base_img_url = base_img_url[:-1]
-
-            for blob in blob_list:
-                blob_url = f"{base_img_url}/{container_name}/{blob.name}"
-                url_list.append(
-                    ImageUrlCreateEntry(url=blob_url, tag_ids=[tag.id])
+        manifest = UploadManifest(
+            os.path.join(
+                setup.UPLOAD_MANIFEST_DIR, f"upload_{container_name}.jsonl"
+            )
+        )
+        with ThreadPoolExecutor(max_workers=setup.UPLOAD_WORKERS) as pool:
+            url_list = []
+            blob_names = {}
+            for label, entries in zip(tags, pool.map(list_label, tags)):
+                if len(entries) == 0:
+                    print("No images for label: " + label)
+                for blob_name, entry in entries:
+                    if blob_name in uploaded or entry.url in manifest:
+                        continue
+                    blob_names[entry.url] = blob_name
+                    url_list.append(entry)
+
+            if len(url_list) == 0:
+                print("No new images to upload")
+                manifest.remove()
+                return
+
+            # upload URLs in chunks of 64
+            print("Uploading images from blob to CV")
+            if len(manifest.uploaded) > 0:
+                print(f"Resuming, {len(manifest.uploaded)} already uploaded")
+            if len(manifest.failed) > 0:
+                print(f"Retrying {len(manifest.failed)} failed images")
+            chunks = self.__chunks(url_list, setup.CV_MAX_IMAGES)
+            # the URLs of every batch, to know which failed
+            uploads = dict(
+                (
+                    pool.submit(
+                        self.limiter.call,
+                        RateLimiter.BATCH,
+                        self.trainer.create_images_from_urls,
+                        self.project_id,
+                        batch=ImageUrlCreateBatch(images=url_chunk),
+                    ),
+                    [entry.url for entry in url_chunk],
                 )
+                for url_chunk in chunks
+            )
+            self.__report_uploads(
+                uploads, len(url_list), manifest, container_name, blob_names
+            )
 
-        # upload URLs in chunks of 64
-        print("Uploading images from blob to CV")
+    def __report_uploads(
+        self, uploads, num_imgs, manifest, container_name, blob_names
+    ) -> None:
+        """
+        Helper method used by upload_images() to print the progress of the
+        submitted batches, checkpoint them to the manifest and record them
+        in the UploadedImage table.
+        """
         img_f = 0
         img_s = 0
         img_d = 0
         itr_img = 0
-        chunks = self.__chunks(url_list, setup.CV_MAX_IMAGES)
-        num_imgs = len(url_list)
         error_messages = set()
-        for url_chunk in chunks:
-            upload_result = self.trainer.create_images_from_urls(
-                self.project_id, batch=ImageUrlCreateBatch(images=url_chunk)
-            )
+        failed_urls = set()
+        for upload in as_completed(uploads):
+            try:
+                upload_result = upload.result()
+            except Exception as e:
+                error_messages.add(str(e))
+                img_f += 1
+                failed_urls.update(uploads[upload])
+                continue
+
             if not upload_result.is_batch_successful:
                 for image in upload_result.images:
                     if image.status == "OK":
@@ -261,6 +669,7 @@ class Classifier:
                     else:
                         error_messages.add(image.status)
                         img_f += 1
+                        failed_urls.add(image.source_url)
 
                     itr_img += 1
             else:
@@ -268,6 +677,17 @@ class Classifier:
                 img_s += batch_size
                 itr_img += batch_size
 
+            urls = [
+                image.source_url
+                for image in upload_result.images
+                if image.status in ("OK", "OKDuplicate")
+            ]
+            manifest.add(urls)
+            with self.app_context():
+                models.insert_into_uploaded_images(
+                    container_name,
+                    [blob_names[url] for url in urls if url in blob_names],
+                )
             prc = itr_img / num_imgs
             print(
                 f"\t succesfull: \033[92m {img_s:5d} \033]92m \033[0m",
@@ -284,9 +704,13 @@ class Classifier:
             print("Error messages:")
             for error_message in error_messages:
                 print(f"\t {error_message}")
+        # the next upload starts from scratch, except for the failed images
+        manifest.finish(failed_urls)
 
     def get_iteration(self):
-        iterations = self.trainer.get_iterations(self.project_id)
+        iterations = self.limiter.call(
+            RateLimiter.ADMIN, self.trainer.get_iterations, self.project_id
+        )
         iterations.sort(key=(lambda i: i.created))
         newest_iteration = iterations[-1]
         return newest_iteration
@@ -296,19 +720,31 @@ class Classifier:
         Deletes the oldest iteration in Custom Vision if there are 11 iterations.
         Custom Vision allows maximum 10 iterations in the free version.
         """
-        iterations = self.trainer.get_iterations(self.project_id)
+        iterations = self.limiter.call(
+            RateLimiter.BATCH, self.trainer.get_iterations, self.project_id
+        )
         if len(iterations) >= setup.CV_MAX_ITERATIONS:
             iterations.sort(key=lambda i: i.created)
             oldest_iteration = iterations[0].id
-            self.trainer.unpublish_iteration(self.project_id, oldest_iteration)
-            self.trainer.delete_iteration(self.project_id, oldest_iteration)
+            for operation in (
+                self.trainer.unpublish_iteration,
+                self.trainer.delete_iteration,
+            ):
+                self.limiter.call(
+                    RateLimiter.BATCH,
+                    operation,
+                    self.project_id,
+                    oldest_iteration,
+                )
 
-    def train(self, labels: list) -> None:
+    def train(self, labels: list, job=None) -> None:
         """
         Trains model on all labels specified in input list, exeption is raised by self.trainer.train_projec() is asked to train on non existent labels.
         Generates unique iteration name, publishes model and sets self.iteration_name if successful.
         Parameters:
         labels (str[]): List of labels
+        job (TrainingJob): receives the progress of training, and stops it
+            if cancelled
         """
         try:
             email = Keys.get("EMAIL")
@@ -318,16 +754,33 @@ class Classifier:
 
         self.delete_iteration()
         print("Training...")
-        iteration = self.trainer.train_project(
+        iteration = self.limiter.call(
+            RateLimiter.BATCH,
+            self.trainer.train_project,
             self.project_id,
             reserved_budget_in_hours=1,
             notification_email_address=email,
         )
-        # Wait for training to complete
+        # Wait for training to complete, polling less often as it goes on
         start = time.time()
+        interval = setup.TRAINING_POLL_INTERVAL
         while iteration.status != "Completed":
-            iteration = self.trainer.get_iteration(
-                self.project_id, iteration.id
+            if job is not None:
+                job.update(iteration.id, iteration.status)
+            if iteration.status == "Failed":
+                raise Exception("Training of iteration failed")
+            if self.__wait(interval, job):
+                print()
+                print("Training cancelled")
+                self.__cancel_training(iteration.id)
+                return
+
+            interval = min(2 * interval, setup.TRAINING_POLL_MAX_INTERVAL)
+            iteration = self.limiter.call(
+                RateLimiter.BATCH,
+                self.trainer.get_iteration,
+                self.project_id,
+                iteration.id,
             )
             minutes, seconds = divmod(time.time() - start, 60)
             print(
@@ -335,71 +788,133 @@ class Classifier:
                 f"\t[{minutes:02.0f}m:{seconds:02.0f}s]",
                 end="\r",
             )
-            time.sleep(1)
 
         print()
+        if job is not None:
+            job.update(iteration.id, iteration.status)
 
         # The iteration is now trained. Publish it to the project endpoint
-        iteration_name = uuid.uuid4()
-        self.trainer.publish_iteration(
+        iteration_name = str(uuid.uuid4())
+        self.limiter.call(
+            RateLimiter.ADMIN,
+            self.trainer.publish_iteration,
             self.project_id,
             iteration.id,
             iteration_name,
             self.prediction_resource_id,
         )
+        # Start using the new iteration right away
+        self.swap_iteration(iteration_name)
+
+    def __wait(self, seconds, job) -> bool:
+        """
+        Sleeps for the given number of seconds, or until the job is
+        cancelled. Returns True if the job is cancelled.
+        """
+        if job is None:
+            time.sleep(seconds)
+            return False
+        return job.wait(seconds)
+
+    def __cancel_training(self, iteration_id) -> None:
+        """
+        Stops training of the iteration if Custom Vision supports it, and
+        deletes the iteration, so it is never published.
+        """
+        cancel_iteration = getattr(self.trainer, "cancel_iteration", None)
+        try:
+            if cancel_iteration is not None:
+                self.limiter.call(
+                    RateLimiter.ADMIN,
+                    cancel_iteration,
+                    self.project_id,
+                    iteration_id,
+                )
+            self.limiter.call(
+                RateLimiter.ADMIN,
+                self.trainer.delete_iteration,
+                self.project_id,
+                iteration_id,
+            )
+        except Exception as e:
+            # an iteration can not be deleted while it is training. It is
+            # deleted by delete_iteration() once it is the oldest
+            logging.warning("Could not delete cancelled iteration: " + str(e))
 
     def delete_all_images(self) -> None:
         """
         Function for deleting uploaded images in Customv Vision.
         """
         try:
-            self.trainer.delete_images(
-                self.project_id, all_images=True, all_iterations=True
+            self.limiter.call(
+                RateLimiter.ADMIN,
+                self.trainer.delete_images,
+                self.project_id,
+                all_images=True,
+                all_iterations=True,
             )
         except Exception as e:
             raise Exception("Could not delete all images: " + str(e))
 
+        # no blob is uploaded anymore
+        with self.app_context():
+            models.clear_uploaded_images()
+        remove_manifests(setup.UPLOAD_MANIFEST_DIR)
+
     def delete_all_tags(self) -> None:
         """
         Function for deleting all tags in Custom Vision.
         """
         try:
-            tags = self.trainer.get_tags(self.project_id)
+            tags = self.limiter.call(
+                RateLimiter.ADMIN, self.trainer.get_tags, self.project_id
+            )
             for tag in tags:
-                self.trainer.delete_tag(self.project_id, tag.id)
+                self.limiter.call(
+                    RateLimiter.ADMIN,
+                    self.trainer.delete_tag,
+                    self.project_id,
+                    tag.id,
+                )
         except Exception as e:
             raise Exception("Could not delete all tags" + str(e))
 
-    def retrain(self):
+    def retrain(self, job=None):
         """
-        Train model on all labels and update iteration.
+        Train model on all labels and update iteration. Only images added
+        since the last upload are uploaded.
         """
-        with app.app_context():
+        with self.app_context():
             labels = models.get_all_labels()
 
-        self.upload_images(labels, setup.CONTAINER_NAME_NEW)
+        self.upload_images(labels, setup.CONTAINER_NAME_NEW, incremental=True)
+        if job is not None and job.cancelled:
+            return
         try:
-            self.train(labels)
+            self.train(labels, job)
         except CustomVisionErrorException as e:
             msg = "No changes since last training"
             print(e, "exiting...")
             raise excp.BadRequest(msg)
 
-    def hard_reset_retrain(self):
+    def hard_reset_retrain(self, job=None):
         """
         Train model on all labels and update iteration.
         This method sleeps for 60 seconds to make sure all
         old images are deleted from custom vision before
         uploading original dataset.
         """
-        with app.app_context():
+        with self.app_context():
             labels = models.get_all_labels()
 
         # Wait 60 seconds to make sure all images are deleted in custom vision
-        time.sleep(60)
+        if self.__wait(60, job):
+            return
         self.upload_images(labels, setup.CONTAINER_NAME_ORIGINAL)
+        if job is not None and job.cancelled:
+            return
         try:
-            self.train(labels)
+            self.train(labels, job)
         except CustomVisionErrorException as e:
             msg = "No changes since last training"
             print(e, "exiting...")
@@ -408,6 +923,9 @@ class Classifier:
     def classify_images_by_label(self, label, number_of_examples):
         """
         Classifies images by label and returns a list of correctly classified images.
+        The blobs are predicted in random order by MINING_WORKERS threads,
+        and mining stops as soon as number_of_examples images are predicted
+        as the label with a probability above EXAMPLE_THRESHOLD.
         """
         # Load the blob service client
         container_client = self.blob_service_client.get_container_client(
@@ -416,25 +934,58 @@ class Classifier:
 
         blob_prefix = f"{label}/"
 
-        # List all blobs in the container
+        # List all blobs in the container, in random order so the examples
+        # are a sample of the whole label
         blobs = list(container_client.list_blobs(name_starts_with=blob_prefix))
+        random.shuffle(blobs)
+        # read the iteration name before the workers need it
+        self.iteration_name
 
         # List to store correctly classified images
         images = []
-        for blob in blobs:
-            blob_client = container_client.get_blob_client(blob)
-            image_url = blob_client.url
+        images_lock = Lock()
 
-            pred_kv, best_guess = self.predict_image_url(image_url)
+        def classify(blob):
+            if len(images) >= number_of_examples:
+                # enough examples, skip the remaining blobs
+                return
+            image_url = container_client.get_blob_client(blob).url
+            try:
+                pred_kv, best_guess = self.predict_image_url(
+                    image_url, priority=RateLimiter.BATCH
+                )
+            except Exception as e:
+                logging.warning(f"Could not classify {blob.name}: {e}")
+                return
 
-            if pred_kv[best_guess] > 0.7:
-                images.append(blob["name"])
             # Check if the image is classified correctly
-            if len(images) >= number_of_examples:
-                return images
+            certainty = pred_kv[best_guess]
+            if best_guess == label and certainty > setup.EXAMPLE_THRESHOLD:
+                with images_lock:
+                    if len(images) < number_of_examples:
+                        images.append(blob.name)
+
+        with ThreadPoolExecutor(max_workers=setup.MINING_WORKERS) as pool:
+            list(pool.map(classify, blobs))
         return images
 
 
+_classifier = None
+_classifier_lock = Lock()
+
+
+def get_classifier() -> Classifier:
+    """
+    Returns the Classifier shared by every blueprint in the process. It is
+    created on first use.
+    """
+    global _classifier
+    with _classifier_lock:
+        if _classifier is None:
+            _classifier = Classifier()
+    return _classifier
+
+
 def main():
     """
     Use main if you want to run the complete program with init, train and prediction of and example image.
@@ -0,0 +1,121 @@
+"""
+    Latest-wins coalescing of classify calls. A player only ever has one
+    prediction in flight. Canvases arriving while it runs wait for it to
+    finish, and only the most recent of them is predicted. The requests
+    it superseded are answered with the newer result, and are told so, so
+    that only one of them acts on it.
+"""
+
+from threading import Event
+from threading import Lock
+
+
+class _Frame:
+    """
+    A canvas waiting for its turn, shared by every request it superseded.
+    """
+
+    def __init__(self, image) -> None:
+        self.image = image
+        self.turn = Event()
+        self.done = Event()
+        self.result = None
+        self.error = None
+        # the request whose canvas is predicted
+        self.owner = None
+
+
+class _Slot:
+    """
+    The prediction state of one player.
+    """
+
+    def __init__(self) -> None:
+        self.running = False
+        self.pending = None
+
+
+class InFlightTracker:
+    """
+    Tracks in-flight predictions per player.
+    """
+
+    def __init__(self) -> None:
+        self._slots = {}
+        self._lock = Lock()
+        self.calls = 0
+        self.superseded = 0
+
+    def run(self, player_id, image, predict):
+        """
+        Predicts the image with predict(image), unless a newer canvas from
+        the same player arrives before it is sent. Returns the result of
+        the most recent canvas.
+        """
+        return self.submit(player_id, image, predict)[0]
+
+    def submit(self, player_id, image, predict):
+        """
+        Like run(), but returns a (result, own) tuple, where own is False if
+        the result belongs to a newer canvas that superseded this one.
+        """
+        request = object()
+        with self._lock:
+            slot = self._slots.setdefault(player_id, _Slot())
+            if not slot.running:
+                # nothing in flight, predict right away
+                slot.running = True
+                self.calls += 1
+                frame = _Frame(image)
+                frame.turn.set()
+                leader = True
+            elif slot.pending is None:
+                # wait for the prediction in flight
+                self.calls += 1
+                frame = slot.pending = _Frame(image)
+                leader = True
+            else:
+                # replace the waiting canvas with this newer one
+                frame = slot.pending
+                frame.image = image
+                self.superseded += 1
+                leader = False
+            frame.owner = request
+
+        if leader:
+            frame.turn.wait()
+            try:
+                frame.result = predict(frame.image)
+            except Exception as e:
+                frame.error = e
+            finally:
+                self._next(player_id, slot)
+                frame.done.set()
+        else:
+            frame.done.wait()
+
+        if frame.error is not None:
+            raise frame.error
+        return frame.result, frame.owner is request
+
+    def _next(self, player_id, slot) -> None:
+        """
+        Lets the waiting canvas of the player start, or forgets the player
+        if there is none.
+        """
+        with self._lock:
+            frame = slot.pending
+            slot.pending = None
+            if frame is None:
+                slot.running = False
+                del self._slots[player_id]
+            else:
+                frame.turn.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": len(self._slots),
+                "calls": self.calls,
+                "superseded": self.superseded,
+            }
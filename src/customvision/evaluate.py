@@ -0,0 +1,216 @@
+"""
+    Offline evaluation of a prediction backend. Runs every .png image in a
+    directory with one subdirectory per label, e.g. preprocessing/images/,
+    through the backend and reports accuracy, confusion, latency and
+    throughput.
+
+    Usage: python -m src.customvision.evaluate <directory> [options]
+"""
+
+import argparse
+import json
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from src.utilities import setup
+from src.customvision.canvas import normalize_canvas
+from src.customvision.classifier import Classifier
+from src.customvision.predictors import LocalPredictor
+from src.customvision.predictors import create_predictor
+
+parser = argparse.ArgumentParser(
+    description="evaluate accuracy and speed of a prediction backend"
+)
+parser.add_argument(
+    "directory", type=str, help="directory with one folder of .png per label"
+)
+parser.add_argument(
+    "--backend",
+    type=str,
+    default=setup.PREDICTION_BACKEND,
+    help="prediction backend, customvision or local",
+)
+parser.add_argument(
+    "--model",
+    type=str,
+    default=setup.LOCAL_MODEL_PATH,
+    help="model file of the local backend",
+)
+parser.add_argument(
+    "--iteration",
+    type=str,
+    default=None,
+    help="published iteration, defaults to the one in Custom Vision",
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=setup.EVALUATION_WORKERS,
+    help="number of concurrent predictions",
+)
+parser.add_argument(
+    "-n", type=int, default=None, help="maximum number of images per label"
+)
+parser.add_argument(
+    "--raw",
+    action="store_true",
+    help="predict the images without normalizing them like the endpoints",
+)
+parser.add_argument(
+    "--json", action="store_true", help="print the report as json"
+)
+
+
+def load_dataset(directory, limit=None):
+    """
+    Returns a list of (label, path) for the .png images in every
+    subdirectory of the directory, named by label.
+    """
+    dataset = []
+    for label in sorted(os.listdir(directory)):
+        label_dir = os.path.join(directory, label)
+        if not os.path.isdir(label_dir):
+            continue
+        paths = sorted(
+            os.path.join(label_dir, name)
+            for name in os.listdir(label_dir)
+            if name.endswith(".png")
+        )
+        dataset += [(label, path) for path in paths[:limit]]
+    return dataset
+
+
+def percentile(values, q):
+    """
+    Returns the q percentile (0-100) of the values, by nearest rank.
+    """
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    rank = max(math.ceil(q / 100 * len(values)), 1)
+    return values[rank - 1]
+
+
+def evaluate(predictor, iteration_name, dataset, workers, normalize=True):
+    """
+    Predicts every image of the dataset with the predictor, using the given
+    number of threads.
+
+    Returns:
+    dict with accuracy and confusion per label, latency percentiles in
+    seconds and throughput in images per second
+    """
+
+    def predict(sample):
+        label, path = sample
+        with open(path, "rb") as f:
+            image = f.read()
+        if normalize:
+            image, _ = normalize_canvas(image)
+        start = time.perf_counter()
+        try:
+            pred_kv = predictor.predict(image, iteration_name)
+            best_guess = max(pred_kv, key=pred_kv.get)
+        except Exception as e:
+            print(f"Could not predict {path}: {e}")
+            best_guess = None
+        return label, best_guess, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(predict, dataset))
+    elapsed = time.perf_counter() - start
+
+    labels = {}
+    latencies = []
+    errors = 0
+    for label, best_guess, latency in results:
+        if best_guess is None:
+            errors += 1
+            continue
+        latencies.append(latency)
+        stats = labels.setdefault(label, {"images": 0, "correct": 0})
+        stats["images"] += 1
+        if best_guess == label:
+            stats["correct"] += 1
+        else:
+            # count what the label is confused with
+            confusion = stats.setdefault("confusion", {})
+            confusion[best_guess] = confusion.get(best_guess, 0) + 1
+
+    for stats in labels.values():
+        stats["accuracy"] = stats["correct"] / stats["images"]
+
+    predicted = len(latencies)
+    correct = sum(stats["correct"] for stats in labels.values())
+    return {
+        "backend": predictor.name,
+        "iteration": iteration_name,
+        "images": len(dataset),
+        "errors": errors,
+        "accuracy": correct / predicted if predicted else 0.0,
+        "labels": labels,
+        "latency": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+        },
+        "images_per_second": len(dataset) / elapsed if elapsed else 0.0,
+    }
+
+
+def print_report(report):
+    print(f"Backend: {report['backend']} ({report['iteration']})")
+    print(f"{'label':<24} {'images':>7} {'accuracy':>9}  confused with")
+    for label, stats in sorted(report["labels"].items()):
+        confusion = sorted(
+            stats.get("confusion", {}).items(), key=lambda c: -c[1]
+        )
+        confused = ", ".join(f"{guess} ({n})" for guess, n in confusion[:3])
+        print(
+            f"{label:<24} {stats['images']:>7d} {stats['accuracy']:>9.1%}",
+            f" {confused}",
+        )
+
+    latency = report["latency"]
+    print()
+    print(f"Accuracy: {report['accuracy']:.1%}", end="")
+    print(f" ({report['images']} images, {report['errors']} errors)")
+    print(
+        f"Latency: p50 {latency['p50'] * 1000:.1f} ms,",
+        f"p95 {latency['p95'] * 1000:.1f} ms,",
+        f"p99 {latency['p99'] * 1000:.1f} ms",
+    )
+    print(f"Throughput: {report['images_per_second']:.1f} images/sec")
+
+
+def main():
+    args = parser.parse_args()
+    if args.backend == LocalPredictor.name:
+        predictor = LocalPredictor(args.model)
+        iteration_name = args.iteration or predictor.model_name
+    else:
+        # Custom Vision needs the clients and keys of the Classifier
+        classifier = Classifier()
+        predictor = create_predictor(args.backend, classifier)
+        iteration_name = (
+            args.iteration or classifier.get_published_iteration_name()
+        )
+
+    dataset = load_dataset(args.directory, args.n)
+    report = evaluate(
+        predictor,
+        iteration_name,
+        dataset,
+        args.workers,
+        normalize=not args.raw,
+    )
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
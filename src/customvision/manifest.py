@@ -0,0 +1,98 @@
+"""
+    Checkpoint of an upload from Blob Storage to Custom Vision, so an
+    interrupted upload can resume where it stopped.
+"""
+
+import json
+import os
+from threading import Lock
+
+
+class UploadManifest:
+    """
+    Set of image URLs already submitted to Custom Vision. Every batch is
+    appended to a JSON lines file, so a checkpoint only writes the URLs of
+    that batch. When the upload completes, the file is removed, or keeps
+    only the URLs that failed if some did.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.uploaded = set()
+        self.failed = set()
+        self._lock = Lock()
+        if os.path.isfile(path):
+            self._load()
+
+    def _load(self) -> None:
+        line = ""
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line is cut short if the upload was killed
+                    continue
+                self.uploaded.update(record.get("uploaded", []))
+                self.failed.update(record.get("failed", []))
+        if line != "" and not line.endswith("\n"):
+            # end the cut line, so the next batch gets a line of its own
+            with open(self.path, "a") as f:
+                f.write("\n")
+        # failed URLs are only written before the upload that retries them
+        self.failed.difference_update(self.uploaded)
+
+    def __contains__(self, url) -> bool:
+        return url in self.uploaded
+
+    def add(self, urls) -> None:
+        """
+        Records a batch of uploaded URLs and appends it to the manifest.
+        """
+        urls = list(urls)
+        with self._lock:
+            self.uploaded.update(urls)
+            self.failed.difference_update(urls)
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(json.dumps({"uploaded": urls}) + "\n")
+
+    def finish(self, failed_urls) -> None:
+        """
+        Ends the upload. The manifest is removed, or keeps only the failed
+        URLs, so the next upload sends them again and skips nothing.
+        """
+        if len(failed_urls) == 0:
+            self.remove()
+            return
+        with self._lock:
+            self.uploaded = set()
+            self.failed = set(failed_urls)
+            # write to a temporary file first, so a crash while saving
+            # never leaves a truncated manifest behind
+            temporary_path = self.path + ".tmp"
+            with open(temporary_path, "w") as f:
+                f.write(json.dumps({"failed": sorted(self.failed)}) + "\n")
+            os.replace(temporary_path, self.path)
+
+    def remove(self) -> None:
+        """
+        Deletes the manifest file once the upload is complete.
+        """
+        with self._lock:
+            if os.path.isfile(self.path):
+                os.remove(self.path)
+            self.uploaded = set()
+            self.failed = set()
+
+
+def remove_manifests(directory: str) -> None:
+    """
+    Deletes every manifest in the directory, when the images they list are
+    deleted from Custom Vision.
+    """
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name.endswith(".jsonl") or name.endswith(".jsonl.tmp"):
+            os.remove(os.path.join(directory, name))
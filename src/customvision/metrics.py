@@ -0,0 +1,194 @@
+"""
+    In-process metrics of predictions: latency histograms and outcome
+    counters per endpoint, backend and iteration. They are read as JSON from
+    the admin page and scraped by Prometheus from /metrics.
+"""
+
+import time
+from threading import Lock
+from src.utilities import setup
+
+
+class LatencyHistogram:
+    """
+    HDR-style histogram of latencies in microseconds. Every power of two is
+    split in 2^precision_bits linear buckets, so recorded values keep a
+    relative error below 2^-precision_bits at any magnitude while the
+    histogram stays small. Values below 2^(precision_bits + 1) are exact.
+    """
+
+    def __init__(self, precision_bits=setup.METRICS_PRECISION_BITS) -> None:
+        self.precision_bits = precision_bits
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        micros = max(int(seconds * 1e6), 0)
+        shift = self._shift(micros)
+        # the lowest value of the bucket identifies it
+        bucket = (micros >> shift) << shift
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q: float) -> float:
+        """
+        Returns the upper bound in seconds of the bucket holding the q
+        quantile, or 0 if nothing is recorded.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                break
+        upper = bucket + (1 << self._shift(bucket))
+        return min(upper / 1e6, self.max)
+
+    def _shift(self, micros: int) -> int:
+        """
+        Returns the number of low bits dropped from the value, keeping the
+        leading bit and precision_bits more.
+        """
+        return max(micros.bit_length() - self.precision_bits - 1, 0)
+
+
+class _Measurement:
+    """
+    Times one prediction. The prediction reports the backend that served it
+    and its result through done(). A prediction raising an exception counts
+    as unavailable.
+    """
+
+    def __init__(self, metrics, endpoint, backend, iteration) -> None:
+        self.metrics = metrics
+        self.endpoint = endpoint
+        self.backend = backend
+        self.iteration = iteration
+        self.outcome = "unavailable"
+
+    def done(self, backend, result) -> None:
+        pred_kv, best_guess = result
+        self.backend = backend
+        if pred_kv.get(best_guess, 0.0) >= setup.CERTAINTY_THRESHOLD:
+            self.outcome = "confident"
+        else:
+            self.outcome = "uncertain"
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(
+            self.endpoint,
+            self.backend,
+            self.iteration,
+            time.monotonic() - self.start,
+            self.outcome,
+        )
+        return False
+
+
+class PredictionMetrics:
+    """
+    Latency histograms and outcome counters of predictions. The outcome of
+    a prediction is "confident" if its best guess clears
+    CERTAINTY_THRESHOLD, "uncertain" if not, and "unavailable" if no
+    backend could predict it.
+    """
+
+    def __init__(self) -> None:
+        self._latency = {}
+        self._outcomes = {}
+        self._lock = Lock()
+
+    def measure(self, endpoint, backend, iteration) -> _Measurement:
+        return _Measurement(self, endpoint, backend, iteration)
+
+    def observe(self, endpoint, backend, iteration, seconds, outcome) -> None:
+        labels = (endpoint, backend, iteration)
+        with self._lock:
+            histogram = self._latency.get(labels)
+            if histogram is None:
+                histogram = self._latency[labels] = LatencyHistogram()
+            histogram.record(seconds)
+            key = labels + (outcome,)
+            self._outcomes[key] = self._outcomes.get(key, 0) + 1
+
+    def snapshot(self) -> list:
+        """
+        Returns the latency quantiles and outcome counts of every
+        combination of endpoint, backend and iteration.
+        """
+        with self._lock:
+            data = []
+            for labels, histogram in sorted(self._latency.items()):
+                endpoint, backend, iteration = labels
+                data.append(
+                    {
+                        "endpoint": endpoint,
+                        "backend": backend,
+                        "iteration": iteration,
+                        "count": histogram.count,
+                        "mean": histogram.total / histogram.count,
+                        "max": histogram.max,
+                        "quantiles": dict(
+                            (str(q), histogram.quantile(q))
+                            for q in setup.METRICS_QUANTILES
+                        ),
+                        "outcomes": dict(
+                            (key[3], count)
+                            for key, count in self._outcomes.items()
+                            if key[:3] == labels
+                        ),
+                    }
+                )
+            return data
+
+    def prometheus(self) -> str:
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        lines = [
+            "# HELP prediction_latency_seconds Latency of predictions.",
+            "# TYPE prediction_latency_seconds summary",
+        ]
+        with self._lock:
+            for labels, histogram in sorted(self._latency.items()):
+                for q in setup.METRICS_QUANTILES:
+                    lines.append(
+                        "prediction_latency_seconds"
+                        + _format_labels(labels, quantile=str(q))
+                        + f" {histogram.quantile(q)}"
+                    )
+                name = "prediction_latency_seconds"
+                lines.append(
+                    f"{name}_sum{_format_labels(labels)} {histogram.total}"
+                )
+                lines.append(
+                    f"{name}_count{_format_labels(labels)} {histogram.count}"
+                )
+
+            lines.append("# HELP predictions_total Predictions by outcome.")
+            lines.append("# TYPE predictions_total counter")
+            for key, count in sorted(self._outcomes.items()):
+                labels = _format_labels(key[:3], outcome=key[3])
+                lines.append(f"predictions_total{labels} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels, **extra) -> str:
+    names = ("endpoint", "backend", "iteration")
+    pairs = list(zip(names, labels)) + list(extra.items())
+    formatted = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        value = value.replace("\n", "\\n")
+        formatted.append(f'{name}="{value}"')
+    return "{" + ",".join(formatted) + "}"
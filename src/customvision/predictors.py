@@ -0,0 +1,291 @@
+"""
+    Prediction backends used by the Classifier. A backend receives the raw
+    bytes of a .png image and returns the probability of every label:
+        - CustomVisionPredictor / predicts through Azure Custom Vision
+        - LocalPredictor / runs an exported model on the CPU in-process
+"""
+
+import os
+from functools import partial
+from io import BytesIO
+from typing import Dict
+from typing import List
+import numpy as np
+from PIL import Image
+from src.utilities import setup
+from src.customvision.batching import BatchScheduler
+from src.customvision.ratelimit import RateLimiter
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+class Predictor:
+    """
+    Base class for prediction backends. Subclasses implement predict(), and
+    may override predict_batch() if the model can be evaluated on several
+    images at once.
+    """
+
+    name = None
+
+    def predict(self, image: bytes, iteration_name: str) -> Dict[str, float]:
+        """
+        Returns a dictionary with the probability of every label.
+        """
+        raise NotImplementedError
+
+    def predict_batch(
+        self, images: List[bytes], iteration_name: str
+    ) -> List[Dict[str, float]]:
+        """
+        Predicts a list of images, one at a time unless overridden.
+        """
+        return [self.predict(image, iteration_name) for image in images]
+
+    def acquire(self) -> None:
+        """
+        Waits until the backend may be called, e.g. for a rate limiter
+        token. The Classifier calls it before send(), outside the circuit
+        breaker. Does nothing unless overridden.
+        """
+
+    def send(self, image: bytes, iteration_name: str) -> Dict[str, float]:
+        """
+        Predicts the image after acquire(). The same as predict() unless
+        overridden.
+        """
+        return self.predict(image, iteration_name)
+
+
+class CustomVisionPredictor(Predictor):
+    """
+    Backend sending every image to the published iteration in Azure Custom
+    Vision.
+    """
+
+    name = "customvision"
+
+    def __init__(
+        self,
+        client,
+        project_id,
+        prediction_key,
+        timeout=None,
+        limiter=None,
+        priority=RateLimiter.LIVE,
+    ) -> None:
+        """
+        Parameters:
+        client: CustomVisionPredictionClient
+        timeout: seconds to wait for Custom Vision, None for the default
+        limiter (RateLimiter): grants the requests, None for no limit
+        priority: priority of the requests in the limiter
+        """
+        self.client = client
+        self.project_id = project_id
+        self.prediction_key = prediction_key
+        self.limiter = limiter
+        self.priority = priority
+        self.operation_config = {}
+        if timeout is not None:
+            self.operation_config["timeout"] = timeout
+
+    def predict(self, image: bytes, iteration_name: str) -> Dict[str, float]:
+        self.acquire()
+        return self.send(image, iteration_name)
+
+    def acquire(self) -> None:
+        if self.limiter is not None:
+            self.limiter.wait(self.priority)
+
+    def send(self, image: bytes, iteration_name: str) -> Dict[str, float]:
+        headers = {
+            "content-type": "application/octet-stream",
+            "prediction-key": self.prediction_key,
+        }
+        classify = partial(
+            self.client.classify_image,
+            self.project_id,
+            iteration_name,
+            image,
+            custom_headers=headers,
+            **self.operation_config,
+        )
+        if self.limiter is None:
+            res = classify()
+        else:
+            res = self.limiter.run(classify)
+        return dict([(i.tag_name, i.probability) for i in res.predictions])
+
+
+class LocalPredictor(Predictor):
+    """
+    Backend running an exported model on the CPU in-process. Two formats
+    are supported:
+        - .npz / NumPy weights of a fully connected network. The file holds
+          "labels", "input_size" and the layers as "W0", "b0", "W1", "b1"...
+          Hidden layers use ReLU, the output layer is followed by softmax.
+        - .onnx / any ONNX classifier taking a (batch, 1, side, side) input.
+          Requires onnxruntime, labels are read from "<model>.labels" with
+          one label per line. Outputs that are already probabilities, as
+          after a softmax layer, are used as they are, other outputs are
+          followed by softmax. A dynamic side is set to LOCAL_INPUT_SIZE.
+    Images are converted to grayscale, scaled to the model resolution and
+    inverted, so ink is 1.0 and the background is 0.0. With batch_size
+    larger than 1, concurrent calls to predict() are gathered into batches
+    by a BatchScheduler.
+    """
+
+    name = "local"
+
+    def __init__(
+        self, model_path: str, batch_size: int = 1, batch_wait: float = 0
+    ) -> None:
+        self.model_path = model_path
+        self.model_name = os.path.splitext(os.path.basename(model_path))[0]
+        if model_path.endswith(".onnx"):
+            self._load_onnx(model_path)
+        else:
+            self._load_numpy(model_path)
+        self.scheduler = None
+        if batch_size > 1:
+            self.scheduler = BatchScheduler(
+                self._predict_arrays,
+                batch_size,
+                batch_wait,
+                prepare=self._to_array,
+            )
+
+    def _load_numpy(self, model_path):
+        with np.load(model_path) as model:
+            self.labels = [str(label) for label in model["labels"]]
+            self.input_size = int(model["input_size"])
+            n_layers = len([k for k in model.files if k.startswith("W")])
+            self.layers = [
+                (
+                    model[f"W{i}"].astype(np.float32),
+                    model[f"b{i}"].astype(np.float32),
+                )
+                for i in range(n_layers)
+            ]
+        self.session = None
+        self.logits = True
+
+    def _load_onnx(self, model_path):
+        if onnxruntime is None:
+            raise ImportError("onnxruntime is required to run .onnx models")
+
+        self.session = onnxruntime.InferenceSession(
+            model_path, providers=["CPUExecutionProvider"]
+        )
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        side = model_input.shape[-1]
+        if isinstance(side, int):
+            self.input_size = side
+        else:
+            # symbolic dimension such as "width", or None
+            self.input_size = setup.LOCAL_INPUT_SIZE
+        with open(os.path.splitext(model_path)[0] + ".labels") as f:
+            self.labels = [line.strip() for line in f if line.strip()]
+        self.layers = None
+        self.logits = False
+
+    def _to_array(self, image: bytes) -> np.ndarray:
+        """
+        Decodes a .png image into a flat array of ink intensities.
+        """
+        img = Image.open(BytesIO(image))
+        if img.mode in ("RGBA", "LA", "P"):
+            # transparent pixels are background, not ink
+            img = img.convert("RGBA")
+            background = Image.new("RGBA", img.size, (255, 255, 255, 255))
+            img = Image.alpha_composite(background, img)
+        img = img.convert("L").resize(
+            (self.input_size, self.input_size), Image.BILINEAR
+        )
+        pixels = np.asarray(img, dtype=np.float32).reshape(-1)
+        return 1.0 - pixels / 255.0
+
+    def _forward(self, x: np.ndarray) -> np.ndarray:
+        """
+        Returns the raw model scores for a batch of images.
+        """
+        if self.session is not None:
+            x = x.reshape(-1, 1, self.input_size, self.input_size)
+            return self.session.run(None, {self.input_name: x})[0]
+
+        for i, (weights, bias) in enumerate(self.layers):
+            x = x @ weights + bias
+            if i < len(self.layers) - 1:
+                x = np.maximum(x, 0.0)
+        return x
+
+    def predict(self, image: bytes, iteration_name: str) -> Dict[str, float]:
+        if self.scheduler is not None:
+            return self.scheduler.submit(image, iteration_name)
+        return self.predict_batch([image], iteration_name)[0]
+
+    def predict_batch(
+        self, images: List[bytes], iteration_name: str
+    ) -> List[Dict[str, float]]:
+        return self._predict_arrays(
+            [self._to_array(image) for image in images], iteration_name
+        )
+
+    def _predict_arrays(
+        self, arrays: List[np.ndarray], iteration_name: str
+    ) -> List[Dict[str, float]]:
+        """
+        Predicts images already decoded by _to_array().
+        """
+        x = np.stack(arrays)
+        probabilities = to_probabilities(self._forward(x), self.logits)
+        return [
+            dict(zip(self.labels, [float(p) for p in row]))
+            for row in probabilities
+        ]
+
+
+def to_probabilities(scores: np.ndarray, logits: bool = True) -> np.ndarray:
+    """
+    Returns rows of model scores as probabilities. Logits are followed by
+    softmax. Other scores are kept if every row is non-negative and sums to
+    1, and are followed by softmax otherwise.
+    """
+    if not logits:
+        sums = scores.sum(axis=1)
+        if (scores >= 0).all() and np.allclose(sums, 1.0, atol=1e-3):
+            return scores
+    # numerically stable softmax
+    scores = np.exp(scores - scores.max(axis=1, keepdims=True))
+    return scores / scores.sum(axis=1, keepdims=True)
+
+
+def create_predictor(name, classifier, priority=RateLimiter.LIVE) -> Predictor:
+    """
+    Creates the backend with the given name for the Classifier. Requests to
+    Custom Vision go through the rate limiter of the Classifier with the
+    given priority.
+    """
+    if name == CustomVisionPredictor.name:
+        return CustomVisionPredictor(
+            classifier.predictor,
+            classifier.project_id,
+            classifier.prediction_key,
+            # bound the wait for a prediction by its latency budget
+            timeout=setup.PREDICTION_LATENCY_BUDGET,
+            limiter=classifier.limiter,
+            priority=priority,
+        )
+    elif name == LocalPredictor.name:
+        return LocalPredictor(
+            classifier.local_model_path,
+            batch_size=setup.LOCAL_BATCH_SIZE,
+            batch_wait=setup.LOCAL_BATCH_WAIT,
+        )
+    else:
+        raise ValueError("Unknown prediction backend: " + str(name))
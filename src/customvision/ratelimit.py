@@ -0,0 +1,204 @@
+"""
+    Token bucket in front of every request to Custom Vision. Predictions for
+    players, admin actions and batch jobs (example mining, uploads, training)
+    share the quota of the Custom Vision resource, so requests are granted
+    tokens by priority, and background work backs off while players are
+    drawing.
+"""
+
+import collections
+import time
+from threading import Condition
+from src.utilities import setup
+from src.utilities.exceptions import PredictionUnavailable
+
+
+def retry_after(error):
+    """
+    Returns the seconds Custom Vision asks to wait if the error is a 429
+    Too Many Requests response, or None for any other error.
+    """
+    response = getattr(error, "response", None)
+    if getattr(response, "status_code", None) != 429:
+        return None
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return setup.RATE_LIMIT_RETRY_AFTER
+
+
+class RateLimiter:
+    """
+    Token bucket refilled with rate tokens per second, holding at most
+    burst tokens. A request waits until the bucket has a token for its
+    priority, and waiting requests are granted in priority order:
+        - LIVE / predictions for players, may take any token
+        - ADMIN / actions from the admin page, leave tokens for the live
+          requests expected in the next live_headroom seconds
+        - BATCH / background jobs, additionally leave batch_reserve tokens
+    The live rate is measured over the last window seconds, so batch jobs
+    yield more as live traffic rises. A 429 response from Custom Vision
+    empties the bucket until its Retry-After has passed.
+    """
+
+    LIVE = 0
+    ADMIN = 1
+    BATCH = 2
+    NAMES = ("live", "admin", "batch")
+
+    def __init__(
+        self,
+        rate,
+        burst,
+        live_headroom=setup.RATE_LIMIT_LIVE_HEADROOM,
+        batch_reserve=setup.RATE_LIMIT_BATCH_RESERVE,
+        window=setup.RATE_LIMIT_WINDOW,
+    ) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.live_headroom = live_headroom
+        self.batch_reserve = batch_reserve
+        self.window = window
+        self.tokens = burst
+        self.granted = [0, 0, 0]
+        self.rejected = 0
+        self.throttled = 0
+        self._waiting = [0, 0, 0]
+        self._live = collections.deque()
+        self._updated = time.monotonic()
+        self._blocked_until = 0
+        self._condition = Condition()
+
+    def call(self, priority, function, *args, **kwargs):
+        """
+        Calls function(*args, **kwargs) once a token is granted. Live
+        requests give up after PREDICTION_LATENCY_BUDGET seconds, and
+        raise PredictionUnavailable.
+        """
+        self.wait(priority)
+        return self.run(function, *args, **kwargs)
+
+    def wait(self, priority) -> None:
+        """
+        Waits for a token. Live requests give up after
+        PREDICTION_LATENCY_BUDGET seconds, and raise PredictionUnavailable.
+        """
+        timeout = None
+        if priority == self.LIVE:
+            timeout = setup.PREDICTION_LATENCY_BUDGET
+        self.acquire(priority, timeout)
+
+    def run(self, function, *args, **kwargs):
+        """
+        Calls function(*args, **kwargs) after a token was granted, and stops
+        granting tokens if Custom Vision answers 429.
+        """
+        try:
+            return function(*args, **kwargs)
+        except Exception as e:
+            seconds = retry_after(e)
+            if seconds is not None:
+                self.throttle(seconds)
+            raise
+
+    def acquire(self, priority, timeout=None) -> None:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    wait = self._try_acquire(priority)
+                    if wait == 0:
+                        break
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.rejected += 1
+                            raise PredictionUnavailable(
+                                "Custom Vision rate limit reached"
+                            )
+                        wait = min(wait, remaining)
+                    self._condition.wait(wait)
+            finally:
+                self._waiting[priority] -= 1
+                # lower priorities may go ahead now
+                self._condition.notify_all()
+
+    def _try_acquire(self, priority) -> float:
+        """
+        Takes a token if the priority may have one, and returns 0. Otherwise
+        returns the seconds to wait before trying again.
+        """
+        now = time.monotonic()
+        self._refill(now)
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        if any(self._waiting[:priority]):
+            # woken up when the more important requests are granted
+            return self.window
+
+        needed = 1 + self._reserve(priority, now)
+        if self.tokens < needed:
+            return (needed - self.tokens) / self.rate
+        self.tokens -= 1
+        self.granted[priority] += 1
+        if priority == self.LIVE:
+            self._live.append(now)
+        return 0
+
+    def _refill(self, now) -> None:
+        elapsed = now - self._updated
+        self.tokens = min(self.tokens + elapsed * self.rate, self.burst)
+        self._updated = now
+
+    def _reserve(self, priority, now) -> float:
+        """
+        Returns the tokens a request of the priority must leave in the
+        bucket.
+        """
+        if priority == self.LIVE:
+            return 0
+        reserve = self.live_rate(now) * self.live_headroom
+        if priority == self.BATCH:
+            reserve += self.batch_reserve
+        # a full bucket always serves one request
+        return min(reserve, self.burst - 1)
+
+    def live_rate(self, now=None) -> float:
+        """
+        Returns the live requests per second over the last window seconds.
+        """
+        if now is None:
+            now = time.monotonic()
+        while self._live and self._live[0] < now - self.window:
+            self._live.popleft()
+        return len(self._live) / self.window
+
+    def throttle(self, seconds) -> None:
+        """
+        Stops granting tokens for the given seconds, after Custom Vision
+        answered 429 Too Many Requests.
+        """
+        with self._condition:
+            self.throttled += 1
+            self.tokens = 0
+            self._updated = time.monotonic()
+            self._blocked_until = max(
+                self._blocked_until, self._updated + seconds
+            )
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        with self._condition:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "tokens": self.tokens,
+                "live_rate": self.live_rate(now),
+                "granted": dict(zip(self.NAMES, self.granted)),
+                "waiting": dict(zip(self.NAMES, self._waiting)),
+                "rejected": self.rejected,
+                "throttled": self.throttled,
+            }
@@ -0,0 +1,133 @@
+"""
+    Shadow predictions. A fraction of the live canvases is also predicted by
+    a candidate backend or iteration in the background, and its guess is
+    compared with the guess returned to the player. The player never waits
+    for the candidate.
+"""
+
+import json
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+
+class ShadowPredictor:
+    """
+    Sends a fraction of the images to predictor.predict(image, iteration)
+    on a small pool of threads. Images are dropped rather than queued when
+    max_pending predictions are waiting, so a slow candidate never builds
+    up a backlog. Every comparison is appended to the log as a json line.
+    iteration_name may be a function returning the name, called for every
+    prediction, to follow the live iteration.
+    """
+
+    def __init__(
+        self,
+        predictor,
+        iteration_name,
+        fraction,
+        log_path,
+        workers,
+        max_pending,
+    ) -> None:
+        self.predictor = predictor
+        self.iteration_name = iteration_name
+        # the name used by the latest prediction
+        self.iteration = None if callable(iteration_name) else iteration_name
+        self.fraction = fraction
+        self.log_path = log_path
+        self.max_pending = max_pending
+        self.sent = 0
+        self.dropped = 0
+        self.agreed = 0
+        self.errors = 0
+        self._pending = 0
+        self._lock = Lock()
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="shadow"
+        )
+
+    def submit(self, image, primary, latency) -> bool:
+        """
+        Predicts the image in the background if it is sampled.
+
+        Parameters:
+        image (bytes): the canvas predicted by the primary backend
+        primary (dict): backend, iteration and guess of the primary backend
+        latency (float): seconds used by the primary backend
+
+        Returns True if the image is sent to the candidate.
+        """
+        if random.random() >= self.fraction:
+            return False
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.dropped += 1
+                return False
+            self._pending += 1
+            self.sent += 1
+        self._pool.submit(self._predict, image, primary, latency)
+        return True
+
+    def _predict(self, image, primary, latency) -> None:
+        start = time.monotonic()
+        iteration = self.iteration
+        try:
+            iteration = self.iteration_name
+            if callable(iteration):
+                iteration = iteration()
+            self.iteration = iteration
+            pred_kv = self.predictor.predict(image, iteration)
+            guess = max(pred_kv, key=pred_kv.get)
+        except Exception:
+            guess = None
+        shadow_latency = time.monotonic() - start
+
+        with self._lock:
+            self._pending -= 1
+            if guess is None:
+                self.errors += 1
+            elif guess == primary["guess"]:
+                self.agreed += 1
+            record = {
+                "time": round(time.time(), 3),
+                "primary": primary["backend"],
+                "primary_iteration": primary["iteration"],
+                "shadow": self.predictor.name,
+                "shadow_iteration": iteration,
+                "primary_guess": primary["guess"],
+                "shadow_guess": guess,
+                "agree": guess == primary["guess"],
+                "primary_ms": round(latency * 1000, 1),
+                "shadow_ms": round(shadow_latency * 1000, 1),
+            }
+        # written outside of the lock, live requests never wait for the disk
+        self._append(record)
+
+    def _append(self, record) -> None:
+        try:
+            directory = os.path.dirname(self.log_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        except OSError as e:
+            # the log must never break the game
+            logging.warning("Could not write shadow log: " + str(e))
+
+    def stats(self) -> dict:
+        with self._lock:
+            compared = self.sent - self._pending - self.errors
+            return {
+                "backend": self.predictor.name,
+                "iteration": self.iteration,
+                "fraction": self.fraction,
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "pending": self._pending,
+                "errors": self.errors,
+                "agreement": self.agreed / compared if compared > 0 else None,
+            }
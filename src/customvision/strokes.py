@@ -0,0 +1,159 @@
+"""
+    Rasterization of drawings sent as stroke vectors, in the format of the
+    simplified QuickDraw dataset: a list of strokes [[x0, x1, ...],
+    [y0, y1, ...]]. The strokes are a fraction of the size of a .png of the
+    canvas, and are drawn on the server at model resolution. In
+    multiplayer, clients may send only the strokes added since their last
+    guess, see StrokeCanvases.
+"""
+
+import json
+from io import BytesIO
+from threading import Lock
+from src.utilities import setup
+from src.utilities.exceptions import UserError
+
+try:
+    import cairocffi as cairo
+except (ImportError, OSError):
+    # cairocffi raises OSError if the cairo library is not installed
+    cairo = None
+
+
+def parse_strokes(strokes):
+    """
+    Validates strokes sent by a client, as a list or a json string.
+
+    Returns:
+    list of strokes, each a tuple (x coordinates, y coordinates)
+    """
+    if isinstance(strokes, str):
+        try:
+            strokes = json.loads(strokes)
+        except ValueError:
+            raise UserError("Strokes must be a json array")
+    if not isinstance(strokes, list):
+        raise UserError("Strokes must be a list")
+
+    parsed = []
+    n_points = 0
+    for stroke in strokes:
+        if not isinstance(stroke, list) or len(stroke) < 2:
+            raise UserError("A stroke must be a list [xs, ys]")
+        xs, ys = stroke[0], stroke[1]
+        if not isinstance(xs, list) or not isinstance(ys, list):
+            raise UserError("A stroke must be a list [xs, ys]")
+        if len(xs) != len(ys) or len(xs) == 0:
+            raise UserError("A stroke needs as many x as y coordinates")
+        if not all(
+            isinstance(v, (int, float)) and not isinstance(v, bool)
+            for v in xs + ys
+        ):
+            raise UserError("Stroke coordinates must be numbers")
+        n_points += len(xs)
+        if n_points > setup.MAX_STROKE_POINTS:
+            raise UserError("Too many points in strokes")
+        parsed.append((xs, ys))
+    return parsed
+
+
+class StrokeRasterizer:
+    """
+    Draws strokes on one cairo surface that is reused for every drawing.
+    The drawing is centered and scaled to fill MODEL_RESOLUTION pixels
+    with a CANVAS_MARGIN around the ink, like normalize_canvas() does for
+    uploaded canvases.
+    """
+
+    def __init__(self) -> None:
+        self.surface = None
+        self.context = None
+        self._lock = Lock()
+
+    def _create_surface(self) -> None:
+        if cairo is None:
+            raise ImportError("cairocffi is required to rasterize strokes")
+
+        resolution = setup.MODEL_RESOLUTION
+        self.surface = cairo.ImageSurface(
+            cairo.FORMAT_RGB24, resolution, resolution
+        )
+        self.context = cairo.Context(self.surface)
+        self.context.set_antialias(cairo.ANTIALIAS_BEST)
+        self.context.set_line_cap(cairo.LINE_CAP_ROUND)
+        self.context.set_line_join(cairo.LINE_JOIN_ROUND)
+
+    def rasterize(self, strokes) -> bytes:
+        """
+        Draws the strokes black on white and returns them as a .png.
+        """
+        resolution = setup.MODEL_RESOLUTION
+        output = BytesIO()
+        with self._lock:
+            if self.surface is None:
+                self._create_surface()
+            ctx = self.context
+            ctx.identity_matrix()
+            ctx.set_source_rgb(1, 1, 1)
+            ctx.paint()
+
+            if len(strokes) > 0:
+                xs = [x for stroke in strokes for x in stroke[0]]
+                ys = [y for stroke in strokes for y in stroke[1]]
+                side = max(max(xs) - min(xs), max(ys) - min(ys), 1)
+                scale = resolution / (side * (1 + 2 * setup.CANVAS_MARGIN))
+                # center the bounding box of the ink on the surface
+                ctx.translate(resolution / 2, resolution / 2)
+                ctx.scale(scale, scale)
+                ctx.translate(
+                    -(max(xs) + min(xs)) / 2, -(max(ys) + min(ys)) / 2
+                )
+                # the line width is given in pixels of the output
+                ctx.set_line_width(setup.STROKE_WIDTH / scale)
+                ctx.set_source_rgb(0, 0, 0)
+                for stroke_xs, stroke_ys in strokes:
+                    ctx.move_to(stroke_xs[0], stroke_ys[0])
+                    for x, y in zip(stroke_xs, stroke_ys):
+                        ctx.line_to(x, y)
+                ctx.stroke()
+
+            self.surface.flush()
+            self.surface.write_to_png(output)
+        return output.getvalue()
+
+
+class StrokeCanvases:
+    """
+    The strokes drawn so far by every player in the current round, so
+    clients only send the strokes added since their last guess. The
+    strokes, not pixels, are kept, as the drawing is centered again when
+    its bounding box grows, and redrawing a few hundred points is cheap.
+    """
+
+    def __init__(self) -> None:
+        self._strokes = {}
+        self._lock = Lock()
+
+    def add(self, player_id, strokes, reset=False):
+        """
+        Adds new strokes to the drawing of the player, after clearing it if
+        reset is True. Returns all strokes of the drawing.
+        """
+        with self._lock:
+            drawing = [] if reset else self._strokes.get(player_id, [])
+            n_points = sum(len(xs) for xs, _ in drawing + strokes)
+            if n_points > setup.MAX_STROKE_POINTS:
+                raise UserError("Too many points in strokes")
+            drawing = drawing + strokes
+            self._strokes[player_id] = drawing
+            return drawing
+
+    def clear(self, player_id) -> None:
+        """
+        Frees the drawing of the player, at the end of a round.
+        """
+        with self._lock:
+            self._strokes.pop(player_id, None)
+
+    def __len__(self) -> int:
+        return len(self._strokes)
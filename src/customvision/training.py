@@ -0,0 +1,194 @@
+"""
+    Training jobs started from the admin page. Only one job runs at a time,
+    its progress is stored in the TrainingJob table and it can be cancelled.
+"""
+
+import datetime
+import logging
+import uuid
+from threading import Event
+from threading import Lock
+from threading import Thread
+from werkzeug import exceptions as excp
+from src import models
+from src import storage
+from src.utilities import setup
+
+
+class TrainingJob:
+    """
+    State of one training job. The Classifier reports the progress of
+    training through update(), and checks for cancellation while it waits.
+    """
+
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    FIELDS = (
+        "job_id",
+        "kind",
+        "state",
+        "iteration_id",
+        "iteration_status",
+        "started",
+        "finished",
+        "error",
+    )
+
+    def __init__(self, kind, on_change=None) -> None:
+        self.job_id = uuid.uuid4().hex
+        self.kind = kind
+        self.state = self.RUNNING
+        self.iteration_id = None
+        self.iteration_status = None
+        self.started = datetime.datetime.now()
+        self.finished = None
+        self.error = None
+        self.on_change = on_change
+        self._cancel = Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    def wait(self, seconds) -> bool:
+        """
+        Sleeps for the given number of seconds, or until the job is
+        cancelled. Returns True if the job is cancelled.
+        """
+        return self._cancel.wait(seconds)
+
+    def update(self, iteration_id=None, iteration_status=None) -> None:
+        """
+        Records the iteration being trained and its status in Custom Vision.
+        """
+        changed = False
+        if iteration_id is not None and iteration_id != self.iteration_id:
+            self.iteration_id = iteration_id
+            changed = True
+        if iteration_status != self.iteration_status:
+            self.iteration_status = iteration_status
+            changed = True
+        if changed and self.on_change is not None:
+            self.on_change(self)
+
+    def finish(self, state, error=None) -> None:
+        self.state = state
+        self.error = error
+        self.finished = datetime.datetime.now()
+        if self.on_change is not None:
+            self.on_change(self)
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+class TrainingManager:
+    """
+    Runs the training jobs of the Classifier in a background thread:
+        - retrain / uploads new images and trains a new iteration
+        - hardReset / deletes every image, uploads the original dataset
+          and trains a new iteration
+    The images are deleted by the job, after it has been started, so they
+    are never deleted when another job is running.
+    """
+
+    def __init__(self, classifier) -> None:
+        self.classifier = classifier
+        self.targets = {
+            "retrain": classifier.retrain,
+            "hardReset": self._hard_reset,
+        }
+        self.job = None
+        self._lock = Lock()
+
+    def is_running(self) -> bool:
+        """
+        Checks if a job is running in this or any other process. A job
+        stored as running for longer than TRAINING_TIMEOUT seconds was left
+        behind by a process that stopped, and is ignored.
+        """
+        if self.job is not None and self.job.state == TrainingJob.RUNNING:
+            return True
+
+        stored = models.get_latest_training_job()
+        if stored is None or stored.state != TrainingJob.RUNNING:
+            return False
+        age = datetime.datetime.now() - stored.started
+        return age.total_seconds() < setup.TRAINING_TIMEOUT
+
+    def start(self, kind) -> TrainingJob:
+        """
+        Starts a job of the given kind. Raises Conflict if a job is
+        already running.
+        """
+        with self._lock:
+            if self.is_running():
+                raise excp.Conflict("A training job is already running")
+
+            job = TrainingJob(kind, on_change=self._save)
+            self._save(job)
+            self.job = job
+
+        Thread(target=self._run, args=(job,), daemon=True).start()
+        return job
+
+    def _run(self, job) -> None:
+        try:
+            self.targets[job.kind](job=job)
+        except Exception as e:
+            job.finish(TrainingJob.FAILED, str(e))
+            return
+
+        if job.cancelled:
+            job.finish(TrainingJob.CANCELLED)
+        else:
+            job.finish(TrainingJob.COMPLETED)
+
+    def _hard_reset(self, job) -> None:
+        self.classifier.delete_all_images()
+        try:
+            storage.clear_dataset()
+        except Exception as e:
+            logging.error(e)
+        self.classifier.hard_reset_retrain(job=job)
+
+    def cancel(self) -> bool:
+        """
+        Cancels the running job. Returns False if no job is running.
+        """
+        job = self.job
+        if job is None or job.state != TrainingJob.RUNNING:
+            return False
+        job.cancel()
+        return True
+
+    def status(self) -> dict:
+        """
+        Returns the state and elapsed time of the current or latest job.
+        """
+        job = self.job
+        if job is not None:
+            data = job.to_dict()
+        else:
+            stored = models.get_latest_training_job()
+            if stored is None:
+                return {"state": "idle"}
+            data = {
+                field: getattr(stored, field) for field in TrainingJob.FIELDS
+            }
+
+        end = data["finished"] or datetime.datetime.now()
+        data["elapsed"] = round((end - data["started"]).total_seconds())
+        data["started"] = str(data["started"])
+        data["finished"] = data["finished"] and str(data["finished"])
+        return data
+
+    def _save(self, job) -> None:
+        with self.classifier.app_context():
+            models.save_training_job(**job.to_dict())
@@ -16,6 +16,47 @@ class Iteration(db.Model):
     iteration_name = db.Column(db.String(64), primary_key=True)
 
 
+class UploadedImage(db.Model):
+    """
+    Ledger of the blobs uploaded to Custom Vision, so retraining only
+    uploads images added since the last training.
+    """
+
+    container_name = db.Column(db.String(64), primary_key=True)
+    blob_name = db.Column(db.String(256), primary_key=True)
+    date = db.Column(db.DateTime)
+
+
+class ImageCount(db.Model):
+    """
+    Number of images saved per label in each blob container, kept instead
+    of counting the blobs. A row with the label COUNTED marks a container
+    as counted, even if it holds no images.
+    """
+
+    COUNTED = ""
+
+    container_name = db.Column(db.String(64), primary_key=True)
+    label = db.Column(db.String(64), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class TrainingJob(db.Model):
+    """
+    Model for storing the state of training jobs started from the admin
+    page.
+    """
+
+    job_id = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(32))
+    state = db.Column(db.String(16))
+    iteration_id = db.Column(db.String(64))
+    iteration_status = db.Column(db.String(32))
+    started = db.Column(db.DateTime)
+    finished = db.Column(db.DateTime)
+    error = db.Column(db.String(256))
+
+
 class Games(db.Model):
     """
     This is the Games model in the database. It is important that the
@@ -261,10 +302,12 @@ def insert_into_games(game_id, labels, date, difficulty_id):
 
 def get_iteration_name():
     """
-    Returns the first and only iteration name that should be in the model.
+    Returns the first and only iteration name that should be in the model,
+    or None if no iteration name has been stored yet.
     """
     iteration = Iteration.query.filter_by().first()
-    assert iteration.iteration_name is not None
+    if iteration is None:
+        return None
     return iteration.iteration_name
 
 
@@ -283,6 +326,142 @@ def update_iteration_name(new_name):
     return new_name
 
 
+def get_uploaded_images(container_name):
+    """
+    Returns the set of blob names in the container that are already
+    uploaded to Custom Vision.
+    """
+    try:
+        rows = (
+            db.session.query(UploadedImage.blob_name)
+            .filter_by(container_name=container_name)
+            .all()
+        )
+        return set(row.blob_name for row in rows)
+    except Exception as e:
+        raise Exception("Could not read UploadedImage table: " + str(e))
+
+
+def insert_into_uploaded_images(container_name, blob_names):
+    """
+    Records blobs in the container as uploaded to Custom Vision.
+    """
+    if isinstance(container_name, str) and isinstance(blob_names, list):
+        try:
+            now = datetime.datetime.now()
+            for blob_name in blob_names:
+                db.session.merge(
+                    UploadedImage(
+                        container_name=container_name,
+                        blob_name=blob_name,
+                        date=now,
+                    )
+                )
+            db.session.commit()
+            return True
+        except Exception as e:
+            db.session.rollback()
+            raise Exception(
+                "Could not insert into UploadedImage table: " + str(e)
+            )
+    else:
+        raise excp.BadRequest("Invalid type of parameters.")
+
+
+def clear_uploaded_images():
+    """
+    Empties the ledger of uploaded images, used when all images are
+    deleted from Custom Vision.
+    """
+    UploadedImage.query.delete()
+    db.session.commit()
+
+
+def increment_image_counts(container_name, counts):
+    """
+    Adds counts, a dictionary from label to number of new images, to the
+    image counts of the container in one transaction. The counts are added
+    by the database, so increments from several workers are not lost.
+    """
+    try:
+        for label, count in counts.items():
+            updated = ImageCount.query.filter_by(
+                container_name=container_name, label=label
+            ).update({ImageCount.count: ImageCount.count + count})
+            if updated == 0:
+                db.session.add(
+                    ImageCount(
+                        container_name=container_name,
+                        label=label,
+                        count=count,
+                    )
+                )
+        db.session.commit()
+        return True
+    except Exception as e:
+        db.session.rollback()
+        raise Exception("Could not update ImageCount table: " + str(e))
+
+
+def set_image_counts(container_name, counts):
+    """
+    Replaces the image counts of the container with counts, a dictionary
+    from label to number of images.
+    """
+    try:
+        ImageCount.query.filter_by(container_name=container_name).delete()
+        counts = dict(counts)
+        counts[ImageCount.COUNTED] = 0
+        for label, count in counts.items():
+            db.session.add(
+                ImageCount(
+                    container_name=container_name, label=label, count=count
+                )
+            )
+        db.session.commit()
+        return True
+    except Exception as e:
+        db.session.rollback()
+        raise Exception("Could not set ImageCount table: " + str(e))
+
+
+def get_image_counts(container_name):
+    """
+    Returns a dictionary with the number of images per label in the
+    container, or None if the container has never been counted.
+    """
+    rows = ImageCount.query.filter_by(container_name=container_name).all()
+    if len(rows) == 0:
+        return None
+    return dict(
+        (row.label, row.count)
+        for row in rows
+        if row.label != ImageCount.COUNTED
+    )
+
+
+def save_training_job(job_id, **fields):
+    """
+    Inserts or updates the training job with the given job_id.
+    """
+    try:
+        if fields.get("error") is not None:
+            fields["error"] = fields["error"][:256]
+        db.session.merge(TrainingJob(job_id=job_id, **fields))
+        db.session.commit()
+        return True
+    except Exception as e:
+        db.session.rollback()
+        raise Exception("Could not save training job: " + str(e))
+
+
+def get_latest_training_job():
+    """
+    Returns the most recently started training job, or None.
+    """
+    return TrainingJob.query.order_by(TrainingJob.started.desc()).first()
+
+
 def insert_into_players(player_id, game_id, state):
     """
     Insert values into Players table.
@@ -337,13 +516,17 @@ def get_game(game_id):
     return game
 
 
-def get_player(player_id):
+def get_player(player_id, refresh=False):
     """
     Return the player in players record with the corresponding player_id.
+    With refresh, the record is read again from the database, in case
+    another request changed it.
     """
     player_in_game = Players.query.get(player_id)
     if player_in_game is None:
         raise excp.BadRequest("player_id invalid or expired")
+    if refresh:
+        db.session.refresh(player_in_game)
 
     return player_in_game
 
@@ -364,6 +547,29 @@ def update_game_for_player(game_id, player_id, session_num, state):
         raise Exception("Could not update game for player: " + str(e))
 
 
+def end_round_for_player(game_id, player_id, session_num):
+    """
+    Increases session_num of the game and sets the state of the player to
+    "Done", if the game is still in the given session. Returns False if
+    another request ended the round first.
+    """
+    try:
+        updated = Games.query.filter_by(
+            game_id=game_id, session_num=session_num
+        ).update({Games.session_num: Games.session_num + 1})
+        if updated == 0:
+            db.session.rollback()
+            return False
+        Players.query.filter_by(player_id=player_id).update(
+            {Players.state: "Done"}
+        )
+        db.session.commit()
+        return True
+    except Exception as e:
+        db.session.rollback()
+        raise Exception("Could not end round for player: " + str(e))
+
+
 def delete_session_from_game(game_id):
     """
     To avoid unecessary data in the database this function is called by
@@ -709,6 +915,21 @@ def get_translation_dict():
         raise Exception("Could not read Labels table: " + str(e))
 
 
+def get_translations(english_labels):
+    """
+    Reads the norwegian translation of the given labels only.
+    """
+    try:
+        labels = Labels.query.filter(
+            Labels.english.in_(list(english_labels))
+        ).all()
+        return dict(
+            [(str(label.english), str(label.norwegian)) for label in labels]
+        )
+    except Exception as e:
+        raise Exception("Could not read Labels table: " + str(e))
+
+
 def delete_all_tables(app):
     """
     Function for deleting all tables in the database.
@@ -725,9 +946,9 @@ def insert_into_example_images(images, label):
     """
     if isinstance(images, list) and isinstance(label, str):
         try:
-            for image in images:
-                example_image = ExampleImages(image=image, label=label)
-                db.session.add(example_image)
+            db.session.add_all(
+                [ExampleImages(image=image, label=label) for image in images]
+            )
             db.session.commit()
         except Exception as e:
             raise Exception(
@@ -752,6 +973,16 @@ def get_n_random_example_images(label, number_of_images):
         raise Exception("Could not read ExampleImages table: " + str(e))
 
 
+def get_example_image_names():
+    """
+    Returns the blob names of every example image.
+    """
+    try:
+        return [row.image for row in ExampleImages.query.all()]
+    except Exception as e:
+        raise Exception("Could not read ExampleImages table: " + str(e))
+
+
 def populate_example_images(app):
     """
     Function for populating example images table with exported csv data. Used so you dont need to
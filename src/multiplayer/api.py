@@ -11,6 +11,7 @@ from flask import Blueprint, request
 from flask import current_app
 from PIL import Image, ImageChops
 from io import BytesIO
+from functools import partial
 from datetime import datetime
 import json
 import uuid
@@ -22,13 +23,27 @@ from . import models
 import src.models as shared_models
 from src import storage
 from src.utilities.exceptions import UserError
+from src.utilities.exceptions import PredictionUnavailable
+from src.utilities.certainty import parse_top_k
+from src.utilities.certainty import truncate_certainty
 from src.utilities import setup
-from src.customvision.classifier import Classifier
+from src.customvision.classifier import get_classifier
+from src.customvision.coalesce import InFlightTracker
+from src.customvision.canvas import normalize_canvas
+from src.customvision.strokes import StrokeCanvases
+from src.customvision.strokes import StrokeRasterizer
+from src.customvision.strokes import parse_strokes
 from src.extensions import socketio
 
 
 multiplayer = Blueprint("multiplayer", __name__)
-classifier = Classifier()
+classifier = get_classifier()
+# Only the newest canvas of each player is sent to the classifier
+in_flight = InFlightTracker()
+# Draws guesses sent as stroke vectors
+rasterizer = StrokeRasterizer()
+# Strokes drawn by each player in the current round
+canvases = StrokeCanvases()
 
 
 @socketio.on("connect")
@@ -44,6 +59,7 @@ def disconnect():
     database connected to the session.
     """
     player_id = request.sid
+    canvases.clear(player_id)
     player = shared_models.get_player(player_id)
     game = shared_models.get_game(player.game_id)
     data = {"player_disconnected": True}
@@ -224,13 +240,81 @@ def handle_classify(data, image, correct_label=None):
     """
     WS event for accepting images for classification
     params: data: {"game_id": str: the game_id you get from joinGame,
-                   "time_left": float: the time left until the game is over}
+                   "time_left": float: the time left until the game is over,
+                   "top_k": int (optional): number of labels in certainty}
            image: binary string with the image data
     """
+    top_k = read_top_k(data)
     image_stream = BytesIO(image)
 
     allowed_file(image_stream)
 
+    # Check if the image hasn't been drawn on
+    bytes_img = Image.open(image_stream).convert("RGB")
+    is_white = white_image(bytes_img)
+    classify_canvas(data, image, is_white, correct_label, top_k)
+
+
+@socketio.on("classifyStrokes")
+def handle_classify_strokes(data, strokes, correct_label=None):
+    """
+    WS event for accepting drawings as stroke vectors for classification.
+    The strokes are rasterized on the server instead of uploading a .png.
+    params: data: same as for the classify event
+           strokes: [[[x0, x1, ...], [y0, y1, ...]], ...], a list or json
+    """
+    top_k = read_top_k(data)
+    strokes = parse_strokes(strokes)
+    canvas = rasterizer.rasterize(strokes)
+    is_white = len(strokes) == 0
+    classify_canvas(
+        data, canvas, is_white, correct_label, top_k, rasterized=True
+    )
+
+
+@socketio.on("classifyStrokeDelta")
+def handle_classify_stroke_delta(data, strokes, correct_label=None):
+    """
+    WS event for accepting the strokes added since the previous guess of
+    the round. The server keeps the drawing until the round is over.
+    params: data: same as for the classify event, plus
+                  "reset": bool (optional): the player cleared the canvas
+           strokes: the new strokes, in the format of classifyStrokes
+    """
+    top_k = read_top_k(data)
+    strokes = parse_strokes(strokes)
+    drawing = canvases.add(request.sid, strokes, data.get("reset", False))
+    canvas = rasterizer.rasterize(drawing)
+    is_white = len(drawing) == 0
+    classify_canvas(
+        data, canvas, is_white, correct_label, top_k, rasterized=True
+    )
+
+
+def read_top_k(data):
+    """
+    Reads the top_k of a classify event before the drawing is processed.
+    Raises UserError, which is emitted to the player as an error event.
+    """
+    return parse_top_k(
+        data.get("top_k", setup.DEFAULT_TOP_K), exc_type=UserError
+    )
+
+
+def classify_canvas(
+    data, image, is_white, correct_label, top_k, rasterized=False
+):
+    """
+    Classifies a guess and emits the prediction to the player.
+
+    Parameters:
+    data (dict): the data of the classify event
+    image (bytes): the drawing as a .png
+    is_white (bool): the drawing is empty
+    top_k (int): number of labels in the certainty, None for all
+    rasterized (bool): the drawing is rasterized from strokes, and is
+        already at model resolution
+    """
     player_id = request.sid
     game_id = data["game_id"]
     time_left = data["time_left"]
@@ -241,9 +325,7 @@ def handle_classify(data, image, correct_label=None):
         labels = json.loads(game.labels)
         correct_label = labels[game.session_num - 1]
 
-    # Check if the image hasn't been drawn on
-    bytes_img = Image.open(image_stream).convert("RGB")
-    if white_image(bytes_img):
+    if is_white:
         response = white_image_data(
             correct_label, time_left, game_id, player_id
         )
@@ -251,32 +333,43 @@ def handle_classify(data, image, correct_label=None):
             emit("prediction", response)
             return
 
-    image_stream.seek(0)
-    certainty, best_guess = classifier.predict_image_by_post(image_stream)
-    best_certainty = certainty[best_guess]
+    if rasterized:
+        canvas = image
+    else:
+        canvas, bytes_saved = normalize_canvas(image)
+        current_app.logger.info(
+            "multiplayer classify canvas bytes saved: " + str(bytes_saved)
+        )
+    try:
+        (certainty, best_guess), own = in_flight.submit(
+            player_id,
+            BytesIO(canvas),
+            partial(classifier.predict_image_by_post, endpoint="multiplayer"),
+        )
+    except PredictionUnavailable as e:
+        # keep the game going while the classifier is unavailable
+        current_app.logger.warning(e)
+        (certainty, best_guess), own = ({}, setup.DEGRADED_GUESS), True
+    best_certainty = certainty.get(best_guess, 0.0)
 
     time_out = time_left <= 0
 
     if time_out:
-        # to break race condition if both players timeout
-        time.sleep(0.5 * random.random())
-        try:
-            storage.save_image(image, correct_label, best_certainty)
-        except Exception as e:
-            current_app.logger.error(e)
-        player = shared_models.get_player(player_id)
-        opponent = models.get_opponent(game_id, player_id)
-        if opponent.state == "Done":
-            if player.state != "Done":
-                # update state for player and increase session_id
-                models.update_game_for_player(game_id, player_id, 1, "Done")
-            emit("roundOver", {"round_over": True}, room=game_id)
-        else:
-            # update state for player
-            models.update_game_for_player(game_id, player_id, 0, "Done")
+        # a superseded request leaves the round to the newer one
+        if own:
+            # to break race condition if both players timeout
+            time.sleep(0.5 * random.random())
+            finish_round(
+                image, correct_label, best_certainty, game_id, player_id
+            )
+        return
+
+    if best_guess == setup.DEGRADED_GUESS:
+        emit("prediction", degraded_data(correct_label, lang))
         return
 
     has_won = (correct_label == best_guess) and (time_left > 0)
+    certainty = truncate_certainty(certainty, top_k, correct_label)
 
     if lang == Language.Norwegian:
 
@@ -297,21 +390,34 @@ def handle_classify(data, image, correct_label=None):
 
     emit("prediction", response)
 
-    if has_won:
-        try:
-            storage.save_image(image, correct_label, best_certainty)
-        except Exception as e:
-            current_app.logger.error(e)
-        player = shared_models.get_player(player_id)
-        opponent = models.get_opponent(game_id, player_id)
-        if opponent.state == "Done":
-            if player.state != "Done":
-                # update state for player and increase session_id
-                models.update_game_for_player(game_id, player_id, 1, "Done")
-            emit("roundOver", {"round_over": True}, room=game_id)
-        else:
-            # update state for player
-            models.update_game_for_player(game_id, player_id, 0, "Done")
+    if has_won and own:
+        finish_round(image, correct_label, best_certainty, game_id, player_id)
+
+
+def finish_round(image, correct_label, best_certainty, game_id, player_id):
+    """
+    Saves the drawing of a player who won or ran out of time, and ends the
+    round when both players are done. Does nothing if the round is already
+    over for the player.
+    """
+    player = shared_models.get_player(player_id, refresh=True)
+    if player.state == "Done":
+        return
+    try:
+        storage.save_image(image, correct_label, best_certainty)
+    except Exception as e:
+        current_app.logger.error(e)
+    # the round is over for the player, free the drawing
+    canvases.clear(player_id)
+    opponent = models.get_opponent(game_id, player_id)
+    if opponent.state == "Done":
+        # update state for player and increase session_id
+        models.update_game_for_player(game_id, player_id, 1, "Done")
+        canvases.clear(opponent.player_id)
+        emit("roundOver", {"round_over": True}, room=game_id)
+    else:
+        # update state for player
+        models.update_game_for_player(game_id, player_id, 0, "Done")
 
 
 @socketio.on("endGame")
@@ -372,7 +478,7 @@ def translate_probabilities(labels):
     """
     translate the labels in a probability dictionary to norwegian
     """
-    translation_dict = shared_models.get_translation_dict()
+    translation_dict = shared_models.get_translations(labels.keys())
     return dict(
         [(translation_dict[label], prob) for label, prob in labels.items()]
     )
@@ -431,3 +537,20 @@ def white_image_data(label, time_left, game_id, player_id):
         "gameState": game_state,
     }
     return data
+
+
+def degraded_data(label, lang):
+    """
+    Generate the data returned to the client when no prediction could be
+    made, telling the player to keep drawing.
+    """
+    if lang == Language.Norwegian:
+        label = shared_models.to_norwegian(label)
+
+    data = {
+        "certainty": {},
+        "guess": setup.DEGRADED_GUESS,
+        "correctLabel": label,
+        "hasWon": False,
+    }
+    return data
@@ -15,7 +15,7 @@ inappropriate content could appear in the dataset. As those drawings in general
 drawings in the dataset, they could be filtered out by prediction
 
 
-WARNING: This script is very slow and isn't cheap, so it should be used thoughtfully. Also remember to point to the
+WARNING: This script isn't cheap, so it should be used thoughtfully. Also remember to point to the
 correct csv file with updated words.
 """
 
@@ -28,6 +28,7 @@ def main():
     models.db.init_app(app)
 
     classifier = Classifier()
+    classifier.init_app(app)
 
     # Take all words from first column of csv and print them as a list with " " around each word.
     # Open the CSV file
@@ -15,12 +15,21 @@ from datetime import datetime
 import pytz
 from PIL import Image, ImageChops
 from io import BytesIO
+from functools import partial
 from src import storage
 from . import models
 import src.models as shared_models
 from src.utilities import setup
 from src.utilities.keys import Keys
-from src.customvision.classifier import Classifier
+from src.utilities.exceptions import PredictionUnavailable
+from src.utilities.exceptions import UserError
+from src.utilities.certainty import parse_top_k
+from src.utilities.certainty import truncate_certainty
+from src.customvision.classifier import get_classifier
+from src.customvision.coalesce import InFlightTracker
+from src.customvision.canvas import normalize_canvas
+from src.customvision.strokes import StrokeRasterizer
+from src.customvision.strokes import parse_strokes
 from flask import Blueprint, current_app, request, session
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug import exceptions as excp
@@ -28,8 +37,12 @@ from werkzeug import exceptions as excp
 
 singleplayer = Blueprint("singleplayer", __name__)
 
-# Initialize CV classifier
-classifier = Classifier()
+# CV classifier shared with the other blueprints
+classifier = get_classifier()
+# Only the newest canvas of each player is sent to the classifier
+in_flight = InFlightTracker()
+# Draws guesses sent as stroke vectors
+rasterizer = StrokeRasterizer()
 
 
 @singleplayer.route("/")
@@ -111,19 +124,53 @@ def classify():
     """
     Classify endpoint for continuous guesses.
     """
-    game_state = "Playing"
     # Check if image submitted correctly
     if "image" not in request.files:
         raise excp.BadRequest("No image submitted")
 
     # Retrieve the image and check if it satisfies constraints
-    lang = request.values["lang"]
     image = request.files["image"]
     allowed_file(image)
+    canvas, bytes_saved = normalize_canvas(image.read())
+    image.seek(0)
+    current_app.logger.info(
+        "singleplayer /classify canvas bytes saved: " + str(bytes_saved)
+    )
+    return classify_canvas(image, canvas)
+
+
+@singleplayer.route("/classifyStrokes", methods=["POST"])
+def classify_strokes():
+    """
+    Classify endpoint for continuous guesses drawn as stroke vectors. The
+    strokes are rasterized on the server instead of uploading a .png.
+    """
+    if "strokes" not in request.values:
+        raise excp.BadRequest("No strokes submitted")
+    try:
+        strokes = parse_strokes(request.values["strokes"])
+    except UserError as e:
+        raise excp.BadRequest(str(e))
+    canvas = rasterizer.rasterize(strokes)
+    return classify_canvas(BytesIO(canvas), canvas)
+
+
+def classify_canvas(image, canvas):
+    """
+    Classifies a guess and updates the game of the player.
+
+    Parameters:
+    image: the drawing as uploaded, saved for training
+    canvas (bytes): the normalized drawing sent to the classifier
+    """
+    game_state = "Playing"
+    lang = request.values["lang"]
     # use player_id submitted by player to find game
     player_id = request.values["player_id"]
     # Get time from POST request
     time_left = float(request.values["time"])
+    # Number of labels in the certainty, all labels if not given
+    top_k = parse_top_k(request.values.get("top_k", setup.DEFAULT_TOP_K))
     # Get label for game session
     player = shared_models.get_player(player_id)
     clientRound = request.values.get("client_round_num", None)
@@ -135,8 +182,17 @@ def classify():
         )
     labels = json.loads(game.labels)
     label = labels[game.session_num - 1]
-    certainty, best_guess = classifier.predict_image_by_post(image)
-    best_certainty = certainty[best_guess]
+    try:
+        (certainty, best_guess), own = in_flight.submit(
+            player_id,
+            BytesIO(canvas),
+            partial(classifier.predict_image_by_post, endpoint="singleplayer"),
+        )
+    except PredictionUnavailable as e:
+        # keep the game going while the classifier is unavailable
+        current_app.logger.warning(e)
+        (certainty, best_guess), own = ({}, setup.DEGRADED_GUESS), True
+    best_certainty = certainty.get(best_guess, 0.0)
     # The player has won if the game is completed within the time limit
     has_won = (
         time_left > 0
@@ -145,24 +201,20 @@ def classify():
     )
     # End game if player win or loose
     if has_won or time_left <= 0:
-        # Update session_num in game and state for player
-        shared_models.update_game_for_player(
-            player.game_id, player_id, 1, "Done"
-        )
-        # save image
-        try:
-            storage.save_image(image, label, best_certainty)
-        except Exception as e:
-            current_app.logger.error(e)
+        # a superseded request answers with the newer result, but only the
+        # request whose canvas was predicted ends the round
+        if own:
+            finish_round(
+                player, server_round, image, label, best_certainty, has_won
+            )
         # Update game state to be done
         game_state = "Done"
-        # Insert statistic for label
-        models.insert_into_label_success(
-            label=label, is_success=has_won, date=datetime.now()
-        )
+    certainty = truncate_certainty(certainty, top_k, label)
     # translate labels into norwegian
     if lang == "NO":
-        translation = shared_models.get_translation_dict()
+        translation = shared_models.get_translations(
+            set(certainty) | {best_guess, label}
+        )
         certainty_translated = dict(
             [
                 (translation[label], probability)
@@ -171,7 +223,7 @@ def classify():
         )
         data = {
             "certainty": certainty_translated,
-            "guess": translation[best_guess],
+            "guess": translation.get(best_guess, best_guess),
             "correctLabel": translation[label],
             "hasWon": has_won,
             "gameState": game_state,
@@ -192,6 +244,26 @@ def classify():
     return json.dumps(data), 200
 
 
+def finish_round(player, server_round, image, label, best_certainty, has_won):
+    """
+    Ends the round of the player, saves the drawing and records whether the
+    label was drawn, unless another request ended the round first.
+    """
+    # Update session_num in game and state for player
+    if not shared_models.end_round_for_player(
+        player.game_id, player.player_id, server_round
+    ):
+        return
+    try:
+        storage.save_image(image, label, best_certainty)
+    except Exception as e:
+        current_app.logger.error(e)
+    # Insert statistic for label
+    models.insert_into_label_success(
+        label=label, is_success=has_won, date=datetime.now()
+    )
+
+
 @singleplayer.route("/postScore", methods=["POST"])
 def post_score():
     """
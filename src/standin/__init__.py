@@ -0,0 +1,6 @@
+"""
+    Local stand-ins for Azure Custom Vision and Blob Storage, for benchmarks
+    and tests without network access or Azure keys.
+"""
+
+from src.standin.server import StandIn  # noqa: F401
@@ -0,0 +1,81 @@
+"""
+    Runs the stand-in server until interrupted, and prints the environment
+    variables that point the backend at it.
+
+    Usage: python -m src.standin [options]
+"""
+
+import argparse
+import csv
+import os
+import time
+from src.utilities import setup
+from src.standin.server import StandIn
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+src_directory = os.path.dirname(current_directory)
+
+parser = argparse.ArgumentParser(
+    description="local stand-in for Custom Vision and Blob Storage"
+)
+parser.add_argument("--host", type=str, default="127.0.0.1")
+parser.add_argument("--port", type=int, default=10000)
+parser.add_argument(
+    "--data",
+    type=str,
+    default=os.path.join(current_directory, "data"),
+    help="directory holding the blob containers",
+)
+parser.add_argument(
+    "--labels",
+    type=str,
+    default=os.path.join(src_directory, "dict_eng_to_nor_difficulties_v2.csv"),
+    help="csv file with one label per line in the first column",
+)
+parser.add_argument(
+    "--latency", type=float, default=0.0, help="seconds added to requests"
+)
+parser.add_argument(
+    "--jitter", type=float, default=0.0, help="random extra latency"
+)
+parser.add_argument(
+    "--error-rate", type=float, default=0.0, help="fraction of 503 errors"
+)
+parser.add_argument(
+    "--training-time",
+    type=float,
+    default=5.0,
+    help="seconds it takes to train an iteration",
+)
+parser.add_argument("--seed", type=int, default=None)
+
+
+def main():
+    args = parser.parse_args()
+    with open(args.labels) as f:
+        labels = [row[0] for row in csv.reader(f) if row]
+
+    standin = StandIn(
+        args.data,
+        labels=labels,
+        iteration_name=setup.DEFAULT_ITERATION_NAME,
+        training_time=args.training_time,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        host=args.host,
+        port=args.port,
+        seed=args.seed,
+    ).start()
+    print(f"Stand-in running on {standin.url}")
+    for key, value in standin.keys().items():
+        print(f"export {key}='{value}'")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        standin.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""
+    Stand-in for the Azure Blob Storage REST endpoints used by storage.py
+    and the Classifier. Every container is a directory and every blob a file
+    under the data directory, so images survive restarts of the stand-in.
+    Requests are not authenticated.
+"""
+
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+from email.utils import formatdate
+from threading import Lock
+from xml.sax.saxutils import escape
+from flask import Blueprint, Response, current_app, request
+
+blob = Blueprint("standin_blob", __name__)
+METADATA_FILE = ".metadata.json"
+BLOB_SUFFIX = ".blob"
+
+
+def _error(code, message, status):
+    body = (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        f"<Error><Code>{code}</Code><Message>{escape(message)}</Message>"
+        "</Error>"
+    )
+    return Response(
+        body,
+        status=status,
+        content_type="application/xml",
+        headers={"x-ms-error-code": code},
+    )
+
+
+def _container_not_found():
+    return _error(
+        "ContainerNotFound", "The specified container does not exist.", 404
+    )
+
+
+def _storage():
+    return current_app.extensions["standin_blob"]
+
+
+def _request_metadata() -> dict:
+    # set by the request handler of the server
+    return request.environ.get("standin.metadata", {})
+
+
+class BlobStandIn:
+    """
+    Blob containers backed by the filesystem. Blob names may contain "/",
+    which become subdirectories.
+    """
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.lock = Lock()
+        os.makedirs(data_dir, exist_ok=True)
+
+    def container_dir(self, container) -> str:
+        return os.path.join(self.data_dir, container)
+
+    def blob_path(self, container, name) -> str:
+        root = self.container_dir(container)
+        path = os.path.normpath(os.path.join(root, name + BLOB_SUFFIX))
+        if not path.startswith(root + os.sep):
+            raise ValueError("Invalid blob name")
+        return path
+
+    def read_metadata(self, container) -> dict:
+        path = os.path.join(self.container_dir(container), METADATA_FILE)
+        with open(path) as f:
+            return json.load(f)
+
+    def write_metadata(self, container, metadata) -> None:
+        path = os.path.join(self.container_dir(container), METADATA_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(metadata, f)
+        os.replace(path + ".tmp", path)
+
+    def properties(self, path) -> dict:
+        """
+        Returns the headers describing the blob stored at path.
+        """
+        stat = os.stat(path)
+        with open(path, "rb") as f:
+            etag = hashlib.md5(f.read()).hexdigest()
+        name = path[: -len(BLOB_SUFFIX)]
+        return {
+            "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+            "ETag": f'"0x{etag[:16].upper()}"',
+            "Content-Length": str(stat.st_size),
+            "Content-Type": mimetypes.guess_type(name)[0]
+            or "application/octet-stream",
+            "x-ms-blob-type": "BlockBlob",
+        }
+
+    def list_blobs(self, container, prefix="") -> list:
+        """
+        Returns the names of the blobs in the container, sorted.
+        """
+        root = self.container_dir(container)
+        names = []
+        for directory, _, files in os.walk(root):
+            for file in files:
+                if not file.endswith(BLOB_SUFFIX):
+                    continue
+                path = os.path.join(directory, file)
+                name = os.path.relpath(path, root)[: -len(BLOB_SUFFIX)]
+                name = name.replace(os.sep, "/")
+                if name.startswith(prefix):
+                    names.append(name)
+        return sorted(names)
+
+
+@blob.route(
+    "/blob/<account>/<container>", methods=["GET", "HEAD", "PUT", "DELETE"]
+)
+def container_operation(account, container):
+    if request.args.get("restype") != "container":
+        return _error("InvalidQueryParameterValue", "restype", 400)
+    storage = _storage()
+    directory = storage.container_dir(container)
+    comp = request.args.get("comp")
+    with storage.lock:
+        exists = os.path.isdir(directory)
+        if request.method == "PUT" and comp is None:
+            if exists:
+                return _error(
+                    "ContainerAlreadyExists",
+                    "The specified container already exists.",
+                    409,
+                )
+            os.makedirs(directory)
+            storage.write_metadata(container, _request_metadata())
+            return Response(status=201)
+        if not exists:
+            return _container_not_found()
+        if request.method == "PUT" and comp == "metadata":
+            storage.write_metadata(container, _request_metadata())
+            return Response(status=200)
+        if request.method == "DELETE":
+            shutil.rmtree(directory)
+            return Response(status=202)
+        if comp == "list":
+            return _list_blobs(storage, container)
+        metadata = storage.read_metadata(container)
+        headers = dict(
+            ("x-ms-meta-" + key, value) for key, value in metadata.items()
+        )
+        return Response(status=200, headers=headers)
+
+
+def _list_blobs(storage, container):
+    """
+    Returns a page of blobs in the container, from the marker on.
+    """
+    prefix = request.args.get("prefix", "")
+    marker = request.args.get("marker", "")
+    max_results = int(request.args.get("maxresults", 5000))
+    names = [n for n in storage.list_blobs(container, prefix) if n >= marker]
+    page, rest = names[:max_results], names[max_results:]
+
+    blobs = []
+    for name in page:
+        props = storage.properties(storage.blob_path(container, name))
+        blobs.append(
+            f"<Blob><Name>{escape(name)}</Name><Properties>"
+            f"<Last-Modified>{props['Last-Modified']}</Last-Modified>"
+            f"<Etag>{props['ETag']}</Etag>"
+            f"<Content-Length>{props['Content-Length']}</Content-Length>"
+            f"<Content-Type>{props['Content-Type']}</Content-Type>"
+            "<BlobType>BlockBlob</BlobType>"
+            "</Properties></Blob>"
+        )
+    next_marker = escape(rest[0]) if rest else ""
+    body = (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        f'<EnumerationResults ServiceEndpoint="{escape(request.host_url)}"'
+        f' ContainerName="{escape(container)}">'
+        f"<Prefix>{escape(prefix)}</Prefix>"
+        f"<Marker>{escape(marker)}</Marker>"
+        f"<MaxResults>{max_results}</MaxResults>"
+        f"<Blobs>{''.join(blobs)}</Blobs>"
+        f"<NextMarker>{next_marker}</NextMarker>"
+        "</EnumerationResults>"
+    )
+    return Response(body, content_type="application/xml")
+
+
+@blob.route(
+    "/blob/<account>/<container>/<path:name>",
+    methods=["GET", "HEAD", "PUT", "DELETE"],
+)
+def blob_operation(account, container, name):
+    storage = _storage()
+    if not os.path.isdir(storage.container_dir(container)):
+        return _container_not_found()
+    try:
+        path = storage.blob_path(container, name)
+    except ValueError as e:
+        return _error("InvalidResourceName", str(e), 400)
+
+    if request.method == "PUT":
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(request.get_data())
+        os.replace(path + ".tmp", path)
+        props = storage.properties(path)
+        headers = {
+            "ETag": props["ETag"],
+            "Last-Modified": props["Last-Modified"],
+        }
+        return Response(status=201, headers=headers)
+    if not os.path.isfile(path):
+        return _error(
+            "BlobNotFound", "The specified blob does not exist.", 404
+        )
+    if request.method == "DELETE":
+        os.remove(path)
+        return Response(status=202)
+    if request.method == "HEAD":
+        return Response(status=200, headers=storage.properties(path))
+    return _download(storage, path)
+
+
+def _download(storage, path):
+    """
+    Returns the blob, or the range of it asked for in x-ms-range.
+    """
+    headers = storage.properties(path)
+    with open(path, "rb") as f:
+        data = f.read()
+    byte_range = request.headers.get("x-ms-range")
+    if byte_range is None or len(data) == 0:
+        return Response(data, status=200, headers=headers)
+
+    start, _, end = byte_range.replace("bytes=", "").partition("-")
+    start = int(start)
+    end = min(int(end) if end else len(data) - 1, len(data) - 1)
+    if start >= len(data):
+        return _error("InvalidRange", "The range cannot be satisfied.", 416)
+    headers["Content-Length"] = str(end - start + 1)
+    headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+    return Response(data[start : end + 1], status=206, headers=headers)
@@ -0,0 +1,302 @@
+"""
+    Stand-in for the Custom Vision training and prediction endpoints used by
+    the Classifier. Predictions are a deterministic function of the image
+    and the iteration, and training completes after a configurable time.
+"""
+
+import datetime
+import hashlib
+import random
+import time
+import uuid
+from threading import Lock
+from flask import Blueprint, current_app, jsonify, request
+
+customvision = Blueprint("standin_customvision", __name__)
+TRAINING = "/customvision/<version>/training/projects/<project_id>"
+PREDICTION = "/customvision/<version>/prediction/<project_id>"
+
+
+def _now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def _error(code, message, status):
+    return jsonify({"code": code, "message": message}), status
+
+
+def _project():
+    return current_app.extensions["standin_customvision"]
+
+
+class CustomVisionStandIn:
+    """
+    State of the stand-in project. Every project id maps to the same
+    project.
+    """
+
+    def __init__(self, labels=(), iteration_name=None, training_time=0):
+        """
+        Parameters:
+        labels: tags created up front
+        iteration_name: published up front under this name, if given
+        training_time (float): seconds it takes to train an iteration
+        """
+        self.training_time = training_time
+        self.tags = {}
+        self.images = {}
+        self.iterations = {}
+        self.changed = False
+        self.lock = Lock()
+        for label in labels:
+            self.create_tag(label)
+        if iteration_name is not None:
+            iteration = self.new_iteration(status="Completed")
+            iteration["publishName"] = iteration_name
+
+    def create_tag(self, name) -> dict:
+        tag = {
+            "id": str(uuid.uuid4()),
+            "name": name,
+            "description": None,
+            "type": "Regular",
+            "imageCount": 0,
+        }
+        self.tags[tag["id"]] = tag
+        return tag
+
+    def new_iteration(self, status) -> dict:
+        iteration = {
+            "id": str(uuid.uuid4()),
+            "name": f"Iteration {len(self.iterations) + 1}",
+            "status": status,
+            "created": _now(),
+            "lastModified": _now(),
+            "publishName": None,
+            "_tags": [tag["name"] for tag in self.tags.values()],
+            "_started": time.monotonic(),
+        }
+        self.iterations[iteration["id"]] = iteration
+        return iteration
+
+    def iteration(self, iteration_id) -> dict:
+        """
+        Returns the iteration without internal fields, completing its
+        training once training_time has passed.
+        """
+        iteration = self.iterations[iteration_id]
+        elapsed = time.monotonic() - iteration["_started"]
+        if iteration["status"] == "Training":
+            if elapsed >= self.training_time:
+                iteration["status"] = "Completed"
+                iteration["lastModified"] = _now()
+        return dict(
+            (key, value)
+            for key, value in iteration.items()
+            if not key.startswith("_")
+        )
+
+    def predict(self, data: bytes, publish_name) -> list:
+        """
+        Returns the predictions of the published iteration for the image
+        or URL, or None if no iteration is published with the name. The
+        same input always gives the same predictions.
+        """
+        published = [
+            iteration
+            for iteration in self.iterations.values()
+            if iteration["publishName"] == publish_name
+        ]
+        if len(published) == 0:
+            return None
+
+        digest = hashlib.blake2b(data + publish_name.encode(), digest_size=8)
+        rng = random.Random(digest.digest())
+        labels = published[0]["_tags"]
+        tags = [tag for tag in self.tags.values() if tag["name"] in labels]
+        # skew the probabilities, so there is a clear best guess
+        weights = [rng.random() ** 8 for _ in tags]
+        total = sum(weights) or 1.0
+        predictions = [
+            {
+                "probability": weight / total,
+                "tagId": tag["id"],
+                "tagName": tag["name"],
+            }
+            for weight, tag in zip(weights, tags)
+        ]
+        predictions.sort(key=lambda p: -p["probability"])
+        return predictions
+
+
+@customvision.route(f"{TRAINING}/tags", methods=["GET"])
+def get_tags(version, project_id):
+    project = _project()
+    with project.lock:
+        return jsonify(list(project.tags.values()))
+
+
+@customvision.route(f"{TRAINING}/tags", methods=["POST"])
+def create_tag(version, project_id):
+    project = _project()
+    name = request.args["name"]
+    with project.lock:
+        if any(tag["name"] == name for tag in project.tags.values()):
+            return _error("BadRequestTagNameNotUnique", name, 400)
+        return jsonify(project.create_tag(name))
+
+
+@customvision.route(f"{TRAINING}/tags/<tag_id>", methods=["DELETE"])
+def delete_tag(version, project_id, tag_id):
+    project = _project()
+    with project.lock:
+        if project.tags.pop(tag_id, None) is None:
+            return _error("NotFound", "Tag not found", 404)
+        return "", 204
+
+
+@customvision.route(f"{TRAINING}/images/urls", methods=["POST"])
+def create_images_from_urls(version, project_id):
+    project = _project()
+    batch = request.get_json()
+    results = []
+    with project.lock:
+        for entry in batch["images"]:
+            tag_ids = entry.get("tagIds") or batch.get("tagIds") or []
+            if entry["url"] in project.images:
+                status = "OKDuplicate"
+            elif not all(tag_id in project.tags for tag_id in tag_ids):
+                status = "ErrorTagNotFound"
+            else:
+                status = "OK"
+                project.images[entry["url"]] = tag_ids
+                project.changed = True
+                for tag_id in tag_ids:
+                    project.tags[tag_id]["imageCount"] += 1
+            results.append({"sourceUrl": entry["url"], "status": status})
+    successful = all(result["status"] == "OK" for result in results)
+    summary = {"isBatchSuccessful": successful, "images": results}
+    return jsonify(summary), 200 if successful else 207
+
+
+@customvision.route(f"{TRAINING}/images", methods=["DELETE"])
+def delete_images(version, project_id):
+    project = _project()
+    with project.lock:
+        project.images.clear()
+        project.changed = True
+        for tag in project.tags.values():
+            tag["imageCount"] = 0
+    return "", 204
+
+
+@customvision.route(f"{TRAINING}/train", methods=["POST"])
+def train_project(version, project_id):
+    project = _project()
+    with project.lock:
+        if not project.changed:
+            return _error(
+                "BadRequestTrainingNotNeeded",
+                "Nothing changed since last training",
+                400,
+            )
+        project.changed = False
+        iteration = project.new_iteration(status="Training")
+        return jsonify(project.iteration(iteration["id"]))
+
+
+@customvision.route(f"{TRAINING}/iterations", methods=["GET"])
+def get_iterations(version, project_id):
+    project = _project()
+    with project.lock:
+        return jsonify([project.iteration(i) for i in project.iterations])
+
+
+@customvision.route(f"{TRAINING}/iterations/<iteration_id>", methods=["GET"])
+def get_iteration(version, project_id, iteration_id):
+    project = _project()
+    with project.lock:
+        if iteration_id not in project.iterations:
+            return _error("NotFound", "Iteration not found", 404)
+        return jsonify(project.iteration(iteration_id))
+
+
+@customvision.route(
+    f"{TRAINING}/iterations/<iteration_id>", methods=["DELETE"]
+)
+def delete_iteration(version, project_id, iteration_id):
+    project = _project()
+    with project.lock:
+        iteration = project.iterations.get(iteration_id)
+        if iteration is None:
+            return _error("NotFound", "Iteration not found", 404)
+        if iteration["publishName"] is not None:
+            return _error(
+                "BadRequestCannotDeletePublishedIteration",
+                "Unpublish the iteration first",
+                400,
+            )
+        del project.iterations[iteration_id]
+        return "", 204
+
+
+@customvision.route(
+    f"{TRAINING}/iterations/<iteration_id>/publish",
+    methods=["POST", "DELETE"],
+)
+def publish_iteration(version, project_id, iteration_id):
+    project = _project()
+    with project.lock:
+        if iteration_id not in project.iterations:
+            return _error("NotFound", "Iteration not found", 404)
+        iteration = project.iterations[iteration_id]
+        if request.method == "DELETE":
+            iteration["publishName"] = None
+            return "", 204
+        if project.iteration(iteration_id)["status"] != "Completed":
+            return _error(
+                "BadRequestIterationNotCompleted",
+                "Iteration is not trained",
+                400,
+            )
+        iteration["publishName"] = request.args["publishName"]
+        return jsonify(True)
+
+
+@customvision.route(
+    f"{PREDICTION}/classify/iterations/<publish_name>/image",
+    methods=["POST"],
+)
+def classify_image(version, project_id, publish_name):
+    # the SDK sends the image as multipart form data
+    if request.files:
+        data = next(iter(request.files.values())).read()
+    else:
+        data = request.get_data()
+    return _classify(project_id, publish_name, data)
+
+
+@customvision.route(
+    f"{PREDICTION}/classify/iterations/<publish_name>/url",
+    methods=["POST"],
+)
+def classify_image_url(version, project_id, publish_name):
+    url = request.get_json()["url"]
+    return _classify(project_id, publish_name, url.encode())
+
+
+def _classify(project_id, publish_name, data):
+    project = _project()
+    with project.lock:
+        predictions = project.predict(data, publish_name)
+    if predictions is None:
+        return _error("NotFound", "Iteration not published", 404)
+    return jsonify(
+        {
+            "id": str(uuid.uuid4()),
+            "project": project_id,
+            "iteration": publish_name,
+            "created": _now(),
+            "predictions": predictions,
+        }
+    )
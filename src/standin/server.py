@@ -0,0 +1,189 @@
+"""
+    Runs the Custom Vision and Blob Storage stand-ins in one Flask app on a
+    background thread, with configurable latency and error injection.
+"""
+
+import random
+import threading
+import time
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import WSGIRequestHandler, make_server
+from src.standin.blob import BlobStandIn, blob
+from src.standin.customvision import CustomVisionStandIn, customvision
+
+ACCOUNT_NAME = "devstoreaccount1"
+# the well-known development key of the Azure storage emulator
+ACCOUNT_KEY = (
+    "Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/"
+    "K1SZFPTOtr/KBHBeksoGMGw=="
+)
+PROJECT_ID = "00000000-0000-0000-0000-000000000000"
+
+
+class _RequestHandler(WSGIRequestHandler):
+    """
+    Keeps the x-ms-meta- headers, as werkzeug drops headers with
+    underscores, and metadata keys like image_count have them.
+    """
+
+    def make_environ(self):
+        environ = super().make_environ()
+        environ["standin.metadata"] = dict(
+            (key[len("x-ms-meta-") :].lower(), value)
+            for key, value in self.headers.items()
+            if key.lower().startswith("x-ms-meta-")
+        )
+        return environ
+
+    def log_request(self, *args, **kwargs):
+        # a line per request would slow down benchmarks
+        pass
+
+
+class StandIn:
+    """
+    Local stand-in server for the Azure services of the backend. The real
+    SDK clients are pointed at it through the keys returned by keys().
+
+    Every request waits latency seconds, plus up to jitter seconds, and
+    fails with a 503 with probability error_rate. Requests to /standin/
+    are never delayed or failed, and POST /standin/config changes the
+    injection while the server runs.
+    """
+
+    def __init__(
+        self,
+        data_dir,
+        labels=(),
+        iteration_name=None,
+        training_time=0,
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        host="127.0.0.1",
+        port=0,
+        seed=None,
+    ) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.injected_errors = 0
+        self.customvision = CustomVisionStandIn(
+            labels, iteration_name, training_time
+        )
+        self.blob = BlobStandIn(data_dir)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.app = self._create_app()
+        self._server = make_server(
+            host,
+            port,
+            self.app,
+            threaded=True,
+            request_handler=_RequestHandler,
+        )
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def keys(self) -> dict:
+        """
+        Returns the keys that point the Classifier and storage.py at the
+        stand-in, to be set as environment variables.
+        """
+        blob_url = f"{self.url}/blob/{ACCOUNT_NAME}"
+        return {
+            "CV_ENDPOINT": self.url,
+            "CV_PREDICTION_ENDPOINT": self.url,
+            "CV_PROJECT_ID": PROJECT_ID,
+            "CV_TRAINING_KEY": "standin",
+            "CV_PREDICTION_KEY": "standin",
+            "CV_PREDICTION_RESOURCE_ID": "standin",
+            "BASE_BLOB_URL": blob_url,
+            "BLOB_CONNECTION_STRING": (
+                "DefaultEndpointsProtocol=http;"
+                f"AccountName={ACCOUNT_NAME};AccountKey={ACCOUNT_KEY};"
+                f"BlobEndpoint={blob_url};"
+            ),
+        }
+
+    def configure(self, latency=None, jitter=None, error_rate=None) -> None:
+        with self._lock:
+            if latency is not None:
+                self.latency = float(latency)
+            if jitter is not None:
+                self.jitter = float(jitter)
+            if error_rate is not None:
+                self.error_rate = float(error_rate)
+
+    def _inject(self):
+        """
+        Delays the request and returns an error response if one is drawn.
+        """
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + self._random.random() * self.jitter
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.injected_errors += 1
+        if delay > 0:
+            time.sleep(delay)
+        if failed:
+            return Response(
+                '{"code": "ServiceUnavailable", "message": "Injected"}',
+                status=503,
+                content_type="application/json",
+                headers={"x-ms-error-code": "ServerBusy"},
+            )
+
+    def _create_app(self) -> Flask:
+        app = Flask(__name__)
+        app.extensions["standin_customvision"] = self.customvision
+        app.extensions["standin_blob"] = self.blob
+        app.register_blueprint(customvision)
+        app.register_blueprint(blob)
+
+        @app.before_request
+        def inject():
+            if not request.path.startswith("/standin/"):
+                return self._inject()
+
+        @app.route("/standin/config", methods=["GET", "POST"])
+        def config():
+            if request.method == "POST":
+                self.configure(**(request.get_json() or {}))
+            return jsonify(
+                {
+                    "latency": self.latency,
+                    "jitter": self.jitter,
+                    "error_rate": self.error_rate,
+                    "requests": self.requests,
+                    "injected_errors": self.injected_errors,
+                }
+            )
+
+        return app
+
+    def start(self) -> "StandIn":
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
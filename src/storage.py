@@ -2,54 +2,189 @@
     Tools for interacting with Azure blob storage.
 """
 
+import atexit
+import logging
+import os
 import uuid
 import time
+from threading import Lock
 from threading import Thread
-from azure.storage.blob import BlobClient
+from concurrent.futures import ThreadPoolExecutor
+from azure.core.exceptions import ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
 from azure.storage.blob import BlobServiceClient
+from flask import current_app
+from src.customvision.metrics import LatencyHistogram
 from src.utilities.keys import Keys
 from src.utilities import setup
+from src.utilities.image_cache import ImageCache
+from src.utilities.image_counter import ImageCounter
+from src.utilities.sessions import pool_stats, pooled_session
+from src.utilities.upload_queue import UploadQueue
+from src import models
 import base64
 import random
 
+_app = None
+_upload_queue = None
+_upload_queue_lock = Lock()
+_image_counter = None
+_image_counter_lock = Lock()
+_blob_clients_lock = Lock()
+_blob_connection_string = None
+_blob_service_client = None
+_blob_session = None
+_container_clients = {}
+_example_image_cache = None
+_example_image_cache_lock = Lock()
+
+
+class BlobRequestStats:
+    """
+    Latency histograms and response counts of the requests to Blob
+    Storage, per HTTP method. Every retry counts as a request.
+    """
+
+    def __init__(self) -> None:
+        self._latency = {}
+        self._statuses = {}
+        self._lock = Lock()
+
+    def start(self, request) -> None:
+        # called by the client before the request is sent
+        request.context["blob_request_start"] = time.monotonic()
+
+    def done(self, response) -> None:
+        # called by the client with the response
+        start = response.context.get("blob_request_start")
+        if start is None:
+            return
+        seconds = time.monotonic() - start
+        method = response.http_request.method
+        status = response.http_response.status_code
+        with self._lock:
+            histogram = self._latency.get(method)
+            if histogram is None:
+                histogram = self._latency[method] = LatencyHistogram()
+            histogram.record(seconds)
+            key = (method, status)
+            self._statuses[key] = self._statuses.get(key, 0) + 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            data = {}
+            for method, histogram in sorted(self._latency.items()):
+                data[method] = {
+                    "count": histogram.count,
+                    "mean": histogram.total / histogram.count,
+                    "max": histogram.max,
+                    "quantiles": dict(
+                        (str(q), histogram.quantile(q))
+                        for q in setup.METRICS_QUANTILES
+                    ),
+                    "statuses": dict(
+                        (str(key[1]), count)
+                        for key, count in self._statuses.items()
+                        if key[0] == method
+                    ),
+                }
+            return data
+
+
+_blob_requests = BlobRequestStats()
+
+
+def init_app(app) -> None:
+    """
+    Registers the Flask app, used to store image counts from background
+    threads. Starts preloading the example drawings if EXAMPLE_IMAGE_PRELOAD
+    is set.
+    """
+    global _app
+    _app = app
+    preload = setup.EXAMPLE_IMAGE_PRELOAD
+    if Keys.exists("EXAMPLE_IMAGE_PRELOAD"):
+        preload = Keys.get("EXAMPLE_IMAGE_PRELOAD") == "true"
+    if preload:
+        Thread(target=preload_example_images, daemon=True).start()
+
 
 def save_image(image, label, certainty):
     """
-    Upload image to blob storage container named "newimgcontainer" with same name as image label.
-    Image is renamed to assure unique name. Uploads only if certainty is larger than threshold
-    Returns public URL to access image, or non if certainty too low.
+    Queues the image for upload to the blob storage container with new
+    images, in a folder named by the image label. Image is renamed to
+    assure unique name. Saves only if certainty is larger than threshold.
+    The image is uploaded in the background, see get_upload_queue().
+    Returns public URL to access image, or None if certainty too low.
     """
     # save image in blob storage if certainty above threshold
     if certainty < setup.SAVE_CERTAINTY:
         return
 
+    if hasattr(image, "read"):
+        # read uploaded files now, they are closed after the request
+        image.seek(0)
+        image = image.read()
     file_name = f"{label}/{uuid.uuid4().hex}.png"
-    connection_string = Keys.get("BLOB_CONNECTION_STRING")
-    base_url = Keys.get("BASE_BLOB_URL")
     container_name = setup.CONTAINER_NAME_NEW
-    try:
-        blob = BlobClient.from_connection_string(
-            conn_str=connection_string,
-            container_name=container_name,
-            blob_name=file_name,
-        )
-        blob.upload_blob(image)
-        container_client = blob_connection(setup.CONTAINER_NAME_NEW)
-        # update metadata in blob
+    get_upload_queue().put(container_name, file_name, image)
+    base_url = Keys.get("BASE_BLOB_URL")
+    return base_url + "/" + container_name + "/" + file_name
+
+
+def get_upload_queue() -> UploadQueue:
+    """
+    Returns the queue of images waiting to be uploaded, started on first
+    use. The queue is drained when the process exits.
+    """
+    global _upload_queue
+    with _upload_queue_lock:
+        if _upload_queue is None:
+            _upload_queue = UploadQueue(
+                upload_batch,
+                setup.UPLOAD_SPOOL_DIR,
+                setup.UPLOAD_QUEUE_SIZE,
+                setup.UPLOAD_QUEUE_BATCH_SIZE,
+                setup.UPLOAD_QUEUE_BATCH_WAIT,
+                setup.UPLOAD_QUEUE_RETRIES,
+                setup.UPLOAD_QUEUE_RETRY_INTERVAL,
+                setup.UPLOAD_SPOOL_INTERVAL,
+            ).start()
+    return _upload_queue
+
+
+def upload_batch(entries):
+    """
+    Uploads a batch of queued images, and adds them to the image counts of
+    their containers. Returns the entries that failed.
+    """
+    failed = []
+    container_clients = {}
+    # container name -> label -> number of uploaded images
+    uploaded = {}
+    for entry in entries:
         try:
-            image_count = int(
-                container_client.get_container_properties().metadata[
-                    "image_count"
-                ]
+            if entry.container not in container_clients:
+                container_clients[entry.container] = blob_connection(
+                    entry.container
+                )
+            # a retried upload may have reached the container already
+            container_clients[entry.container].upload_blob(
+                entry.name, entry.data, overwrite=True
             )
-        except KeyError:
-            image_count = 0
-        metadata = {"image_count": str(image_count + 1)}
-        container_client.set_container_metadata(metadata=metadata)
-    except Exception as e:
-        raise Exception("Could not save image from storage.py" + str(e))
-    url = base_url + "/" + container_name + "/" + file_name
-    return url
+        except Exception as e:
+            logging.warning(f"Could not upload image {entry.name}: {e}")
+            failed.append(entry)
+            continue
+        labels = uploaded.setdefault(entry.container, {})
+        label = entry.name.split("/")[0]
+        labels[label] = labels.get(label, 0) + 1
+
+    counter = get_image_counter()
+    for container_name, labels in uploaded.items():
+        for label, count in labels.items():
+            counter.add(container_name, label, count)
+    return failed
 
 
 def clear_dataset():
@@ -64,6 +199,7 @@ def clear_dataset():
         container_client.delete_container()
     except Exception as e:
         raise Exception("could not delete container" + str(e))
+    reset_image_counts(setup.CONTAINER_NAME_NEW)
     Thread(target=create_container).start()
 
 
@@ -91,52 +227,164 @@ def create_container():
             raise Exception("Could not create container")
 
 
-def image_count_old():
+def get_image_counter() -> ImageCounter:
     """
-    Returns number of images in relevant container.
+    Returns the counter of saved images, started on first use. Counts are
+    added to the database every IMAGE_COUNT_FLUSH_INTERVAL seconds, and
+    when the process exits.
     """
-    container_client = blob_connection(Keys.get("CONTAINER_NAME"))
+    global _image_counter
+    with _image_counter_lock:
+        if _image_counter is None:
+            _image_counter = ImageCounter(
+                _store_image_counts, setup.IMAGE_COUNT_FLUSH_INTERVAL
+            ).start()
+    return _image_counter
 
-    return container_client.get_container_properties().metadata["image_count"]
 
+@atexit.register
+def _shutdown() -> None:
+    """
+    Drains the upload queue and then flushes the image counter, so counts
+    of the last uploaded images still reach the database.
+    """
+    if _upload_queue is not None:
+        _upload_queue.close(setup.UPLOAD_QUEUE_DRAIN_TIMEOUT)
+    if _image_counter is not None:
+        _image_counter.close()
 
-def image_count():
-    blob_service_client = BlobServiceClient.from_connection_string(
-        Keys.get("BLOB_CONNECTION_STRING")
-    )
-    container_client = blob_service_client.get_container_client(
-        Keys.get("CONTAINER_NAME")
-    )
 
-    # Initialize the counter for all files
-    file_count = 0
+def _app_context():
+    if _app is not None:
+        return _app.app_context()
+    return current_app.app_context()
 
-    # Iterate over all the blobs in the container
-    file_count = sum(1 for _ in container_client.list_blobs())
-    return file_count
 
+def _store_image_counts(container_name, counts):
+    with _app_context():
+        models.increment_image_counts(container_name, counts)
 
-def blob_connection(container_name):
+
+def image_counts(container_name=None) -> dict:
     """
-    Helper method for connection to blob service.
+    Returns a dictionary with the number of images per label in the
+    container, including images not stored in the database yet. A container
+    without stored counts is counted once by listing its blobs.
     """
+    if container_name is None:
+        container_name = Keys.get("CONTAINER_NAME")
+    with _app_context():
+        counts = models.get_image_counts(container_name)
+        if counts is None:
+            # the listed blobs include the uploaded images not stored yet
+            get_image_counter().discard(container_name)
+            counts = count_blobs(container_name)
+            models.set_image_counts(container_name, counts)
+    for label, count in get_image_counter().pending(container_name).items():
+        counts[label] = counts.get(label, 0) + count
+    return counts
 
-    connect_str = Keys.get("BLOB_CONNECTION_STRING")
+
+def image_count(container_name=None) -> int:
+    """
+    Returns number of images in the container, by default the container
+    named by the CONTAINER_NAME key.
+    """
+    return sum(image_counts(container_name).values())
+
+
+def count_blobs(container_name) -> dict:
+    """
+    Returns a dictionary with the number of blobs per label in the
+    container, by listing every blob. Used when no counts are stored.
+    """
+    container_client = blob_connection(container_name)
+    counts = {}
     try:
-        # Instantiate a BlobServiceClient using a connection string
-        blob_service_client = BlobServiceClient.from_connection_string(
-            connect_str
-        )
-        # Instantiate a ContainerClient
-        container_client = blob_service_client.get_container_client(
-            container_name
-        )
-    except Exception as e:
-        raise Exception("Could not connect to blob client: " + str(e))
+        for blob in container_client.list_blobs():
+            label = blob.name.split("/")[0]
+            counts[label] = counts.get(label, 0) + 1
+    except ResourceNotFoundError:
+        # deleted by clear_dataset(), and not created again yet
+        pass
+    return counts
+
 
+def reset_image_counts(container_name) -> None:
+    """
+    Sets the image counts of an emptied container to zero.
+    """
+    get_image_counter().discard(container_name)
+    with _app_context():
+        models.set_image_counts(container_name, {})
+
+
+def get_blob_service_client() -> BlobServiceClient:
+    """
+    Returns the Blob service client shared by every thread. Its requests
+    go through one pooled session, so connections are kept alive between
+    calls. A new client is made if the connection string changes.
+    """
+    global _blob_connection_string, _blob_service_client, _blob_session
+    connect_str = Keys.get("BLOB_CONNECTION_STRING")
+    with _blob_clients_lock:
+        if _blob_service_client is None or (
+            connect_str != _blob_connection_string
+        ):
+            pool_size = setup.BLOB_POOL_SIZE
+            if Keys.exists("BLOB_POOL_SIZE"):
+                pool_size = int(Keys.get("BLOB_POOL_SIZE"))
+            session = pooled_session(pool_size)
+            transport = RequestsTransport(session=session, session_owner=False)
+            try:
+                client = BlobServiceClient.from_connection_string(
+                    connect_str,
+                    transport=transport,
+                    raw_request_hook=_blob_requests.start,
+                    raw_response_hook=_blob_requests.done,
+                )
+            except Exception as e:
+                raise Exception("Could not connect to blob client: " + str(e))
+            _blob_connection_string = connect_str
+            _blob_service_client = client
+            _blob_session = session
+            _container_clients.clear()
+        return _blob_service_client
+
+
+def blob_connection(container_name):
+    """
+    Returns the shared client of the container.
+    """
+    service_client = get_blob_service_client()
+    with _blob_clients_lock:
+        container_client = _container_clients.get(container_name)
+        if container_client is None:
+            container_client = service_client.get_container_client(
+                container_name
+            )
+            _container_clients[container_name] = container_client
     return container_client
 
 
+def blob_client_stats() -> dict:
+    """
+    Returns the connections of the shared Blob Storage clients, and the
+    latency of their requests.
+    """
+    with _blob_clients_lock:
+        session = _blob_session
+        containers = len(_container_clients)
+    connections = {"hosts": 0, "opened": 0, "idle": 0, "requests": 0}
+    if session is not None:
+        connections = pool_stats(session)
+    return {
+        "containers": containers,
+        "connections": connections,
+        "requests": _blob_requests.snapshot(),
+    }
+
+
 def get_n_random_images_from_label(n, label):
     """
     Returns n random images from the blob storage container with the given label.
@@ -172,23 +420,70 @@ def clear_container(container_name=setup.CONTAINER_NAME_ORIGINAL):
     blobs = container_client.list_blobs()
     for blob in blobs:
         container_client.delete_blob(blob)
-    metadata = {"image_count": "0"}
-    container_client.set_container_metadata(metadata=metadata)
+    reset_image_counts(container_name)
     return True
 
 
 def get_images_from_relative_url(image_urls):
     """
-    Returns a list of images from a list of relative URLs.
+    Returns a list of images from a list of relative URLs. The images are
+    served from the example image cache, and downloaded only on the first
+    request.
     """
-    container_client = blob_connection(setup.CONTAINER_NAME_ORIGINAL)
+    cache = get_example_image_cache()
     images = []
     for image in image_urls:
-        blob_client = container_client.get_blob_client(image)
-
-        image_data = blob_client.download_blob().readall()
+        image_data = cache.get(image, _download_example_image)
         decoded_image = image_to_data_url(
             image_data, "application/octet-stream"
         )
         images.append(decoded_image)
     return images
+
+
+def get_example_image_cache() -> ImageCache:
+    """
+    Returns the cache of example drawings, kept in memory up to
+    EXAMPLE_IMAGE_CACHE_SIZE bytes and on disk in EXAMPLE_IMAGE_CACHE_DIR.
+    """
+    global _example_image_cache
+    with _example_image_cache_lock:
+        if _example_image_cache is None:
+            _example_image_cache = ImageCache(
+                setup.EXAMPLE_IMAGE_CACHE_SIZE,
+                os.path.join(
+                    setup.EXAMPLE_IMAGE_CACHE_DIR,
+                    setup.CONTAINER_NAME_ORIGINAL,
+                ),
+            )
+    return _example_image_cache
+
+
+def _download_example_image(name) -> bytes:
+    container_client = blob_connection(setup.CONTAINER_NAME_ORIGINAL)
+    return container_client.get_blob_client(name).download_blob().readall()
+
+
+def preload_example_images() -> int:
+    """
+    Loads every image in the ExampleImages table into the example image
+    cache, downloading the ones not on disk. Returns the number of images
+    loaded.
+    """
+    with _app_context():
+        names = models.get_example_image_names()
+    cache = get_example_image_cache()
+
+    def load(name):
+        try:
+            cache.get(name, _download_example_image)
+            return True
+        except Exception as e:
+            logging.warning(f"Could not preload example image {name}: {e}")
+            return False
+
+    workers = setup.EXAMPLE_IMAGE_PRELOAD_WORKERS
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        loaded = sum(executor.map(load, names))
+    logging.info(f"Preloaded {loaded} of {len(names)} example images")
+    return loaded
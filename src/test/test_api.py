@@ -7,6 +7,7 @@ from pytest import raises
 from singleplayer import api
 import src.models as shared_models
 from utilities import setup
+from utilities.certainty import parse_top_k, truncate_certainty
 from werkzeug import exceptions as excp
 from PIL import Image
 from test.conftest import TestValues, get_data_folder_path
@@ -352,3 +353,47 @@ def test_white_image_data_done(client):
     assert json_data["hasWon"] is False
     assert json_data["certainty"] == 1.0
     assert json_data["guess"] == setup.WHITE_IMAGE_GUESS
+
+
+def test_truncate_certainty_keeps_top_k_and_correct_label():
+    """
+    Ensure that only the top k labels and the correct label are kept.
+    """
+    certainty = {"bird": 0.5, "tree": 0.3, "house": 0.15, "cat": 0.05}
+    truncated = truncate_certainty(certainty, 2, "cat")
+    assert truncated == {"bird": 0.5, "tree": 0.3, "cat": 0.05}
+    assert truncate_certainty(certainty, 2, "tree") == {
+        "bird": 0.5,
+        "tree": 0.3,
+    }
+    assert truncate_certainty(certainty, None, "cat") == certainty
+
+
+def test_parse_top_k():
+    """
+    Ensure that top_k has to be a positive integer if given.
+    """
+    assert parse_top_k(None) is None
+    assert parse_top_k("3") == 3
+    with raises(excp.BadRequest):
+        parse_top_k("0")
+    with raises(excp.BadRequest):
+        parse_top_k("many")
+
+
+def test_metrics_requires_authentication(client):
+    """
+    Ensure that prediction metrics are not public.
+    """
+    res = client.get("/metrics")
+    assert res.status_code == 401
+
+
+def test_classify_strokes_malformed(client):
+    """
+    Ensure that malformed strokes are rejected with 400 Bad Request.
+    """
+    res = client.post("/classifyStrokes", data={"strokes": "[[1, 2]]"})
+    assert res.status_code == 400
+    res = client.post("/classifyStrokes", data={})
+    assert res.status_code == 400
@@ -1,6 +1,34 @@
 import pytest
 import os
+import json
+import time
+from threading import Event, Thread
+from types import SimpleNamespace
+import numpy as np
 from customvision.classifier import Classifier
+from customvision.predictors import LocalPredictor, to_probabilities
+from customvision.cache import PredictionCache
+from customvision.coalesce import InFlightTracker
+from customvision.batching import BatchScheduler
+from customvision.canvas import normalize_canvas
+from customvision.breaker import CircuitBreaker
+from customvision.ratelimit import RateLimiter
+from customvision.manifest import UploadManifest
+from customvision.manifest import remove_manifests
+from customvision.training import TrainingJob, TrainingManager
+from customvision.metrics import LatencyHistogram, PredictionMetrics
+from customvision.evaluate import evaluate, load_dataset
+from customvision.shadow import ShadowPredictor
+from customvision import strokes
+from customvision.strokes import StrokeCanvases, StrokeRasterizer
+from customvision.strokes import parse_strokes
+from src.utilities.exceptions import UserError
+from werkzeug import exceptions as excp
+from src import models
+from src.utilities.exceptions import PredictionUnavailable
+from io import BytesIO
+from PIL import Image
+from utilities import setup
 from test.conftest import TestValues, get_data_folder_path
 
 
@@ -12,6 +40,26 @@ def classifier():
     yield Classifier()
 
 
+@pytest.fixture
+def local_predictor(tmp_path):
+    """
+    initialize a local predictor with a small random NumPy model.
+    """
+    rng = np.random.default_rng(0)
+    input_size = 28
+    path = os.path.join(tmp_path, "model.npz")
+    np.savez(
+        path,
+        labels=np.array(TestValues.LABELS),
+        input_size=input_size,
+        W0=rng.normal(size=(input_size * input_size, 16)),
+        b0=np.zeros(16),
+        W1=rng.normal(size=(16, len(TestValues.LABELS))),
+        b1=np.zeros(len(TestValues.LABELS)),
+    )
+    yield LocalPredictor(path)
+
+
 def test_prediction_image_does_not_crash(classifier):
     """
     assert classifier is able to get a predicition without crashing.
@@ -60,3 +108,862 @@ def test_get_iteration_name_is_string(classifier):
     Tests if it's possible to get an iteration name from the database and the type is str
     """
     assert isinstance(classifier.iteration_name, str)
+
+
+def test_local_predictor_probabilities_format(local_predictor):
+    """
+    Test that the local backend returns a probability for every label.
+    """
+    path = os.path.join(get_data_folder_path(), TestValues.CV_TEST_IMAGE)
+    with open(path, "rb") as fh:
+        probabilities = local_predictor.predict(fh.read(), "local")
+    assert sorted(probabilities) == sorted(TestValues.LABELS)
+    for k, v in probabilities.items():
+        assert type(k) is str
+        assert type(v) is float
+    assert sum(probabilities.values()) == pytest.approx(1.0)
+
+
+def test_local_predictor_batch_matches_single(local_predictor):
+    """
+    Test that predicting a batch gives the same result as one at a time.
+    """
+    images = []
+    for name in [TestValues.CV_TEST_IMAGE, TestValues.API_IMAGE4]:
+        with open(os.path.join(get_data_folder_path(), name), "rb") as fh:
+            images.append(fh.read())
+    batch = local_predictor.predict_batch(images, "local")
+    for image, result in zip(images, batch):
+        single = local_predictor.predict(image, "local")
+        assert single == pytest.approx(result)
+
+
+def test_local_predictor_keeps_onnx_probabilities(tmp_path, monkeypatch):
+    """
+    Test that outputs of an ONNX model ending in softmax are not put through
+    softmax again, and that a dynamic input side uses LOCAL_INPUT_SIZE.
+    """
+    labels = TestValues.LABELS
+    output = np.zeros(len(labels), dtype=np.float32)
+    output[0] = 0.9
+    output[1:] = 0.1 / (len(labels) - 1)
+    sides = []
+
+    class FakeSession:
+        def __init__(self, path, providers):
+            pass
+
+        def get_inputs(self):
+            shape = ["batch", 1, "side", "side"]
+            return [SimpleNamespace(name="image", shape=shape)]
+
+        def run(self, names, feed):
+            sides.append(feed["image"].shape[-1])
+            return [np.tile(output, (len(feed["image"]), 1))]
+
+    monkeypatch.setattr(
+        "customvision.predictors.onnxruntime",
+        SimpleNamespace(InferenceSession=FakeSession),
+    )
+    path = os.path.join(tmp_path, "model.onnx")
+    with open(os.path.join(tmp_path, "model.labels"), "w") as f:
+        f.write("\n".join(labels))
+    predictor = LocalPredictor(path)
+    with open(
+        os.path.join(get_data_folder_path(), TestValues.CV_TEST_IMAGE), "rb"
+    ) as fh:
+        probabilities = predictor.predict(fh.read(), "local")
+    assert probabilities[labels[0]] == pytest.approx(0.9)
+    assert sides == [setup.LOCAL_INPUT_SIZE]
+
+
+def test_to_probabilities_applies_softmax_to_logits():
+    """
+    Test that logits, and scores that are not probabilities, go through
+    softmax.
+    """
+    probabilities = np.array([[0.7, 0.2, 0.1]])
+    assert to_probabilities(probabilities, logits=False) == pytest.approx(
+        probabilities
+    )
+    softmax = to_probabilities(probabilities, logits=True)
+    assert softmax[0, 0] < 0.7
+    assert softmax.sum() == pytest.approx(1.0)
+    scores = to_probabilities(np.array([[2.0, -1.0, 0.5]]), logits=False)
+    assert scores.sum() == pytest.approx(1.0)
+    assert (scores > 0).all()
+
+
+def test_prediction_cache_counts_hits_and_misses():
+    """
+    Test that a repeated image is answered from the cache.
+    """
+    cache = PredictionCache(max_size=2, ttl=60)
+    key = cache.key(b"image", TestValues.CV_ITERATION_NAME)
+    assert cache.get(key) is None
+    cache.put(key, ({"bird": 0.9, "tree": 0.1}, "bird"))
+    assert cache.get(key) == ({"bird": 0.9, "tree": 0.1}, "bird")
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_prediction_cache_key_includes_iteration():
+    """
+    Test that a new iteration does not get predictions from the old one.
+    """
+    cache = PredictionCache(max_size=2, ttl=60)
+    assert cache.key(b"image", "Iteration4") != cache.key(b"image", "other")
+
+
+def test_prediction_cache_evicts_least_recently_used():
+    """
+    Test that the least recently used entry is evicted when full.
+    """
+    cache = PredictionCache(max_size=2, ttl=60)
+    for key in ["a", "b"]:
+        cache.put(key, ({key: 1.0}, key))
+    cache.get("a")
+    cache.put("c", ({"c": 1.0}, "c"))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+
+def test_prediction_cache_expires_entries():
+    """
+    Test that entries older than the time to live are not returned.
+    """
+    cache = PredictionCache(max_size=2, ttl=-1)
+    cache.put("a", ({"a": 1.0}, "a"))
+    assert cache.get("a") is None
+
+
+def test_in_flight_tracker_only_predicts_latest_canvas():
+    """
+    Test that canvases superseded while a prediction is in flight are
+    answered with the result of the newest canvas, which only the newest
+    request owns.
+    """
+    tracker = InFlightTracker()
+    release = Event()
+    predicted = []
+
+    def predict(image):
+        predicted.append(image)
+        if image == "first":
+            release.wait()
+        return image
+
+    results = {}
+
+    def classify(image):
+        results[image] = tracker.submit(TestValues.PLAYER_ID, image, predict)
+
+    threads = [Thread(target=classify, args=("first",))]
+    threads[0].start()
+    while not predicted:
+        time.sleep(0.01)
+    for image in ["second", "third"]:
+        threads.append(Thread(target=classify, args=(image,)))
+        threads[-1].start()
+    while tracker.stats()["superseded"] < 1:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert predicted == ["first", "third"]
+    assert results == {
+        "first": ("first", True),
+        "second": ("third", False),
+        "third": ("third", True),
+    }
+    assert tracker.stats()["in_flight"] == 0
+
+
+def test_in_flight_tracker_raises_prediction_error():
+    """
+    Test that an error from the prediction is raised to the caller and the
+    player can classify again afterwards.
+    """
+    tracker = InFlightTracker()
+
+    def predict(image):
+        raise ValueError(image)
+
+    with pytest.raises(ValueError):
+        tracker.run(TestValues.PLAYER_ID, "image", predict)
+    assert tracker.run(TestValues.PLAYER_ID, "image", str.upper) == "IMAGE"
+
+
+def test_batch_scheduler_gathers_concurrent_images():
+    """
+    Test that images submitted at the same time are predicted together and
+    every caller gets the result of its own image.
+    """
+    batch_sizes = []
+
+    def predict_batch(images, iteration_name):
+        batch_sizes.append(len(images))
+        return [image * 2 for image in images]
+
+    scheduler = BatchScheduler(predict_batch, max_batch_size=8, max_wait=0.2)
+    results = {}
+
+    def submit(image):
+        results[image] = scheduler.submit(image, TestValues.CV_ITERATION_NAME)
+
+    threads = [Thread(target=submit, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == {i: i * 2 for i in range(8)}
+    assert sum(batch_sizes) == 8
+    assert len(batch_sizes) < 8
+
+
+def test_batch_scheduler_fails_only_the_invalid_image():
+    """
+    Test that an image that cannot be decoded or predicted fails its own
+    request, and the other images in the batch are still predicted.
+    """
+
+    def prepare(image):
+        if image == "undecodable":
+            raise ValueError(image)
+        return image
+
+    def predict_batch(images, iteration_name):
+        if "bad" in images:
+            raise ValueError("bad")
+        return [image.upper() for image in images]
+
+    scheduler = BatchScheduler(
+        predict_batch, max_batch_size=8, max_wait=0.2, prepare=prepare
+    )
+    results = {}
+
+    def submit(image):
+        try:
+            results[image] = scheduler.submit(
+                image, TestValues.CV_ITERATION_NAME
+            )
+        except ValueError as e:
+            results[image] = e
+
+    images = ["first", "bad", "undecodable", "second"]
+    threads = [Thread(target=submit, args=(image,)) for image in images]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results["first"] == "FIRST"
+    assert results["second"] == "SECOND"
+    assert isinstance(results["bad"], ValueError)
+    assert isinstance(results["undecodable"], ValueError)
+
+
+def test_normalize_canvas_crops_to_model_resolution():
+    """
+    Test that a drawing is re-encoded as a smaller grayscale image at model
+    resolution.
+    """
+    path = os.path.join(get_data_folder_path(), TestValues.API_IMAGE4)
+    with open(path, "rb") as fh:
+        image = fh.read()
+    normalized, bytes_saved = normalize_canvas(image)
+    img = Image.open(BytesIO(normalized))
+    assert img.mode == "L"
+    assert img.size == (setup.MODEL_RESOLUTION, setup.MODEL_RESOLUTION)
+    assert bytes_saved == len(image) - len(normalized)
+    assert bytes_saved > 0
+
+
+def test_normalize_canvas_keeps_blank_canvas_blank():
+    """
+    Test that a blank canvas is still blank after normalization.
+    """
+    path = os.path.join(get_data_folder_path(), TestValues.API_IMAGE5)
+    with open(path, "rb") as fh:
+        normalized, _ = normalize_canvas(fh.read())
+    img = Image.open(BytesIO(normalized)).convert("L")
+    assert img.getextrema() == (255, 255)
+
+
+def test_iteration_name_falls_back_to_default(classifier, monkeypatch):
+    """
+    Test that the default iteration is used when Custom Vision can't be
+    reached and no iteration name is stored.
+    """
+
+    def unreachable():
+        raise ConnectionError("Custom Vision is down")
+
+    monkeypatch.setattr(classifier, "_stored_iteration_name", lambda: None)
+    monkeypatch.setattr(
+        classifier, "get_published_iteration_name", unreachable
+    )
+    assert classifier.iteration_name == setup.DEFAULT_ITERATION_NAME
+
+
+def test_iteration_name_prefers_stored_name(classifier, monkeypatch):
+    """
+    Test that the stored iteration name is used on first use, without
+    asking Custom Vision.
+    """
+
+    def unexpected():
+        raise AssertionError("Custom Vision should not be called")
+
+    monkeypatch.setattr(
+        classifier, "_stored_iteration_name", lambda: "Iteration5"
+    )
+    monkeypatch.setattr(classifier, "get_published_iteration_name", unexpected)
+    assert classifier.iteration_name == "Iteration5"
+
+
+def test_swap_iteration_after_warm_up(classifier, monkeypatch):
+    """
+    Test that a new iteration is warmed up, used and stored.
+    """
+    warmed_up = []
+    stored = []
+    monkeypatch.setattr(
+        classifier.backend,
+        "predict",
+        lambda image, name: warmed_up.append(name) or {"bird": 1.0},
+    )
+    monkeypatch.setattr(classifier, "_store_iteration_name", stored.append)
+    classifier.iteration_name = "Iteration4"
+    assert classifier.swap_iteration("Iteration5")
+    assert warmed_up == ["Iteration5"]
+    assert stored == ["Iteration5"]
+    assert classifier.iteration_name == "Iteration5"
+
+
+def test_swap_iteration_keeps_old_iteration_if_warm_up_fails(
+    classifier, monkeypatch
+):
+    """
+    Test that traffic stays on the old iteration if the new one fails.
+    """
+
+    def failing_predict(image, name):
+        raise ConnectionError("iteration not ready")
+
+    monkeypatch.setattr(classifier.backend, "predict", failing_predict)
+    monkeypatch.setattr(classifier, "_store_iteration_name", print)
+    classifier.iteration_name = "Iteration4"
+    assert not classifier.swap_iteration("Iteration5")
+    assert classifier.iteration_name == "Iteration4"
+
+
+def test_circuit_breaker_opens_after_failures():
+    """
+    Test that the breaker rejects calls after too many failures, and closes
+    again after a successful trial call.
+    """
+    breaker = CircuitBreaker("test", 2, reset_timeout=0, latency_budget=1)
+
+    def fail():
+        raise ConnectionError("backend down")
+
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            breaker.call(fail)
+    assert breaker.stats()["state"] == CircuitBreaker.OPEN
+    assert breaker.stats()["trips"] == 1
+    # reset_timeout is 0, so the next call is a trial call
+    assert breaker.call(str.upper, "ok") == "OK"
+    assert breaker.stats()["state"] == CircuitBreaker.CLOSED
+
+
+def test_circuit_breaker_ignores_errors_before_the_call():
+    """
+    Test that errors from before(), such as a rate limiter giving up, do not
+    count as failures and leave the trial call to the next request.
+    """
+    breaker = CircuitBreaker("test", 1, reset_timeout=0, latency_budget=1)
+
+    def limited():
+        raise PredictionUnavailable("rate limit reached")
+
+    for _ in range(3):
+        with pytest.raises(PredictionUnavailable):
+            breaker.call(str.upper, "ok", before=limited)
+    assert breaker.stats()["state"] == CircuitBreaker.CLOSED
+    assert breaker.stats()["failures"] == 0
+    assert breaker.call(str.upper, "ok", before=lambda: None) == "OK"
+
+
+def test_circuit_breaker_rejects_while_open():
+    """
+    Test that calls are rejected without calling the backend while open.
+    """
+    breaker = CircuitBreaker("test", 1, reset_timeout=60, latency_budget=1)
+    with pytest.raises(ZeroDivisionError):
+        breaker.call(lambda: 1 / 0)
+    with pytest.raises(PredictionUnavailable):
+        breaker.call(str.upper, "not called")
+    assert breaker.stats()["rejected"] == 1
+
+
+def test_circuit_breaker_counts_slow_calls_as_failures():
+    """
+    Test that a call slower than the latency budget counts as a failure.
+    """
+    breaker = CircuitBreaker("test", 1, reset_timeout=60, latency_budget=0)
+    breaker.call(time.sleep, 0.01)
+    assert breaker.stats()["state"] == CircuitBreaker.OPEN
+
+
+def test_rate_limiter_serves_live_before_batch():
+    """
+    Test that a waiting live request is granted a token before a batch
+    request that has waited longer.
+    """
+    limiter = RateLimiter(rate=10, burst=1, batch_reserve=0)
+    limiter.acquire(RateLimiter.LIVE)
+    granted = []
+
+    def acquire(priority):
+        limiter.acquire(priority)
+        granted.append(priority)
+
+    batch = Thread(target=acquire, args=(RateLimiter.BATCH,))
+    live = Thread(target=acquire, args=(RateLimiter.LIVE,))
+    batch.start()
+    time.sleep(0.02)
+    live.start()
+    batch.join()
+    live.join()
+    assert granted == [RateLimiter.LIVE, RateLimiter.BATCH]
+
+
+def test_rate_limiter_batch_yields_to_live_traffic():
+    """
+    Test that batch requests leave the tokens to live traffic.
+    """
+    limiter = RateLimiter(
+        rate=1, burst=10, live_headroom=4, batch_reserve=0, window=1
+    )
+    for _ in range(5):
+        limiter.acquire(RateLimiter.LIVE)
+    with pytest.raises(PredictionUnavailable):
+        limiter.acquire(RateLimiter.BATCH, timeout=0.05)
+    limiter.acquire(RateLimiter.LIVE, timeout=0.05)
+    assert limiter.stats()["granted"] == {"live": 6, "admin": 0, "batch": 0}
+
+
+def test_rate_limiter_pauses_after_too_many_requests():
+    """
+    Test that a 429 response stops all requests until Retry-After.
+    """
+    limiter = RateLimiter(rate=100, burst=10)
+    response = SimpleNamespace(status_code=429, headers={"Retry-After": "0.2"})
+
+    def throttled():
+        error = Exception("Too Many Requests")
+        error.response = response
+        raise error
+
+    with pytest.raises(Exception):
+        limiter.call(RateLimiter.BATCH, throttled)
+    assert limiter.stats()["throttled"] == 1
+    with pytest.raises(PredictionUnavailable):
+        limiter.acquire(RateLimiter.LIVE, timeout=0.05)
+    time.sleep(0.2)
+    limiter.acquire(RateLimiter.LIVE, timeout=0.05)
+
+
+def test_prediction_unavailable_without_fallback(classifier, monkeypatch):
+    """
+    Test that a failing backend without fallback raises
+    PredictionUnavailable.
+    """
+
+    def failing_predict(image, name):
+        raise ConnectionError("Custom Vision is down")
+
+    monkeypatch.setattr(classifier.backend, "send", failing_predict)
+    classifier.iteration_name = TestValues.CV_ITERATION_NAME
+    classifier.fallback = None
+    path = os.path.join(get_data_folder_path(), TestValues.CV_TEST_IMAGE)
+    with open(path, "rb") as fh:
+        with pytest.raises(PredictionUnavailable):
+            classifier.predict_image_by_post(fh)
+
+
+def test_upload_manifest_resumes_from_checkpoint(tmp_path):
+    """
+    Test that uploaded URLs are kept across instances until the manifest
+    is removed.
+    """
+    path = str(tmp_path / "upload_test.jsonl")
+    manifest = UploadManifest(path)
+    manifest.add(["https://blob/a.png", "https://blob/b.png"])
+
+    resumed = UploadManifest(path)
+    assert "https://blob/a.png" in resumed
+    assert "https://blob/c.png" not in resumed
+
+    resumed.remove()
+    assert not os.path.exists(path)
+    assert len(UploadManifest(path).uploaded) == 0
+
+
+def test_upload_manifest_keeps_only_failed_urls(tmp_path):
+    """
+    Test that a finished upload with failures skips nothing next time, and
+    that deleted images leave no manifest behind.
+    """
+    path = str(tmp_path / "upload_test.jsonl")
+    manifest = UploadManifest(path)
+    manifest.add(["https://blob/a.png", "https://blob/b.png"])
+    manifest.finish({"https://blob/c.png"})
+
+    resumed = UploadManifest(path)
+    assert "https://blob/a.png" not in resumed
+    assert resumed.failed == {"https://blob/c.png"}
+
+    remove_manifests(str(tmp_path))
+    assert not os.path.exists(path)
+
+
+def test_upload_manifest_appends_batches(tmp_path):
+    """
+    Test that every batch appends one line, and that a line cut short by a
+    crash is skipped when resuming.
+    """
+    path = str(tmp_path / "upload_test.jsonl")
+    manifest = UploadManifest(path)
+    manifest.add(["https://blob/a.png"])
+    manifest.add(["https://blob/b.png"])
+    with open(path) as f:
+        assert len(f.readlines()) == 2
+    with open(path, "a") as f:
+        f.write('{"uploaded": ["https://blob/c.p')
+
+    resumed = UploadManifest(path)
+    assert resumed.uploaded == {"https://blob/a.png", "https://blob/b.png"}
+    resumed.add(["https://blob/c.png"])
+    assert "https://blob/c.png" in UploadManifest(path)
+
+
+class FakeTrainer:
+    """
+    Classifier whose training runs until it is cancelled.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+        self.training = Event()
+        self.deleted = 0
+
+    def delete_all_images(self):
+        self.deleted += 1
+
+    def app_context(self):
+        return self.app.app_context()
+
+    def retrain(self, job):
+        job.update("iteration-id", "Training")
+        self.training.set()
+        while not job.wait(0.01):
+            pass
+
+    hard_reset_retrain = retrain
+
+
+def test_training_manager_runs_one_job_at_a_time(app_instance):
+    """
+    Test that a second job is rejected, without deleting any images, while
+    one runs, and that a cancelled job is stored as cancelled.
+    """
+    models.create_tables(app_instance)
+    fake = FakeTrainer(app_instance)
+    training = TrainingManager(fake)
+    job = training.start("retrain")
+    assert fake.training.wait(5)
+    with pytest.raises(excp.Conflict):
+        training.start("hardReset")
+    assert fake.deleted == 0
+    assert training.status()["iteration_status"] == "Training"
+
+    assert training.cancel()
+    for _ in range(500):
+        if job.state != TrainingJob.RUNNING:
+            break
+        time.sleep(0.01)
+
+    with app_instance.app_context():
+        stored = models.get_latest_training_job()
+    assert stored.job_id == job.job_id
+    assert stored.state == TrainingJob.CANCELLED
+    assert training.status()["state"] == TrainingJob.CANCELLED
+    assert not training.cancel()
+
+
+def test_classify_images_by_label_stops_when_enough_examples(
+    classifier, monkeypatch
+):
+    """
+    Test that mining returns confident and correct examples only, and
+    stops predicting once enough examples are found.
+    """
+    blobs = [SimpleNamespace(name=f"bird/{i}.png") for i in range(500)]
+    container = SimpleNamespace(
+        list_blobs=lambda name_starts_with: list(blobs),
+        get_blob_client=lambda blob: SimpleNamespace(url=blob.name),
+    )
+    monkeypatch.setattr(
+        classifier.blob_service_client,
+        "get_container_client",
+        lambda name: container,
+    )
+    calls = []
+
+    def predict_image_url(url, priority):
+        assert priority == RateLimiter.BATCH
+        calls.append(url)
+        number = int(url.split("/")[1].split(".")[0])
+        if number % 2 == 0:
+            return {"bird": 0.9, "tree": 0.1}, "bird"
+        return {"bird": 0.2, "tree": 0.8}, "tree"
+
+    monkeypatch.setattr(classifier, "predict_image_url", predict_image_url)
+    classifier.iteration_name = TestValues.CV_ITERATION_NAME
+    images = classifier.classify_images_by_label("bird", 5)
+
+    assert len(images) == 5
+    assert all(int(image[5:-4]) % 2 == 0 for image in images)
+    assert len(calls) < len(blobs)
+
+
+def test_latency_histogram_quantiles_are_precise():
+    """
+    Test that histogram quantiles are within the precision of the buckets.
+    """
+    histogram = LatencyHistogram(precision_bits=5)
+    for ms in range(1, 1001):
+        histogram.record(ms / 1000)
+    assert histogram.count == 1000
+    assert histogram.quantile(0.5) == pytest.approx(0.5, rel=1 / 32)
+    assert histogram.quantile(0.99) == pytest.approx(0.99, rel=1 / 32)
+    assert histogram.quantile(1) == 1.0
+
+
+def test_latency_histogram_error_bound():
+    """
+    Test that every power of two has 2^precision_bits buckets, so buckets
+    are at most 2^-precision_bits times as wide as the values in them.
+    """
+    precision_bits = 5
+    lowers = set()
+    for micros in range(1024, 2048):
+        histogram = LatencyHistogram(precision_bits=precision_bits)
+        histogram.record(micros / 1e6)
+        lowers.update(histogram.counts)
+    assert len(lowers) == 2**precision_bits
+
+    for micros in range(1, 1 << 22, 997):
+        histogram = LatencyHistogram(precision_bits=precision_bits)
+        histogram.record(micros / 1e6)
+        recorded = int(micros / 1e6 * 1e6)
+        (lower,) = histogram.counts
+        width = 1 << histogram._shift(lower)
+        assert lower <= recorded < lower + width
+        if width > 1:
+            # small values have a bucket of their own and no error
+            assert width / recorded <= 2**-precision_bits
+
+
+def test_prediction_metrics_count_outcomes():
+    """
+    Test that predictions are counted by outcome and exported to
+    Prometheus.
+    """
+    metrics = PredictionMetrics()
+    with metrics.measure("singleplayer", "local", "model") as measurement:
+        measurement.done("local", ({"bird": 0.9, "tree": 0.1}, "bird"))
+    with metrics.measure("singleplayer", "local", "model") as measurement:
+        measurement.done("cache", ({"bird": 0.4, "tree": 0.6}, "tree"))
+    with pytest.raises(PredictionUnavailable):
+        with metrics.measure("multiplayer", "local", "model"):
+            raise PredictionUnavailable("down")
+
+    snapshot = metrics.snapshot()
+    outcomes = dict(
+        ((row["endpoint"], row["backend"]), row["outcomes"])
+        for row in snapshot
+    )
+    assert outcomes[("singleplayer", "local")] == {"confident": 1}
+    assert outcomes[("singleplayer", "cache")] == {"uncertain": 1}
+    assert outcomes[("multiplayer", "local")] == {"unavailable": 1}
+    text = metrics.prometheus()
+    assert (
+        'predictions_total{endpoint="multiplayer",backend="local",'
+        'iteration="model",outcome="unavailable"} 1'
+    ) in text
+    assert "# TYPE prediction_latency_seconds summary" in text
+
+
+def test_evaluate_reports_accuracy_and_latency(local_predictor, tmp_path):
+    """
+    Test that the evaluation predicts every image of a labelled directory.
+    """
+    for label in TestValues.LABELS:
+        os.makedirs(tmp_path / "images" / label)
+        for i in range(3):
+            Image.new("L", (64, 64), 255).save(
+                tmp_path / "images" / label / f"{i}.png"
+            )
+
+    dataset = load_dataset(str(tmp_path / "images"), limit=2)
+    report = evaluate(local_predictor, "model", dataset, workers=4)
+
+    assert report["images"] == 2 * len(TestValues.LABELS)
+    assert report["errors"] == 0
+    assert set(report["labels"]) == set(TestValues.LABELS)
+    # a blank image gets the same guess whatever its label
+    assert report["accuracy"] == pytest.approx(1 / 3)
+    latency = report["latency"]
+    assert 0 < latency["p50"] <= latency["p95"] <= latency["p99"]
+    assert report["images_per_second"] > 0
+
+
+def test_shadow_predictor_logs_agreement(local_predictor, tmp_path):
+    """
+    Test that sampled images are compared with the candidate in the
+    background and written to the log.
+    """
+    log_path = str(tmp_path / "shadow.log")
+    shadow = ShadowPredictor(
+        local_predictor, "model", 1.0, log_path, workers=1, max_pending=8
+    )
+    image = BytesIO()
+    Image.new("L", (64, 64), 255).save(image, format="PNG")
+    guess = local_predictor.predict(image.getvalue(), "model")
+    best_guess = max(guess, key=guess.get)
+    primary = {"backend": "test", "iteration": "old", "guess": best_guess}
+
+    assert shadow.submit(image.getvalue(), primary, 0.1)
+    shadow._pool.shutdown(wait=True)
+
+    with open(log_path) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 1
+    assert records[0]["agree"]
+    assert records[0]["shadow_iteration"] == "model"
+    assert shadow.stats()["agreement"] == 1.0
+
+
+def test_shadow_predictor_follows_the_live_iteration(tmp_path):
+    """
+    Test that a candidate without its own iteration predicts with the live
+    iteration name at the time of each prediction.
+    """
+    iterations = []
+    predictor = SimpleNamespace(
+        name="customvision",
+        predict=lambda image, name: iterations.append(name) or {"bird": 1.0},
+    )
+    live = [None]
+    shadow = ShadowPredictor(
+        predictor, lambda: live[0], 1.0, str(tmp_path / "shadow.log"), 1, 8
+    )
+    primary = {"backend": "test", "iteration": "old", "guess": "bird"}
+    for name in ["Iteration1", "Iteration2"]:
+        live[0] = name
+        assert shadow.submit(b"", primary, 0.1)
+        for _ in range(500):
+            if shadow.stats()["pending"] == 0:
+                break
+            time.sleep(0.01)
+
+    assert iterations == ["Iteration1", "Iteration2"]
+    assert shadow.stats()["iteration"] == "Iteration2"
+    assert shadow.stats()["errors"] == 0
+
+
+def test_shadow_predictor_skips_unsampled_images(local_predictor, tmp_path):
+    """
+    Test that no image is sent to the candidate with a fraction of 0.
+    """
+    shadow = ShadowPredictor(
+        local_predictor, "model", 0.0, str(tmp_path / "shadow.log"), 1, 8
+    )
+    primary = {"backend": "test", "iteration": "old", "guess": "bird"}
+    assert not shadow.submit(b"", primary, 0.1)
+    assert shadow.stats()["sent"] == 0
+
+
+def test_parse_strokes_accepts_quickdraw_format():
+    """
+    Test that strokes are accepted as a list or a json string.
+    """
+    drawing = [[[0, 10, 20], [0, 5, 0]], [[3], [4]]]
+    assert parse_strokes(drawing) == [([0, 10, 20], [0, 5, 0]), ([3], [4])]
+    assert parse_strokes(json.dumps(drawing)) == parse_strokes(drawing)
+    assert parse_strokes([]) == []
+
+
+@pytest.mark.parametrize(
+    "drawing",
+    ["not json", {"x": 1}, [[[0, 1], [0]]], [[["a"], ["b"]]], [[[], []]]],
+)
+def test_parse_strokes_rejects_malformed_strokes(drawing):
+    """
+    Test that malformed strokes raise a UserError.
+    """
+    with pytest.raises(UserError):
+        parse_strokes(drawing)
+
+
+@pytest.mark.skipif(strokes.cairo is None, reason="cairo is not installed")
+def test_rasterize_strokes_at_model_resolution():
+    """
+    Test that strokes are drawn black on white at model resolution.
+    """
+    rasterizer = StrokeRasterizer()
+    png = rasterizer.rasterize(parse_strokes([[[0, 100], [0, 100]]]))
+    img = Image.open(BytesIO(png)).convert("L")
+    resolution = setup.MODEL_RESOLUTION
+    assert img.size == (resolution, resolution)
+    assert img.getpixel((resolution // 2, resolution // 2)) < 128
+    assert img.getpixel((0, resolution - 1)) == 255
+    blank = Image.open(BytesIO(rasterizer.rasterize([]))).convert("L")
+    assert blank.getextrema() == (255, 255)
+
+
+def test_stroke_canvases_accumulate_deltas_per_player():
+    """
+    Test that stroke deltas are added to the drawing of each player until
+    it is reset or freed.
+    """
+    canvases = StrokeCanvases()
+    first = parse_strokes([[[0, 10], [0, 10]]])
+    second = parse_strokes([[[5], [5]]])
+    assert canvases.add("player1", first) == first
+    assert canvases.add("player1", second) == first + second
+    assert canvases.add("player2", second) == second
+    assert canvases.add("player1", second, reset=True) == second
+
+    canvases.clear("player1")
+    canvases.clear("unknown")
+    assert len(canvases) == 1
+    assert canvases.add("player1", []) == []
+
+
+def test_stroke_canvases_limit_points(monkeypatch):
+    """
+    Test that a drawing can not grow beyond MAX_STROKE_POINTS.
+    """
+    monkeypatch.setattr("src.utilities.setup.MAX_STROKE_POINTS", 3)
+    canvases = StrokeCanvases()
+    canvases.add("player1", parse_strokes([[[0, 1], [0, 1]]]))
+    with pytest.raises(UserError):
+        canvases.add("player1", parse_strokes([[[0, 1], [0, 1]]]))
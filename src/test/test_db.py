@@ -237,3 +237,67 @@ def test_high_score_cleared(app_instance):
         num_records = models.Scores.query.count()
 
     assert num_records == 0
+
+
+def test_uploaded_images_ledger(app_instance):
+    """
+    Check that uploaded blobs are recorded per container, once, until the
+    ledger is cleared.
+    """
+    with app_instance.app_context():
+        models.create_tables(app_instance)
+        models.insert_into_uploaded_images("new", ["cat/1.png", "cat/2.png"])
+        models.insert_into_uploaded_images("new", ["cat/2.png"])
+        uploaded = models.get_uploaded_images("new")
+        other_container = models.get_uploaded_images("original")
+        models.clear_uploaded_images()
+        cleared = models.get_uploaded_images("new")
+
+    assert uploaded == {"cat/1.png", "cat/2.png"}
+    assert other_container == set()
+    assert cleared == set()
+
+
+def test_image_counts(app_instance):
+    """
+    Check that image counts are added per label, and replaced when reset,
+    and that an empty container is told apart from an uncounted one.
+    """
+    with app_instance.app_context():
+        models.create_tables(app_instance)
+        uncounted = models.get_image_counts("counted")
+        models.set_image_counts("counted", {})
+        empty = models.get_image_counts("counted")
+        models.increment_image_counts("counted", {"cat": 2, "dog": 1})
+        models.increment_image_counts("counted", {"cat": 3})
+        counts = models.get_image_counts("counted")
+        models.set_image_counts("counted", {"cat": 1})
+        reset = models.get_image_counts("counted")
+
+    assert uncounted is None
+    assert empty == {}
+    assert counts == {"cat": 5, "dog": 1}
+    assert reset == {"cat": 1}
+
+
+def test_end_round_for_player_only_once(app_instance):
+    """
+    Check that a round is ended once, even if several requests try to end
+    it.
+    """
+    with app_instance.app_context():
+        game = models.get_game(TestValues.GAME_ID)
+        session_num = game.session_num
+        first = models.end_round_for_player(
+            TestValues.GAME_ID, TestValues.PLAYER_ID, session_num
+        )
+        second = models.end_round_for_player(
+            TestValues.GAME_ID, TestValues.PLAYER_ID, session_num
+        )
+        game = models.get_game(TestValues.GAME_ID)
+        player = models.get_player(TestValues.PLAYER_ID, refresh=True)
+
+    assert first
+    assert not second
+    assert game.session_num == session_num + 1
+    assert player.state == "Done"
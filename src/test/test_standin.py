@@ -0,0 +1,171 @@
+import os
+import pytest
+from azure.storage.blob import BlobServiceClient
+from customvision.classifier import Classifier
+from src import models
+from src import storage
+from src.standin import StandIn
+from utilities import setup
+from test.conftest import TestValues, get_data_folder_path
+
+
+@pytest.fixture
+def standin(tmp_path, monkeypatch):
+    """
+    run the stand-in server and point the keys at it.
+    """
+    with StandIn(
+        str(tmp_path),
+        labels=TestValues.LABELS,
+        iteration_name=setup.DEFAULT_ITERATION_NAME,
+        seed=0,
+    ) as server:
+        for key, value in server.keys().items():
+            monkeypatch.setenv(key, value)
+        yield server
+
+
+def read_test_image():
+    path = os.path.join(get_data_folder_path(), TestValues.CV_TEST_IMAGE)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_standin_predictions_are_deterministic(standin):
+    """
+    Test that the Custom Vision client gets the same predictions for the
+    same image from the stand-in.
+    """
+    classifier = Classifier()
+    iteration_name = classifier.get_published_iteration_name()
+    assert iteration_name == setup.DEFAULT_ITERATION_NAME
+
+    image = read_test_image()
+    first = classifier.backend.predict(image, iteration_name)
+    second = classifier.backend.predict(image, iteration_name)
+    assert first == second
+    assert set(first) == set(TestValues.LABELS)
+    assert sum(first.values()) == pytest.approx(1.0)
+
+
+def test_standin_trains_and_publishes_iterations(standin):
+    """
+    Test that images can be added, trained and published through the
+    training client.
+    """
+    classifier = Classifier()
+    project_id = classifier.project_id
+    trainer = classifier.trainer
+    tag = trainer.get_tags(project_id)[0]
+    assert tag.name in TestValues.LABELS
+
+    from azure.cognitiveservices.vision.customvision.training.models import (
+        ImageUrlCreateBatch,
+        ImageUrlCreateEntry,
+    )
+
+    batch = ImageUrlCreateBatch(
+        images=[ImageUrlCreateEntry(url="http://a/b.png", tag_ids=[tag.id])]
+    )
+    summary = trainer.create_images_from_urls(project_id, batch)
+    assert summary.is_batch_successful
+    summary = trainer.create_images_from_urls(project_id, batch)
+    assert summary.images[0].status == "OKDuplicate"
+
+    iteration = trainer.train_project(project_id)
+    assert trainer.get_iteration(project_id, iteration.id).status == (
+        "Completed"
+    )
+    trainer.publish_iteration(project_id, iteration.id, "Iteration9", "x")
+    assert classifier.get_published_iteration_name() == "Iteration9"
+
+
+def test_standin_stores_blobs_on_disk(standin, tmp_path, app_instance):
+    """
+    Test that storage.py saves and reads images from the stand-in, and
+    counts them.
+    """
+    storage.reset_image_counts(setup.CONTAINER_NAME_NEW)
+    client = BlobServiceClient.from_connection_string(
+        standin.keys()["BLOB_CONNECTION_STRING"]
+    )
+    client.create_container(
+        setup.CONTAINER_NAME_NEW, metadata={"image_count": "0"}
+    )
+    image = read_test_image()
+    url = storage.save_image(image, "bird", 1.0)
+    assert storage.get_upload_queue().flush(timeout=10)
+    assert url.startswith(standin.keys()["BASE_BLOB_URL"])
+
+    assert storage.image_count(setup.CONTAINER_NAME_NEW) == 1
+    assert storage.get_image_counter().flush()
+    assert models.get_image_counts(setup.CONTAINER_NAME_NEW) == {"bird": 1}
+
+    container = storage.blob_connection(setup.CONTAINER_NAME_NEW)
+    blobs = list(container.list_blobs(name_starts_with="bird/"))
+    assert len(blobs) == 1
+    assert blobs[0].content_settings.content_type == "image/png"
+    data = container.get_blob_client(blobs[0]).download_blob().readall()
+    assert data == image
+    assert (tmp_path / setup.CONTAINER_NAME_NEW / "bird").is_dir()
+
+
+def test_standin_blob_clients_are_shared(standin):
+    """
+    Test that storage.py and the Classifier share one Blob client, which
+    keeps its connections alive between requests.
+    """
+    classifier = Classifier()
+    assert classifier.blob_service_client is storage.get_blob_service_client()
+    container = storage.blob_connection(setup.CONTAINER_NAME_NEW)
+    assert storage.blob_connection(setup.CONTAINER_NAME_NEW) is container
+
+    before = storage.blob_client_stats()
+    container.create_container()
+    for _ in range(5):
+        list(container.list_blobs())
+    stats = storage.blob_client_stats()
+    assert stats["connections"]["requests"] >= 6
+    assert stats["connections"]["opened"] <= 1
+    assert stats["requests"]["GET"]["count"] >= (
+        before["requests"].get("GET", {"count": 0})["count"] + 5
+    )
+    assert stats["requests"]["PUT"]["statuses"]["201"] >= 1
+
+
+def test_standin_example_images_are_cached(standin, tmp_path, monkeypatch):
+    """
+    Test that example images are downloaded once, and then served without
+    requests to Blob Storage.
+    """
+    monkeypatch.setattr(
+        "src.utilities.setup.EXAMPLE_IMAGE_CACHE_DIR", str(tmp_path / "cache")
+    )
+    monkeypatch.setattr(storage, "_example_image_cache", None)
+    container = storage.blob_connection(setup.CONTAINER_NAME_ORIGINAL)
+    container.create_container()
+    image = read_test_image()
+    container.upload_blob("bird/1.png", image)
+
+    first = storage.get_images_from_relative_url(["bird/1.png"])
+    requests = storage.blob_client_stats()["connections"]["requests"]
+    second = storage.get_images_from_relative_url(["bird/1.png"])
+    assert first == second
+    assert storage.blob_client_stats()["connections"]["requests"] == requests
+    stats = storage.get_example_image_cache().stats()
+    assert stats["misses"] == 1
+    assert stats["memory_hits"] == 1
+
+
+def test_standin_injects_errors(standin):
+    """
+    Test that injected errors reach the client.
+    """
+    classifier = Classifier()
+    classifier.predictor.config.retry_policy.retries = 0
+    standin.configure(error_rate=1.0)
+    with pytest.raises(Exception):
+        classifier.backend.predict(
+            read_test_image(), setup.DEFAULT_ITERATION_NAME
+        )
+    assert standin.injected_errors == 1
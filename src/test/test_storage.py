@@ -0,0 +1,162 @@
+import os
+import time
+from utilities.image_cache import ImageCache
+from utilities.image_counter import ImageCounter
+from utilities.upload_queue import UploadQueue
+
+
+def create_queue(upload, spool_dir, **kwargs):
+    options = {
+        "max_size": 8,
+        "batch_size": 4,
+        "batch_wait": 0.05,
+        "retries": 1,
+        "retry_interval": 0.01,
+        "spool_interval": 60,
+    }
+    options.update(kwargs)
+    return UploadQueue(upload, str(spool_dir), **options)
+
+
+def test_upload_queue_uploads_in_batches(tmp_path):
+    """
+    Test that queued images are uploaded in batches in the background.
+    """
+    batches = []
+
+    def upload(entries):
+        batches.append([entry.name for entry in entries])
+        return []
+
+    queue = create_queue(upload, tmp_path).start()
+    for i in range(6):
+        queue.put("new", f"bird/{i}.png", b"image")
+    assert queue.flush(timeout=5)
+    assert sorted(sum(batches, [])) == [f"bird/{i}.png" for i in range(6)]
+    assert all(len(batch) <= 4 for batch in batches)
+    assert len(batches) < 6
+    assert queue.stats()["depth"] == 0
+    assert queue.stats()["uploaded"] == 6
+    queue.close()
+
+
+def test_upload_queue_spools_failed_uploads(tmp_path):
+    """
+    Test that images are spooled to disk while uploads fail, and uploaded
+    from the spool once uploads succeed again.
+    """
+    uploaded = []
+    down = [True]
+
+    def upload(entries):
+        if down[0]:
+            raise ConnectionError("Blob Storage is down")
+        uploaded.extend(entry.name for entry in entries)
+        return []
+
+    queue = create_queue(upload, tmp_path).start()
+    queue.put("new", "bird/1.png", b"first")
+    assert queue.flush(timeout=5)
+    spooled = tmp_path / "new" / "bird" / "1.png"
+    assert spooled.read_bytes() == b"first"
+    assert queue.stats()["spooled"] == 1
+
+    down[0] = False
+    queue.put("new", "bird/2.png", b"second")
+    deadline = time.monotonic() + 5
+    while len(uploaded) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(uploaded) == ["bird/1.png", "bird/2.png"]
+    assert queue.flush(timeout=5)
+    assert not spooled.exists()
+    queue.close()
+
+
+def test_upload_queue_spools_images_put_after_close(tmp_path):
+    """
+    Test that closing the queue uploads the queued images, and images
+    saved afterwards are spooled instead of lost.
+    """
+    uploaded = []
+
+    def upload(entries):
+        uploaded.extend(entry.name for entry in entries)
+        return []
+
+    queue = create_queue(upload, tmp_path).start()
+    queue.put("new", "bird/1.png", b"image")
+    queue.close(timeout=5)
+    assert uploaded == ["bird/1.png"]
+    queue.put("new", "bird/2.png", b"image")
+    assert os.path.isfile(tmp_path / "new" / "bird" / "2.png")
+    assert queue.stats()["closed"]
+
+
+def test_image_counter_aggregates_and_keeps_failed_counts():
+    """
+    Test that counts are summed per label until flushed, and kept for the
+    next flush if they could not be stored.
+    """
+    stored = []
+    down = [True]
+
+    def store(container_name, counts):
+        if down[0]:
+            raise Exception("database unavailable")
+        stored.append((container_name, counts))
+
+    counter = ImageCounter(store, 60)
+    counter.add("new", "bird", 2)
+    counter.add("new", "bird")
+    counter.add("new", "cat")
+    assert counter.pending("new") == {"bird": 3, "cat": 1}
+    assert not counter.flush()
+    assert counter.pending("new") == {"bird": 3, "cat": 1}
+
+    down[0] = False
+    counter.add("new", "cat")
+    assert counter.flush()
+    assert stored == [("new", {"bird": 3, "cat": 2})]
+    assert counter.pending("new") == {}
+    counter.add("new", "bird")
+    counter.discard("new")
+    counter.close()
+    assert len(stored) == 1
+
+
+def test_image_cache_serves_memory_then_disk(tmp_path):
+    """
+    Test that images are fetched once, served from memory, and from disk
+    after they are evicted or the process restarts.
+    """
+    fetched = []
+
+    def fetch(name):
+        fetched.append(name)
+        return name.encode() * 10
+
+    cache = ImageCache(250, str(tmp_path))
+    assert cache.get("bird/1.png", fetch) == b"bird/1.png" * 10
+    assert cache.get("bird/1.png", fetch) == b"bird/1.png" * 10
+    assert fetched == ["bird/1.png"]
+    assert cache.stats()["memory_hits"] == 1
+
+    cache = ImageCache(250, str(tmp_path))
+    cache.get("bird/1.png", fetch)
+    cache.get("bird/2.png", fetch)
+    cache.get("bird/3.png", fetch)
+    assert cache.stats()["size"] == 2
+    assert cache.stats()["bytes"] == 200
+    cache.get("bird/1.png", fetch)
+    assert fetched == ["bird/1.png", "bird/2.png", "bird/3.png"]
+    assert cache.stats()["disk_hits"] == 2
+    assert (tmp_path / "bird" / "3.png").read_bytes() == b"bird/3.png" * 10
+
+
+def test_image_cache_keeps_names_inside_cache_dir(tmp_path):
+    """
+    Test that blob names cannot write outside of the disk tier.
+    """
+    cache = ImageCache(100, str(tmp_path / "cache"))
+    assert cache.get("../escaped.png", lambda name: b"image") == b"image"
+    assert not (tmp_path / "escaped.png").exists()
@@ -362,6 +362,24 @@ def test_classification_both_timeout(test_clients):
     assert len(r2) == 1
 
 
+def test_invalid_top_k_emits_error(test_clients):
+    _, ws_client1, ws_client2 = test_clients
+    ws_client1.emit("joinGame", '{"difficulty_id": 1}')
+    ws_client2.emit("joinGame", '{"difficulty_id": 1}')
+    r1 = ws_client1.get_received()
+    ws_client2.get_received()
+    game_id = r1[0]["args"][0]["game_id"]
+    data = {"game_id": game_id, "time_left": 1, "lang": "NO", "top_k": "a"}
+
+    for event in ["classifyStrokes", "classifyStrokeDelta"]:
+        ws_client1.emit(event, data, [])
+
+        r1 = ws_client1.get_received()
+        assert r1[0]["name"] == "error"
+        assert "top_k" in r1[0]["args"][0]
+        assert ws_client2.get_received() == []
+
+
 def test_players_not_with_same_playerid(test_clients):
     """TODO: implement me"""
     _, ws_client1, ws_client2 = test_clients
@@ -0,0 +1,39 @@
+"""
+    Truncation of the certainty returned by the classify endpoints. The
+    model returns a probability for every label, while the client only
+    shows the most likely guesses.
+"""
+
+from werkzeug import exceptions as excp
+
+
+def parse_top_k(value, exc_type=excp.BadRequest):
+    """
+    Reads the top_k parameter of a classify request. Returns None if the
+    full distribution is requested. An invalid value raises exc_type, e.g.
+    UserError on socket events, where BadRequest never reaches the client.
+    """
+    if value is None or value == "":
+        return None
+    try:
+        top_k = int(value)
+    except (TypeError, ValueError):
+        raise exc_type("top_k has to be a positive integer")
+    if top_k < 1:
+        raise exc_type("top_k has to be a positive integer")
+    return top_k
+
+
+def truncate_certainty(certainty, top_k, correct_label):
+    """
+    Keeps the top_k most likely labels, and the probability of the correct
+    label even if it is not among them. Returns the certainty unchanged if
+    top_k is None.
+    """
+    if top_k is None or len(certainty) <= top_k:
+        return certainty
+    # a heap is not worth it for a few hundred labels
+    labels = sorted(certainty, key=certainty.get, reverse=True)[:top_k]
+    if correct_label in certainty and correct_label not in labels:
+        labels.append(correct_label)
+    return dict([(label, certainty[label]) for label in labels])
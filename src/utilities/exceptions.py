@@ -15,3 +15,10 @@ class UserError(Exception):
         """
         self.message = message
         super().__init__(self.message)
+
+
+class PredictionUnavailable(Exception):
+    """
+    This error is raised when no prediction backend can classify an image,
+    e.g. while the circuit breaker of Custom Vision is open.
+    """
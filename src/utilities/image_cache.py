@@ -0,0 +1,134 @@
+"""
+    Two-tier cache for example drawings. The example images are a fixed set
+    of blobs that never change, so once downloaded they are kept in memory
+    and on local disk, and served without requests to Blob Storage.
+"""
+
+import logging
+import os
+from collections import OrderedDict
+from threading import Lock
+
+
+class ImageCache:
+    """
+    Least recently used memory tier of at most max_bytes bytes, backed by
+    a disk tier in cache_dir holding every image ever fetched. Images
+    evicted from memory are read from disk again on the next request, and
+    only images in neither tier are fetched.
+    """
+
+    def __init__(self, max_bytes: int, cache_dir: str) -> None:
+        """
+        Parameters:
+        max_bytes: size of the memory tier, 0 keeps images on disk only
+        cache_dir: directory of the disk tier, None keeps images in memory
+        """
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, name: str, fetch) -> bytes:
+        """
+        Returns the image with the given blob name, calling fetch(name) if
+        it is not cached.
+        """
+        with self._lock:
+            data = self._entries.get(name)
+            if data is not None:
+                self._entries.move_to_end(name)
+                self.memory_hits += 1
+                return data
+
+        data = self._read(name)
+        if data is not None:
+            with self._lock:
+                self.disk_hits += 1
+        else:
+            data = fetch(name)
+            with self._lock:
+                self.misses += 1
+            self._write(name, data)
+        self._remember(name, data)
+        return data
+
+    def _remember(self, name, data) -> None:
+        """
+        Adds the image to the memory tier, evicting the least recently used
+        images to stay within max_bytes.
+        """
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(name, None)
+            if previous is not None:
+                self._bytes -= len(previous)
+            self._entries[name] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def _path(self, name):
+        """
+        Returns the path of the image in the disk tier, or None if there is
+        no disk tier or the name points outside of it.
+        """
+        if self.cache_dir is None:
+            return None
+        root = os.path.abspath(self.cache_dir)
+        path = os.path.normpath(os.path.join(root, name))
+        if not path.startswith(root + os.sep):
+            return None
+        return path
+
+    def _read(self, name):
+        path = self._path(name)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write(self, name, data) -> None:
+        path = self._path(name)
+        if path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # written under a unique name, other threads may fetch it too
+            tmp_path = f"{path}.{os.getpid()}.{id(data)}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Could not cache image {name}: {e}")
+
+    def clear(self) -> None:
+        """
+        Empties the memory tier. The disk tier is kept.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        """
+        Returns the size of the memory tier and the hit and miss counters.
+        """
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,93 @@
+"""
+    Aggregated counts of saved images. Increments are summed in memory and
+    stored by a background thread every interval seconds, instead of a
+    read-modify-write of the container metadata for every image.
+"""
+
+import logging
+from threading import Event, Lock, Thread
+
+
+class ImageCounter:
+    """
+    Counts images per container and label. store(container_name, counts)
+    adds a dictionary from label to number of new images to the stored
+    counts. Counts that could not be stored are kept for the next flush.
+    """
+
+    def __init__(self, store, interval) -> None:
+        self.store = store
+        self.interval = interval
+        self._pending = {}
+        self._flushing = {}
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+
+    def start(self) -> "ImageCounter":
+        self._thread = Thread(
+            target=self._run, name="image-counter", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def add(self, container_name, label, count=1) -> None:
+        with self._lock:
+            counts = self._pending.setdefault(container_name, {})
+            counts[label] = counts.get(label, 0) + count
+
+    def pending(self, container_name) -> dict:
+        """
+        Returns the counts of the container that are not stored yet.
+        """
+        with self._lock:
+            pending = {}
+            for counts in (self._flushing, self._pending):
+                for label, count in counts.get(container_name, {}).items():
+                    pending[label] = pending.get(label, 0) + count
+            return pending
+
+    def discard(self, container_name) -> None:
+        """
+        Forgets the counts of the container, when it is emptied.
+        """
+        with self._lock:
+            self._pending.pop(container_name, None)
+
+    def flush(self) -> bool:
+        """
+        Stores the pending counts. Returns False if some could not be
+        stored.
+        """
+        with self._flush_lock:
+            with self._lock:
+                self._flushing, self._pending = self._pending, {}
+            stored = True
+            for container_name, counts in self._flushing.items():
+                try:
+                    self.store(container_name, counts)
+                except Exception as e:
+                    logging.warning("Could not store image counts: " + str(e))
+                    stored = False
+                    with self._lock:
+                        pending = self._pending.setdefault(container_name, {})
+                        for label, count in counts.items():
+                            pending[label] = pending.get(label, 0) + count
+            with self._lock:
+                self._flushing = {}
+            return stored
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.flush()
+
+    def close(self) -> None:
+        """
+        Stops the background thread and stores the pending counts.
+        Called at exit, after the upload queue is drained.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
@@ -0,0 +1,58 @@
+"""
+    Pooled HTTP sessions for the Azure clients. By default msrest closes its
+    session after every call and keeps one session per thread (one per
+    greenlet under gevent), so a new TLS connection is opened for every
+    request to Custom Vision.
+"""
+
+from types import SimpleNamespace
+import requests
+from requests.adapters import HTTPAdapter
+from src.utilities import setup
+
+
+def pooled_session(pool_size=setup.HTTP_POOL_SIZE) -> requests.Session:
+    """
+    Returns a session keeping up to pool_size connections alive per host.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def share_session(client, session: requests.Session) -> None:
+    """
+    Makes a msrest service client (e.g. CustomVisionPredictionClient) send
+    every request through the given session, from all threads, and keep
+    the session open between calls.
+    """
+    client.config.keep_alive = True
+    driver = client.config.pipeline._sender.driver
+    # the driver stores its session in a threading.local, replace it with
+    # a plain namespace so every thread and greenlet uses the same pool
+    driver._session_mapping = SimpleNamespace()
+    driver.session = session
+
+
+def pool_stats(session: requests.Session) -> dict:
+    """
+    Returns the connections opened, idle connections and requests sent by
+    the connection pools of the session, summed over every host.
+    """
+    stats = {"hosts": 0, "opened": 0, "idle": 0, "requests": 0}
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats["hosts"] += 1
+            stats["opened"] += pool.num_connections
+            stats["requests"] += pool.num_requests
+            if pool.pool is not None:
+                stats["idle"] += sum(
+                    1 for conn in list(pool.pool.queue) if conn is not None
+                )
+    return stats
@@ -8,6 +8,9 @@ TOP_N = 10
 NUM_GAMES = 3
 # certainties from costum vision lower than this -> haswon=False
 CERTAINTY_THRESHOLD = 0.7
+# Number of labels in the certainty of a guess when the request has no
+# top_k parameter. None returns the probability of every label
+DEFAULT_TOP_K = None
 # certainty threhold for saving images to BLOB storage for training
 SAVE_CERTAINTY = 0.3
 # custom vision can't have more than 10 iterations at a time, if more
@@ -22,14 +25,161 @@ SESSION_EXPIRATION_TIME = 10
 # Maximum file size and minimum resolution for CV classification
 MAX_IMAGE_SIZE = 4000000
 MIN_RESOLUTION = 256
+# Canvases are cropped to the drawing, with a margin given as a fraction of
+# the drawing size, and scaled to this resolution before prediction
+MODEL_RESOLUTION = 256
+CANVAS_MARGIN = 0.1
+# zlib level used when re-encoding canvases, 1 is the fastest
+PNG_COMPRESSION = 1
+# Width in pixels of strokes rasterized at MODEL_RESOLUTION
+STROKE_WIDTH = 6
+# Maximum number of points in the strokes of one guess
+MAX_STROKE_POINTS = 20000
 # Container names
 CONTAINER_NAME_ORIGINAL = "oldimgcontainer"
 CONTAINER_NAME_NEW = "newimgcontainer"
+# Saved images wait in a queue of UPLOAD_QUEUE_SIZE images, and are uploaded
+# in batches of up to UPLOAD_QUEUE_BATCH_SIZE images, waiting at most
+# UPLOAD_QUEUE_BATCH_WAIT seconds for a batch to fill up
+UPLOAD_QUEUE_SIZE = 256
+UPLOAD_QUEUE_BATCH_SIZE = 16
+UPLOAD_QUEUE_BATCH_WAIT = 0.5
+# Number of retries of a failed upload, and seconds before the first retry.
+# The interval doubles after every retry
+UPLOAD_QUEUE_RETRIES = 3
+UPLOAD_QUEUE_RETRY_INTERVAL = 1
+# Images that could not be uploaded are spooled to this directory, and
+# retried every UPLOAD_SPOOL_INTERVAL seconds while the queue is idle
+UPLOAD_SPOOL_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "spool"
+)
+UPLOAD_SPOOL_INTERVAL = 60
+# Seconds spent uploading the queue at exit, before spooling the rest
+UPLOAD_QUEUE_DRAIN_TIMEOUT = 10
+# Bytes of example drawings kept in memory. Every downloaded example is
+# also kept on disk in EXAMPLE_IMAGE_CACHE_DIR
+EXAMPLE_IMAGE_CACHE_SIZE = 32 * 1024 * 1024
+EXAMPLE_IMAGE_CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "example_cache",
+)
+# Download every example drawing at startup, unless set by the
+# EXAMPLE_IMAGE_PRELOAD key, with EXAMPLE_IMAGE_PRELOAD_WORKERS threads
+EXAMPLE_IMAGE_PRELOAD = False
+EXAMPLE_IMAGE_PRELOAD_WORKERS = 8
+# Seconds between each time the counts of saved images are added to the
+# database
+IMAGE_COUNT_FLUSH_INTERVAL = 10
+# Number of threads listing blobs and submitting image batches to Custom
+# Vision in upload_images()
+UPLOAD_WORKERS = 8
+# Directory of the checkpoints used to resume interrupted uploads
+UPLOAD_MANIFEST_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "customvision",
+    "manifests",
+)
+# Seconds between polls of a training iteration. The interval doubles
+# after every poll, up to TRAINING_POLL_MAX_INTERVAL
+TRAINING_POLL_INTERVAL = 1
+TRAINING_POLL_MAX_INTERVAL = 60
+# Seconds after which a training job still stored as running is assumed
+# to be left behind by a stopped process
+TRAINING_TIMEOUT = 7200
+# Number of threads predicting blobs in classify_images_by_label()
+MINING_WORKERS = 16
+# Probability needed for a correct prediction to become an example image
+EXAMPLE_THRESHOLD = 0.7
+# Latency histograms keep 2^METRICS_PRECISION_BITS buckets per power of
+# two, i.e. a relative error below 2^-METRICS_PRECISION_BITS (about 3 %)
+METRICS_PRECISION_BITS = 5
+# Latency quantiles reported by the admin page and /metrics
+METRICS_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+# Number of concurrent predictions in src/customvision/evaluate.py
+EVALUATION_WORKERS = 8
 # Number of attempt to create a new container, to make sure old container
 # is deleted by Azure.
 CREATE_CONTAINER_TRIES = 10
 # Waiting interval in seconds for creating new container after deletion
 CREATE_CONTAINER_WAITER = 30
+# Iteration used for predictions if Custom Vision can't be reached and no
+# iteration name is stored in the database
+DEFAULT_ITERATION_NAME = "Iteration4"
+# Seconds between each check for a newly published iteration, and between
+# attempts when Custom Vision can't be reached
+ITERATION_REFRESH_INTERVAL = 300
+ITERATION_RETRY_INTERVAL = 30
+# Send a prediction to a newly published iteration before switching to it
+WARM_UP_ITERATION = True
+# Backend used for predictions, either "customvision" or "local". Can be
+# overridden with the PREDICTION_BACKEND key
+PREDICTION_BACKEND = "customvision"
+# Exported model (.npz or .onnx) used by the local prediction backend. Can be
+# overridden with the LOCAL_MODEL_PATH key
+LOCAL_MODEL_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "customvision",
+    "model.npz",
+)
+# Maximum number of images predicted together by the local backend, and the
+# maximum number of seconds an image waits for its batch to fill up
+LOCAL_BATCH_SIZE = 16
+LOCAL_BATCH_WAIT = 0.005
+# Side in pixels of the images given to an .onnx model whose input side is
+# not fixed in the model
+LOCAL_INPUT_SIZE = 28
+# Backend used while the prediction backend is unavailable, None gives the
+# player a DEGRADED_GUESS instead. Can be overridden with the
+# FALLBACK_BACKEND key
+FALLBACK_BACKEND = None
+# Candidate backend that a fraction of the predictions are also sent to in
+# the background, to compare it with the prediction backend. Can be
+# overridden with the SHADOW_BACKEND key, and the SHADOW_ITERATION key
+# selects a candidate iteration. None turns shadowing off
+SHADOW_BACKEND = None
+SHADOW_FRACTION = 0.05
+SHADOW_WORKERS = 2
+# Shadow predictions are dropped when this many are waiting
+SHADOW_MAX_PENDING = 32
+# Append-only log of the comparisons, one json object per line
+SHADOW_LOG_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "customvision",
+    "shadow.log",
+)
+# The guess provided to the user when no backend can classify the image
+DEGRADED_GUESS = "keep drawing"
+# Seconds a prediction may take before it counts as a failure, number of
+# failures in a row before the circuit breaker opens, and seconds before a
+# trial prediction is let through again
+PREDICTION_LATENCY_BUDGET = 2.0
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30
+# Number of times a failed request to Custom Vision prediction is retried
+PREDICTION_RETRIES = 1
+# Requests per second and burst allowed by the Custom Vision resource,
+# shared by predictions, training and uploads. Can be overridden with the
+# CV_RATE_LIMIT key
+CV_RATE_LIMIT = 10
+CV_RATE_BURST = 10
+# Admin and batch requests leave tokens for the live requests expected in
+# the next RATE_LIMIT_LIVE_HEADROOM seconds, measured over the last
+# RATE_LIMIT_WINDOW seconds. Batch requests leave RATE_LIMIT_BATCH_RESERVE
+# more tokens
+RATE_LIMIT_LIVE_HEADROOM = 1.0
+RATE_LIMIT_WINDOW = 5.0
+RATE_LIMIT_BATCH_RESERVE = 2
+# Seconds to stop sending requests after a 429 without Retry-After
+RATE_LIMIT_RETRY_AFTER = 1.0
+# Number of predictions kept in memory, and for how many seconds. Identical
+# canvases are answered from this cache instead of the prediction backend
+PREDICTION_CACHE_SIZE = 1024
+PREDICTION_CACHE_TTL = 300
+# Number of connections kept alive per host by the shared HTTP sessions
+HTTP_POOL_SIZE = 20
+# Number of connections kept alive to Blob Storage by the clients shared by
+# every thread in storage.py, unless set by the BLOB_POOL_SIZE key
+BLOB_POOL_SIZE = 20
 
 
 # Object used to initialize Flask instance
@@ -0,0 +1,264 @@
+"""
+    Write-behind queue for images saved to Blob Storage. Images are queued
+    while the player gets the answer, and uploaded in batches by a
+    background thread. Images that can't be uploaded are spooled to local
+    disk and uploaded once Blob Storage answers again.
+"""
+
+import collections
+import logging
+import os
+import time
+from threading import Condition, Thread
+
+
+class UploadEntry:
+    """
+    An image waiting to be uploaded as the blob name in the container.
+    """
+
+    def __init__(self, container, name, data, queued=None, spool_path=None):
+        self.container = container
+        self.name = name
+        self.data = data
+        self.queued = time.time() if queued is None else queued
+        # the copy on disk, if the entry has been spooled
+        self.spool_path = spool_path
+
+
+class UploadQueue:
+    """
+    Bounded queue uploaded by one background thread. upload(entries) is
+    called with up to batch_size entries, waiting at most batch_wait seconds
+    for a batch to fill up, and returns the entries that failed. Failed
+    entries are retried with a doubling interval, and spooled to spool_dir
+    after the last retry. put() never blocks: when the queue is full, the
+    entry goes straight to the spool. Spooled entries are queued again at
+    start, when an upload succeeds, and every spool_interval seconds while
+    the queue is idle.
+    """
+
+    def __init__(
+        self,
+        upload,
+        spool_dir,
+        max_size,
+        batch_size,
+        batch_wait,
+        retries,
+        retry_interval,
+        spool_interval,
+    ) -> None:
+        self.upload = upload
+        self.spool_dir = spool_dir
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.retries = retries
+        self.retry_interval = retry_interval
+        self.spool_interval = spool_interval
+        self.uploaded = 0
+        self.retried = 0
+        self.spooled = 0
+        self._queue = collections.deque()
+        self._in_flight = []
+        self._spool_pending = True
+        self._closed = False
+        self._condition = Condition()
+        self._thread = None
+
+    def start(self) -> "UploadQueue":
+        self._thread = Thread(
+            target=self._run, name="upload-queue", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def put(self, container, name, data) -> None:
+        """
+        Queues data to be uploaded as the blob name in the container.
+        """
+        entry = UploadEntry(container, name, data)
+        with self._condition:
+            if not self._closed and len(self._queue) < self.max_size:
+                self._queue.append(entry)
+                self._condition.notify_all()
+                return
+        self._spool(entry)
+
+    def _run(self) -> None:
+        self._unspool()
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            failed = self._upload(batch) if batch else []
+            for entry in failed:
+                self._spool(entry)
+            with self._condition:
+                self._in_flight = []
+                self.uploaded += len(batch) - len(failed)
+                self._condition.notify_all()
+            if len(failed) == 0:
+                self._unspool()
+
+    def _next_batch(self):
+        """
+        Waits for entries and returns the next batch, an empty batch if the
+        queue stayed idle for spool_interval seconds, or None when the queue
+        is closed and empty.
+        """
+        with self._condition:
+            while len(self._queue) == 0:
+                if self._closed:
+                    return None
+                if not self._condition.wait(self.spool_interval):
+                    return []
+            deadline = time.monotonic() + self.batch_wait
+            while len(self._queue) < self.batch_size and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            size = min(self.batch_size, len(self._queue))
+            self._in_flight = [self._queue.popleft() for _ in range(size)]
+            return list(self._in_flight)
+
+    def _upload(self, batch) -> list:
+        """
+        Uploads the batch, retrying the failed entries. Returns the entries
+        that failed after the last retry.
+        """
+        pending = batch
+        interval = self.retry_interval
+        for attempt in range(self.retries + 1):
+            try:
+                pending = self.upload(pending)
+            except Exception as e:
+                logging.warning("Could not upload images: " + str(e))
+            for entry in batch:
+                if entry not in pending and entry.spool_path is not None:
+                    self._remove_spooled(entry)
+            if len(pending) == 0 or attempt == self.retries:
+                break
+            with self._condition:
+                # a closing queue spools the entries instead of waiting
+                if self._closed:
+                    break
+                self.retried += len(pending)
+                self._condition.wait(interval)
+            interval *= 2
+        return pending
+
+    def _spool(self, entry) -> None:
+        """
+        Writes the entry to the spool directory, unless it is there already.
+        """
+        if entry.spool_path is not None:
+            with self._condition:
+                self._spool_pending = True
+            return
+        path = os.path.join(self.spool_dir, entry.container, entry.name)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                f.write(entry.data)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logging.error(f"Could not spool image {entry.name}: {e}")
+            return
+        with self._condition:
+            self.spooled += 1
+            self._spool_pending = True
+
+    def _remove_spooled(self, entry) -> None:
+        try:
+            os.remove(entry.spool_path)
+        except OSError:
+            pass
+        entry.spool_path = None
+
+    def _unspool(self) -> None:
+        """
+        Queues spooled entries while the queue has room.
+        """
+        with self._condition:
+            if not self._spool_pending or self._closed:
+                return
+            room = self.max_size - len(self._queue)
+            queued = set(
+                entry.spool_path
+                for entry in list(self._queue) + self._in_flight
+            )
+        entries = []
+        for path in self._spool_files():
+            if len(entries) >= room:
+                break
+            if path in queued:
+                continue
+            relative = os.path.relpath(path, self.spool_dir)
+            container, _, name = relative.replace(os.sep, "/").partition("/")
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                queued_at = os.path.getmtime(path)
+            except OSError:
+                continue
+            entries.append(UploadEntry(container, name, data, queued_at, path))
+
+        with self._condition:
+            self._spool_pending = len(entries) >= room
+            self._queue.extend(entries)
+            self._condition.notify_all()
+
+    def _spool_files(self):
+        for directory, _, files in os.walk(self.spool_dir):
+            for file in sorted(files):
+                if not file.endswith(".tmp"):
+                    yield os.path.join(directory, file)
+
+    def flush(self, timeout=None) -> bool:
+        """
+        Waits until every queued entry has been uploaded or spooled.
+        Returns False if the timeout expired first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._queue or self._in_flight:
+                if deadline is None:
+                    self._condition.wait()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def close(self, timeout=None) -> None:
+        """
+        Stops accepting entries, uploads the queued entries within the
+        timeout, and spools the rest. Called at exit.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        with self._condition:
+            remaining = list(self._queue) + self._in_flight
+            self._queue.clear()
+        for entry in remaining:
+            self._spool(entry)
+
+    def stats(self) -> dict:
+        with self._condition:
+            pending = list(self._queue) + self._in_flight
+            oldest = min((entry.queued for entry in pending), default=None)
+            return {
+                "depth": len(pending),
+                "lag": 0.0 if oldest is None else time.time() - oldest,
+                "uploaded": self.uploaded,
+                "retried": self.retried,
+                "spooled": self.spooled,
+                "closed": self._closed,
+            }